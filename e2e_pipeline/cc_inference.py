@@ -1,10 +1,17 @@
 import torch
+import higra as hg
+import numpy as np
+from time import time
 
 from e2e_pipeline.mlp_layer import MLPLayer
-from e2e_pipeline.sdp_layer import SDPLayer
+from e2e_pipeline.sdp_layer import SDPLayer, get_max_agree_objective
+from e2e_pipeline.reduction_layer import CCReductionLayer
+from e2e_pipeline.exact_cc import solve_exact_cc, MAX_EXACT_SIZE
+from e2e_pipeline.cc_router import CCRouter
 from e2e_pipeline.hac_cut_layer import HACCutLayer
 from e2e_pipeline.trellis_cut_layer import TrellisCutLayer
 from e2e_pipeline.uncompress_layer import UncompressTransformLayer
+from utils.condensed_matrix import triu_indices_np
 import logging
 from IPython import embed
 
@@ -15,29 +22,149 @@ logger = logging.getLogger(__name__)
 class CCInference(torch.nn.Module):
     """
     Correlation clustering inference-only model. Expects edge weights and the number of nodes as input.
+    The method used for each block is picked by a CCRouter; by default, blocks of size <= exact_max_size are solved
+    exactly and all others go through SDP (or sigmoid, if use_sdp is False) + HAC-cut (or trellis-cut, if rounding is
+    "trellis").
     """
 
-    def __init__(self, sdp_max_iters, sdp_eps, sdp_scale, use_sdp):
+    def __init__(self, sdp_max_iters, sdp_eps, sdp_scale, use_sdp, sdp_solver="scs", sdp_lowrank_rank=-1,
+                 sdp_report_gap=False, sdp_warm_start=False, sdp_warm_start_mem_mb=1024, sdp_warm_start_dir=None,
+                 sdp_reduce=False, sdp_reduce_tol=0., sdp_contraction_ratio=1., exact_max_size=0, router=None,
+                 batch_round_max_size=0, batch_round_size=256, rounding="hac", trellis_linkages=None):
         super().__init__()
         self.uncompress_layer = UncompressTransformLayer()
-        self.sdp_layer = SDPLayer(max_iters=sdp_max_iters, eps=sdp_eps, scale_input=sdp_scale)
+        self.sdp_layer = SDPLayer(max_iters=sdp_max_iters, eps=sdp_eps, scale_input=sdp_scale, solver=sdp_solver,
+                                  lowrank_rank=sdp_lowrank_rank, report_gap=sdp_report_gap,
+                                  warm_start=sdp_warm_start, warm_start_mem_mb=sdp_warm_start_mem_mb,
+                                  warm_start_dir=sdp_warm_start_dir)
+        self.reduction_layer = CCReductionLayer(tol=sdp_reduce_tol, contraction_ratio=sdp_contraction_ratio)
+        if rounding not in ["hac", "trellis"]:
+            raise ValueError("Invalid value for rounding")
         self.hac_cut_layer = HACCutLayer()
+        self.trellis_cut_layer = TrellisCutLayer(linkages=trellis_linkages)
+        self.rounding = rounding
         self.use_sdp = use_sdp
+        self.sdp_reduce = sdp_reduce
+        if router is None:
+            router = CCRouter(exact_max_size=exact_max_size, sdp_max_size=-1 if use_sdp else 0)
+        if not 0 <= router.max_sizes["exact"] <= MAX_EXACT_SIZE:
+            raise ValueError(f"The exact route is limited to blocks of size <= {MAX_EXACT_SIZE}")
+        self.router = router
+        # Blocks up to this size can be clustered in batches of batch_round_size (see forward_batch)
+        self.batch_round_max_size = batch_round_max_size
+        self.batch_round_size = batch_round_size
+        # Results of the last call
+        self.cluster_labels = None
+        self.round_objective_value = None
+        self.frac_objective_value = None
+        self.route = None
 
-    def forward(self, edge_weights, N, min_id=0, threshold=None, verbose=False):
+    @property
+    def cut_layer(self):
+        return self.trellis_cut_layer if self.rounding == "trellis" else self.hac_cut_layer
+
+    def forward(self, edge_weights, N, min_id=0, threshold=None, verbose=False, block_id=None):
+        self.route = self.router.route(N)
+        start_time = time()
+        cluster_labels = self.solve_routed(edge_weights, N, self.route, threshold=threshold, verbose=verbose,
+                                           block_id=block_id)
+        self.router.record(N, self.route, time() - start_time)
+        if verbose:
+            logger.info(f"Block of size {N} routed to {self.route}")
+        return (cluster_labels + min_id).tolist()
+
+    def forward_batch(self, edge_weights_list, Ns, threshold=None, verbose=False, block_ids=None):
+        """
+        Clusters a group of blocks, with the rounding of all blocks routed to "sdp" or "nosdp" done in batched calls
+        (one for the dense blocks, one for those rounded in condensed form). Returns one dict per block with its
+        cluster labels (starting at 0), objective values and route
+        """
+        block_ids = block_ids if block_ids is not None else [None] * len(edge_weights_list)
+        results, Xs, Ws, round_idxs = [], [], [], []
+        xs, ws, condensed_Ns, condensed_idxs = [], [], [], []  # Blocks rounded in condensed form
+        for edge_weights, N, block_id in zip(edge_weights_list, Ns, block_ids):
+            route = self.router.route(N)
+            start_time = time()
+            if route in ("exact", "hac"):
+                self.solve_routed(edge_weights, N, route, threshold=threshold, verbose=verbose, block_id=block_id)
+                result = {'cluster_labels': self.cluster_labels,
+                          'round_objective_value': self.round_objective_value,
+                          'sdp_objective_value': self.frac_objective_value}
+            elif self.use_condensed(route):
+                W_val, output_probs = self.sdp_layer.forward_condensed(self.get_edge_weights(edge_weights,
+                                                                                             threshold=threshold),
+                                                                       N, verbose=verbose)
+                xs.append(output_probs)
+                ws.append(W_val)
+                condensed_Ns.append(N)
+                condensed_idxs.append(len(results))
+                result = {'cluster_labels': None,
+                          'round_objective_value': None,
+                          'sdp_objective_value': self.sdp_layer.objective_value}
+            else:
+                edge_weights_uncompressed = self.get_weight_matrix(edge_weights, N, threshold=threshold)
+                Xs.append(self.solve_relaxation(edge_weights_uncompressed, N, route, verbose=verbose,
+                                                block_id=block_id))
+                Ws.append(edge_weights_uncompressed)
+                round_idxs.append(len(results))
+                result = {'cluster_labels': None,
+                          'round_objective_value': None,
+                          'sdp_objective_value': self.sdp_layer.objective_value}
+            result.update({'sdp_objective_gap': self.sdp_layer.objective_gap,
+                           'route': route,
+                           'route_seconds': time() - start_time})
+            results.append(result)
+
+        for idxs, get_rounded_solutions in [
+            (round_idxs, lambda: self.cut_layer.get_rounded_solutions(Xs, Ws)),
+            (condensed_idxs, lambda: self.hac_cut_layer.get_rounded_solutions_condensed(xs, ws, condensed_Ns,
+                                                                                        fill_value=0.5))]:
+            start_time = time()
+            cluster_labels, objective_values = get_rounded_solutions()
+            round_seconds = (time() - start_time) / max(len(idxs), 1)
+            for i, labels, objective_value in zip(idxs, cluster_labels, objective_values):
+                results[i]['cluster_labels'] = labels
+                results[i]['round_objective_value'] = objective_value
+                results[i]['route_seconds'] += round_seconds
+        for N, result in zip(Ns, results):
+            self.router.record(N, result['route'], result['route_seconds'])
+        return results
+
+    def use_condensed(self, route):
+        # Without the SDP, the sigmoid relaxation and the HAC-cut rounding run on the condensed edge weights
+        return route == "nosdp" and self.rounding == "hac"
+
+    def get_edge_weights(self, edge_weights, threshold=None):
         edge_weights = torch.squeeze(edge_weights)
         if threshold is not None:
             # threshold is used to convert a similarity score (in [0,1]) into edge weights (in R, i.e. + and -)
             edge_weights = torch.sigmoid(edge_weights) - threshold + 1e-5
             # Constant added above for numerical stability: scenario where edge_weights all become 0's
-        edge_weights_uncompressed = self.uncompress_layer(edge_weights, N)
-        output_probs = self.sdp_layer(edge_weights_uncompressed, N, use_sdp=self.use_sdp)
-        pred_clustering = self.hac_cut_layer(output_probs, edge_weights_uncompressed)
+        return edge_weights.reshape(-1)
 
-        if verbose:
-            logger.info(f"Size of W = {edge_weights.size()}")
-            logger.info(f"\n{edge_weights}")
+    def get_weight_matrix(self, edge_weights, N, threshold=None):
+        return self.uncompress_layer(self.get_edge_weights(edge_weights, threshold=threshold), N)
+
+    def solve_relaxation(self, edge_weights_uncompressed, N, route, verbose=False, block_id=None):
+        use_sdp = route == "sdp"
+        if use_sdp and self.sdp_reduce:
+            return self.reduction_layer(edge_weights_uncompressed, N, self.sdp_layer, verbose=verbose,
+                                        block_id=block_id)
+        return self.sdp_layer(edge_weights_uncompressed, N, use_sdp=use_sdp, block_id=block_id)
+
+    def solve_routed(self, edge_weights, N, route, threshold=None, verbose=False, block_id=None):
+        if route == "hac":
+            return self.solve_hac(edge_weights, N, threshold=threshold, verbose=verbose)
+        if self.use_condensed(route):
+            return self.solve_condensed(edge_weights, N, threshold=threshold, verbose=verbose)
+        edge_weights_uncompressed = self.get_weight_matrix(edge_weights, N, threshold=threshold)
+        if route == "exact":
+            return self.solve_exact(edge_weights_uncompressed, N, verbose=verbose)
 
+        output_probs = self.solve_relaxation(edge_weights_uncompressed, N, route, verbose=verbose, block_id=block_id)
+        pred_clustering = self.cut_layer(output_probs, edge_weights_uncompressed)
+
+        if verbose:
             logger.info(f"Size of W_matrix = {edge_weights_uncompressed.size()}")
             logger.info(f"\n{edge_weights_uncompressed}")
 
@@ -46,5 +173,57 @@ class CCInference(torch.nn.Module):
 
             logger.info(f"Size of X_r = {pred_clustering.size()}")
             logger.info(f"\n{pred_clustering}")
+        self.cluster_labels = self.cut_layer.cluster_labels
+        self.round_objective_value = self.cut_layer.objective_value
+        self.frac_objective_value = self.sdp_layer.objective_value
+        return self.cluster_labels
+
+    def solve_condensed(self, edge_weights, N, threshold=None, verbose=False):
+        """
+        Sigmoid relaxation + HAC-cut on the N(N-1)/2 condensed edge weights, without any NxN tensors
+        """
+        W_val, output_probs = self.sdp_layer.forward_condensed(self.get_edge_weights(edge_weights, threshold=threshold),
+                                                               N, verbose=verbose)
+        # The entries of the dense sigmoid matrix outside of the strict upper triangle are sigmoid(0)
+        self.hac_cut_layer.get_rounded_solution_condensed(output_probs, W_val, N, fill_value=0.5)
+        self.cluster_labels = self.hac_cut_layer.cluster_labels
+        self.round_objective_value = self.hac_cut_layer.objective_value
+        self.frac_objective_value = self.sdp_layer.objective_value
+        if verbose:
+            logger.info(f"Sigmoid + HAC-cut solution: objective={self.round_objective_value}, "
+                        f"labels={self.cluster_labels}")
+        return self.cluster_labels
 
-        return (self.hac_cut_layer.cluster_labels + min_id).tolist()
+    def solve_exact(self, edge_weights_uncompressed, N, verbose=False):
+        # Same scaling as in the SDP route, so that objective values are comparable across blocks
+        W_val = self.sdp_layer.scaled(edge_weights_uncompressed)
+        self.cluster_labels, _, self.round_objective_value = solve_exact_cc(W_val, N)
+        self.frac_objective_value = self.round_objective_value  # No relaxation
+        self.sdp_layer.scs_objective_value, self.sdp_layer.objective_gap = None, None
+        if verbose:
+            logger.info(f"Exact solution: objective={self.round_objective_value}, labels={self.cluster_labels}")
+        return self.cluster_labels
+
+    def solve_hac(self, edge_weights, N, threshold=None, verbose=False):
+        """
+        Higra average-linkage HAC (as in HACInference) on distances 1 - sigmoid(w), cut where the average edge weight
+        changes sign (or where the average similarity drops below threshold, if given)
+        """
+        edge_weights = torch.squeeze(edge_weights)
+        cut_threshold = 0.5 if threshold is None else 1. - threshold
+        graph = hg.UndirectedGraph(N)
+        graph.add_edges(*triu_indices_np(N))
+        dists = 1. - torch.sigmoid(edge_weights).detach().cpu().numpy().reshape(N * (N - 1) // 2)
+        tree, altitudes = hg.binary_partition_tree_average_linkage(graph, dists)
+        cut = hg.HorizontalCutExplorer(tree, altitudes).horizontal_cut_from_altitude(cut_threshold)
+        self.cluster_labels = torch.tensor(cut.labelisation_leaves(tree), dtype=torch.long)
+        # Objective of the clustering on the (thresholded) weights; there is no relaxation to compare against
+        W_val = self.sdp_layer.scaled(self.get_weight_matrix(edge_weights, N, threshold=threshold))
+        round_matrix = (self.cluster_labels[:, None] == self.cluster_labels[None, :]).type(W_val.dtype).to(
+            W_val.device)
+        self.round_objective_value = get_max_agree_objective(W_val, round_matrix)
+        self.frac_objective_value = self.round_objective_value
+        self.sdp_layer.scs_objective_value, self.sdp_layer.objective_gap = None, None
+        if verbose:
+            logger.info(f"HAC solution: objective={self.round_objective_value}, labels={self.cluster_labels}")
+        return self.cluster_labels
@@ -0,0 +1,64 @@
+import logging
+from collections import Counter, deque
+from IPython import embed
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CCRouter:
+    """
+    Per-block routing policy for CCInference. Picks one of the following routes from the block size:
+        "exact": exact enumeration of all clusterings (N <= exact_max_size)
+        "sdp": SDP + HAC-cut rounding (N <= sdp_max_size)
+        "nosdp": sigmoid + HAC-cut rounding (N <= nosdp_max_size)
+        "hac": higra average-linkage HAC, cut at the sign of the edge weights (any N)
+    A max size of -1 means unlimited, and 0 disables the route. With a time_budget (in seconds), a route is also
+    skipped if its predicted time for the block exceeds the budget; times are extrapolated as c * N^3 from the
+    largest block observed on each route, so the budget only applies to a route once a block has been recorded on it
+    (the first block routed to it is never skipped for time). The last log_size routed blocks are recorded in `log`
+    (see reset_log).
+    """
+
+    ROUTES = ["exact", "sdp", "nosdp", "hac"]
+
+    def __init__(self, exact_max_size=0, sdp_max_size=-1, nosdp_max_size=-1, time_budget=None, log_size=100000):
+        self.max_sizes = {
+            "exact": exact_max_size,
+            "sdp": sdp_max_size,
+            "nosdp": nosdp_max_size,
+            "hac": -1
+        }
+        self.time_budget = time_budget
+        self._largest_obs = {}  # route -> (N, seconds) of the largest block seen on the route
+        self.log = deque(maxlen=log_size)  # (block_size, route, seconds) per routed block
+
+    def predict_time(self, route, N):
+        if route not in self._largest_obs:
+            return None
+        _N, _seconds = self._largest_obs[route]
+        return _seconds * (N / _N) ** 3
+
+    def route(self, N):
+        for route in self.ROUTES:
+            max_size = self.max_sizes[route]
+            if max_size == 0 or (max_size != -1 and N > max_size):
+                continue
+            if route != "hac" and self.time_budget is not None:
+                predicted_time = self.predict_time(route, N)  # None until the route has a recorded block
+                if predicted_time is not None and predicted_time > self.time_budget:
+                    continue
+            return route
+
+    def record(self, N, route, seconds):
+        self.log.append((N, route, seconds))
+        if route not in self._largest_obs or N >= self._largest_obs[route][0]:
+            self._largest_obs[route] = (N, seconds)
+
+    def stats(self):
+        return dict(Counter(route for _, route, _ in self.log))
+
+    def reset_log(self):
+        # The time predictions are kept
+        self.log.clear()
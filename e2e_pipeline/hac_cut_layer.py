@@ -1,4 +1,358 @@
 import torch
+import numba as nb
+import numpy as np
+
+from utils.condensed_matrix import compress, triu_indices
+
+
+@nb.njit
+def _argmin_row(Y: np.ndarray, i: int):
+    # First minimum of row i (same tie-breaking as torch.min along a dimension)
+    best = 0
+    for j in range(1, Y.shape[1]):
+        if Y[i, j] < Y[i, best]:
+            best = j
+    return best
+
+
+@nb.njit
+def _build_and_cut(Y: np.ndarray, W_sym: np.ndarray, max_dist, weights_f32: bool):
+    """
+    Average-linkage HAC on the upper-triangular dissimilarity matrix Y (all other entries equal to max_dist), cut to
+    maximize the intra-cluster weight sum. Mirrors the dense merge loop of the original torch implementation: at each
+    step the lexicographically first (row, column) pair at the global minimum is merged into the row, and the new
+    dissimilarities are computed in the dtype of Y. Row minima are maintained incrementally, and intra-cluster weight
+    sums are computed in O(1) per merge from a running table of cross-cluster weight sums between the current
+    clusters (initialized with W_sym, the symmetric weight matrix). Y and W_sym are modified in place.
+    Returns parents, per-node energies of the best cut of each subtree (float32), per-node intra-cluster weight sums,
+    whether each node is selected in the cut, and the merges (m1, m2)
+    """
+    D = Y.shape[0]
+    n_nodes = D + (D - 1)
+    parents = np.arange(n_nodes)
+    idx_to_parent = np.arange(D)
+    cluster_sizes = np.ones(n_nodes, dtype=Y.dtype)
+    energy = np.zeros(n_nodes, dtype=np.float32)
+    intra = np.zeros(n_nodes, dtype=np.float64)
+    selected = np.zeros(n_nodes, dtype=np.bool_)
+    merges = np.zeros((max(D - 1, 0), 2), dtype=np.int64)
+    cross = W_sym  # cross[a, b]: sum of the weights between the clusters of rows a and b
+
+    values = np.empty(D, dtype=Y.dtype)
+    indices = np.empty(D, dtype=np.int64)
+    for i in range(D):
+        indices[i] = _argmin_row(Y, i)
+        values[i] = Y[i, indices[i]]
+    new_values = np.empty(D, dtype=Y.dtype)
+
+    max_node = D - 1
+    for it in range(D - 1):
+        max_node += 1
+        merge_idx_1 = 0
+        for i in range(1, D):
+            if values[i] < values[merge_idx_1]:
+                merge_idx_1 = i
+        merge_idx_2 = indices[merge_idx_1]
+        merges[it, 0], merges[it, 1] = merge_idx_1, merge_idx_2
+
+        parent_1, parent_2 = idx_to_parent[merge_idx_1], idx_to_parent[merge_idx_2]
+        parents[parent_1] = max_node
+        parents[parent_2] = max_node
+        idx_to_parent[merge_idx_1] = max_node
+
+        # Average-linkage update of the merged row / column; entries at max_dist stay masked
+        size_1, size_2 = cluster_sizes[parent_1], cluster_sizes[parent_2]
+        new_cluster_size = size_1 + size_2
+        cluster_sizes[max_node] = new_cluster_size
+        for j in range(D):
+            new_values[j] = (min(Y[merge_idx_1, j], Y[j, merge_idx_1]) * size_1 +
+                             min(Y[j, merge_idx_2], Y[merge_idx_2, j]) * size_2) / new_cluster_size
+        for j in range(D):
+            if Y[merge_idx_1, j] != max_dist:
+                Y[merge_idx_1, j] = new_values[j]
+            if Y[j, merge_idx_1] != max_dist:
+                Y[j, merge_idx_1] = new_values[j]
+        for j in range(D):
+            Y[merge_idx_2, j] = max_dist
+            Y[j, merge_idx_2] = max_dist
+
+        # Update the row minima that could have changed
+        values[merge_idx_2] = max_dist
+        if values[merge_idx_1] != max_dist:
+            indices[merge_idx_1] = _argmin_row(Y, merge_idx_1)
+            values[merge_idx_1] = Y[merge_idx_1, indices[merge_idx_1]]
+        for i in range(D):
+            # Rows at max_dist stay masked
+            if i == merge_idx_1 or values[i] == max_dist:
+                continue
+            if indices[i] == merge_idx_1 or indices[i] == merge_idx_2:
+                indices[i] = _argmin_row(Y, i)
+                values[i] = Y[i, indices[i]]
+            elif Y[i, merge_idx_1] < values[i] or (Y[i, merge_idx_1] == values[i] and merge_idx_1 < indices[i]):
+                indices[i] = merge_idx_1
+                values[i] = Y[i, merge_idx_1]
+
+        # Energy of the merged cluster from its children's intra-cluster sums and their cross term
+        intra[max_node] = intra[parent_1] + intra[parent_2] + cross[merge_idx_1, merge_idx_2]
+        for j in range(D):
+            cross[merge_idx_1, j] += cross[merge_idx_2, j]
+            cross[j, merge_idx_1] = cross[merge_idx_1, j]
+        energy[max_node] = energy[parent_1] + energy[parent_2]
+        if weights_f32:
+            merge_energy = np.float32(intra[max_node])
+            select = merge_energy >= energy[max_node]
+        else:
+            merge_energy = intra[max_node]
+            select = merge_energy >= np.float64(energy[max_node])
+        if select:
+            energy[max_node] = np.float32(merge_energy)
+            selected[max_node] = True
+
+    return parents, energy, intra, selected, merges
+
+
+@nb.njit
+def _get_cut_labels(parents: np.ndarray, selected: np.ndarray, D: int):
+    """
+    Returns the highest selected node above each leaf (-1 if none), and the cluster label of each leaf: the id of
+    that node, or (leaf index + 1) for leaves that are not in any selected cluster
+    """
+    n_nodes = parents.size
+    top = np.full(n_nodes, -1, dtype=np.int64)
+    # Parents always have larger ids than their children
+    for node in range(n_nodes - 1, -1, -1):
+        parent = parents[node]
+        if parent != node and top[parent] != -1:
+            top[node] = top[parent]
+        elif selected[node]:
+            top[node] = node
+    labels = np.empty(D, dtype=np.float32)
+    for i in range(D):
+        labels[i] = top[i] if top[i] != -1 else i + 1
+    return top[:D], labels
+
+
+@nb.njit(parallel=True)
+def _batch_build_and_cut(Ys: np.ndarray, W_syms: np.ndarray, sizes: np.ndarray, max_dists: np.ndarray,
+                         weights_f32: bool):
+    """
+    Runs _build_and_cut on a batch of blocks in parallel. Ys and W_syms hold the flattened NxN matrices of all blocks,
+    back to back (in place). Returns the concatenated cluster labels of all blocks, and the max-agree objective of
+    each block
+    """
+    n_blocks = sizes.size
+    offsets = np.zeros(n_blocks + 1, dtype=np.int64)
+    label_offsets = np.zeros(n_blocks + 1, dtype=np.int64)
+    for b in range(n_blocks):
+        offsets[b + 1] = offsets[b] + sizes[b] * sizes[b]
+        label_offsets[b + 1] = label_offsets[b] + sizes[b]
+    all_labels = np.empty(label_offsets[-1], dtype=np.float32)
+    objective_values = np.empty(n_blocks, dtype=np.float64)
+    # Largest blocks first, for a better balance across threads
+    order = np.argsort(-sizes)
+    for k in nb.prange(n_blocks):
+        b = order[k]
+        D = sizes[b]
+        Y = Ys[offsets[b]:offsets[b + 1]].reshape((D, D))
+        W_sym = W_syms[offsets[b]:offsets[b + 1]].reshape((D, D))
+        # Negative intra-cluster weights are read before W_sym is used as the cross-cluster table
+        W_neg = np.minimum(W_sym, 0.)
+        parents, energy, _, selected, _ = _build_and_cut(Y, W_sym, max_dists[b], weights_f32)
+        top, labels = _get_cut_labels(parents, selected, D)
+        negative_sum = 0.
+        for i in range(D):
+            if top[i] == -1:
+                continue
+            for j in range(i + 1, D):
+                if top[j] == top[i]:
+                    negative_sum += W_neg[i, j]
+        all_labels[label_offsets[b]:label_offsets[b + 1]] = labels
+        objective_values[b] = energy[-1] - negative_sum  # MA
+    return all_labels, objective_values
+
+
+@nb.njit
+def _get_row_offsets(D: int):
+    # The pair (i, j), i < j, is at row_offsets[i] + j in the condensed vector (np.triu_indices order)
+    row_offsets = np.empty(D, dtype=np.int64)
+    for i in range(D):
+        row_offsets[i] = i * (2 * D - i - 1) // 2 - i - 1
+    return row_offsets
+
+
+@nb.njit
+def _pair_index(row_offsets: np.ndarray, i: int, j: int):
+    if i < j:
+        return row_offsets[i] + j
+    return row_offsets[j] + i
+
+
+@nb.njit
+def _argmin_row_condensed(Yc: np.ndarray, row_offsets: np.ndarray, i: int, D: int, max_dist):
+    # Same as _argmin_row on the dense matrix, whose entries outside of the strict upper triangle are max_dist
+    best, best_value = 0, max_dist
+    for j in range(i + 1, D):
+        if Yc[row_offsets[i] + j] < best_value:
+            best, best_value = j, Yc[row_offsets[i] + j]
+    return best, best_value
+
+
+@nb.njit
+def _build_and_cut_condensed(Yc: np.ndarray, Wc: np.ndarray, D: int, max_dist, weights_f32: bool):
+    """
+    Condensed-form version of _build_and_cut, with the same merges and outputs: Yc holds the N(N-1)/2 dissimilarities
+    of the strict upper triangle (all other entries being implicitly max_dist, which must have the dtype of Yc), and
+    Wc the (float64) condensed edge weights, used as the table of cross-cluster weight sums. No NxN array is
+    allocated. Yc and Wc are modified in place
+    """
+    n_nodes = D + (D - 1)
+    parents = np.arange(n_nodes)
+    idx_to_parent = np.arange(D)
+    cluster_sizes = np.ones(n_nodes, dtype=Yc.dtype)
+    energy = np.zeros(n_nodes, dtype=np.float32)
+    intra = np.zeros(n_nodes, dtype=np.float64)
+    selected = np.zeros(n_nodes, dtype=np.bool_)
+    merges = np.zeros((max(D - 1, 0), 2), dtype=np.int64)
+    row_offsets = _get_row_offsets(D)
+
+    values = np.empty(D, dtype=Yc.dtype)
+    indices = np.empty(D, dtype=np.int64)
+    for i in range(D):
+        indices[i], values[i] = _argmin_row_condensed(Yc, row_offsets, i, D, max_dist)
+
+    max_node = D - 1
+    for it in range(D - 1):
+        max_node += 1
+        merge_idx_1 = 0
+        for i in range(1, D):
+            if values[i] < values[merge_idx_1]:
+                merge_idx_1 = i
+        # Row minima are always in the upper triangle, so merge_idx_1 < merge_idx_2
+        merge_idx_2 = indices[merge_idx_1]
+        merges[it, 0], merges[it, 1] = merge_idx_1, merge_idx_2
+
+        parent_1, parent_2 = idx_to_parent[merge_idx_1], idx_to_parent[merge_idx_2]
+        parents[parent_1] = max_node
+        parents[parent_2] = max_node
+        idx_to_parent[merge_idx_1] = max_node
+
+        # Average-linkage update of the pairs of the merged cluster; pairs at max_dist stay masked
+        size_1, size_2 = cluster_sizes[parent_1], cluster_sizes[parent_2]
+        new_cluster_size = size_1 + size_2
+        cluster_sizes[max_node] = new_cluster_size
+        for j in range(D):
+            if j == merge_idx_1 or j == merge_idx_2:
+                continue
+            p1 = _pair_index(row_offsets, merge_idx_1, j)
+            if Yc[p1] != max_dist:
+                Yc[p1] = (Yc[p1] * size_1 + Yc[_pair_index(row_offsets, merge_idx_2, j)] * size_2) / new_cluster_size
+        for j in range(D):
+            if j != merge_idx_2:
+                Yc[_pair_index(row_offsets, merge_idx_2, j)] = max_dist
+
+        # Update the row minima that could have changed
+        values[merge_idx_2] = max_dist
+        if values[merge_idx_1] != max_dist:
+            indices[merge_idx_1], values[merge_idx_1] = _argmin_row_condensed(Yc, row_offsets, merge_idx_1, D,
+                                                                              max_dist)
+        for i in range(D):
+            # Rows at max_dist stay masked
+            if i == merge_idx_1 or values[i] == max_dist:
+                continue
+            if indices[i] == merge_idx_1 or indices[i] == merge_idx_2:
+                indices[i], values[i] = _argmin_row_condensed(Yc, row_offsets, i, D, max_dist)
+            elif i < merge_idx_1:
+                value = Yc[row_offsets[i] + merge_idx_1]
+                if value < values[i] or (value == values[i] and merge_idx_1 < indices[i]):
+                    indices[i], values[i] = merge_idx_1, value
+
+        # Energy of the merged cluster from its children's intra-cluster sums and their cross term
+        intra[max_node] = intra[parent_1] + intra[parent_2] + Wc[_pair_index(row_offsets, merge_idx_1, merge_idx_2)]
+        for j in range(D):
+            if j != merge_idx_1 and j != merge_idx_2:
+                Wc[_pair_index(row_offsets, merge_idx_1, j)] += Wc[_pair_index(row_offsets, merge_idx_2, j)]
+        energy[max_node] = energy[parent_1] + energy[parent_2]
+        if weights_f32:
+            merge_energy = np.float32(intra[max_node])
+            select = merge_energy >= energy[max_node]
+        else:
+            merge_energy = intra[max_node]
+            select = merge_energy >= np.float64(energy[max_node])
+        if select:
+            energy[max_node] = np.float32(merge_energy)
+            selected[max_node] = True
+
+    return parents, energy, intra, selected, merges
+
+
+@nb.njit(parallel=True)
+def _batch_build_and_cut_condensed(Ycs: np.ndarray, Wcs: np.ndarray, sizes: np.ndarray, max_dists: np.ndarray,
+                                   weights_f32: bool):
+    """
+    Condensed-form version of _batch_build_and_cut: Ycs and Wcs hold the condensed vectors of all blocks, back to
+    back (in place), and max_dists has the dtype of Ycs
+    """
+    n_blocks = sizes.size
+    offsets = np.zeros(n_blocks + 1, dtype=np.int64)
+    label_offsets = np.zeros(n_blocks + 1, dtype=np.int64)
+    for b in range(n_blocks):
+        offsets[b + 1] = offsets[b] + sizes[b] * (sizes[b] - 1) // 2
+        label_offsets[b + 1] = label_offsets[b] + sizes[b]
+    all_labels = np.empty(label_offsets[-1], dtype=np.float32)
+    objective_values = np.empty(n_blocks, dtype=np.float64)
+    # Largest blocks first, for a better balance across threads
+    order = np.argsort(-sizes)
+    for k in nb.prange(n_blocks):
+        b = order[k]
+        D = sizes[b]
+        Yc = Ycs[offsets[b]:offsets[b + 1]]
+        Wc = Wcs[offsets[b]:offsets[b + 1]]
+        # Negative intra-cluster weights are read before Wc is used as the cross-cluster table
+        W_neg = np.minimum(Wc, 0.)
+        parents, energy, _, selected, _ = _build_and_cut_condensed(Yc, Wc, D, max_dists[b], weights_f32)
+        top, labels = _get_cut_labels(parents, selected, D)
+        negative_sum = 0.
+        p = 0
+        for i in range(D):
+            for j in range(i + 1, D):
+                if top[i] != -1 and top[j] == top[i]:
+                    negative_sum += W_neg[p]
+                p += 1
+        all_labels[label_offsets[b]:label_offsets[b + 1]] = labels
+        objective_values[b] = energy[-1] - negative_sum  # MA
+    return all_labels, objective_values
+
+
+def _get_dissimilarities(X, _MAX_DIST=1000, use_similarities=True, max_similarity=1):
+    """
+    Returns the upper-triangular NxN dissimilarity matrix (as a numpy array), with all other entries masked by a
+    large value, and that value
+    """
+    D = X.size(1)
+    with torch.no_grad():
+        _MAX_DIST = torch.max(torch.abs(X)) * _MAX_DIST
+        Y = _MAX_DIST * torch.ones(D, D, device=X.device).tril() + \
+            (max_similarity - X if use_similarities else X).triu(1)
+    return Y.cpu().numpy().copy(), _MAX_DIST.item()
+
+
+def _get_condensed_dissimilarities(x, _MAX_DIST=1000, use_similarities=True, fill_value=None):
+    """
+    Condensed version of _get_dissimilarities: returns the dissimilarities of the N(N-1)/2 pairs (as a numpy array)
+    and the masking value (with the dtype of x). fill_value stands for the entries of the dense X outside of the
+    strict upper triangle (e.g. sigmoid(0) = 0.5 for the sigmoid relaxation), which count towards the max similarity
+    and the masking value exactly as in the dense layer
+    """
+    with torch.no_grad():
+        max_abs = torch.max(torch.abs(x)) if x.numel() > 0 else torch.zeros((), dtype=x.dtype, device=x.device)
+        max_similarity = torch.max(x) if x.numel() > 0 else torch.full((), -np.inf, dtype=x.dtype, device=x.device)
+        if fill_value is not None:
+            max_abs = torch.clamp(max_abs, min=abs(fill_value))
+            max_similarity = torch.clamp(max_similarity, min=fill_value)
+        _MAX_DIST = max_abs * _MAX_DIST
+        Yc = max_similarity - x if use_similarities else x
+    Yc = Yc.cpu().numpy().copy()
+    return Yc, Yc.dtype.type(_MAX_DIST.item())
 
 
 class HACCutLayer(torch.nn.Module):
@@ -8,6 +362,9 @@ class HACCutLayer(torch.nn.Module):
         self.cluster_labels = None
         self.parents = None
         self.objective_value = None
+        # Per-node attributes of the last HAC tree (indexed like parents)
+        self.node_energies = None  # Energy of the best cut of the subtree under each node
+        self.cluster_energies = None  # Intra-cluster weight sum of each node
 
     """
     Takes fractional SDP output as input, and simultaneously builds & cuts avg. HAC tree to get rounded solution.
@@ -23,117 +380,139 @@ class HACCutLayer(torch.nn.Module):
         # Initialization
         device = X.device
         D = X.size(1)
-        parents = torch.arange(D + (D - 1))
-        parent_to_idx = torch.arange(D + (D - 1))
-        idx_to_parent = torch.arange(D)
-        cluster_sizes = torch.ones(D + (D - 1))
-
-        energy = torch.zeros(D + (D - 1), device=device)
-        clustering = torch.zeros((D + (D - 1), D))
-        clustering[torch.arange(D), torch.arange(D)] = torch.arange(1, D + 1, dtype=clustering.dtype)
-        round_matrix = torch.eye(D, device=device)
 
         # Take the upper triangular and mask the other values with a large number
-        _MAX_DIST = torch.max(torch.abs(X)) * _MAX_DIST
-        Y = _MAX_DIST * torch.ones(D, D, device=device).tril() + (max_similarity - X if use_similarities else X).triu(1)
-        # Compute the dissimilarity minima per row
-        values, indices = torch.min(Y, dim=1)
+        Y, max_dist = _get_dissimilarities(X, _MAX_DIST, use_similarities, max_similarity)
+        W = weights.detach()
+        W_sym = (W + W.T).cpu().numpy().astype(np.float64)
+        parents, energy, intra, selected, merges = _build_and_cut(Y, W_sym, max_dist, W.dtype != torch.float64)
+        top, cluster_labels = _get_cut_labels(parents, selected, D)
 
         if verbose:
-            print('Initialization:')
-            print('Y:', Y)
+            print('Merges (row indices):', merges.tolist())
             print('\tparents:', parents)
-            print('\tparent_to_idx:', parent_to_idx)
-            print('\tidx_to_parent:', idx_to_parent)
-            print('\tminima (values):', values)
-            print('\tminima (indices):', indices)
-            print('\tcluster_sizes:', cluster_sizes)
+            print('\tenergy:', energy)
+            print('\tcluster energy:', intra)
+            print('\tselected:', np.where(selected)[0])
             print()
 
-        ####################################
+        top = torch.from_numpy(top)
+        round_matrix = ((top[:, None] == top[None, :]) & (top[:, None] != -1)).float()
+        round_matrix[torch.arange(D), torch.arange(D)] = 1
+        self.round_matrix = round_matrix.to(device)
+        self.cluster_labels = torch.from_numpy(cluster_labels)
+        self.parents = torch.from_numpy(parents)
+        self.node_energies = torch.from_numpy(energy)
+        self.cluster_energies = torch.from_numpy(intra)
+        with torch.no_grad():
+            objective_matrix = weights * torch.triu(self.round_matrix, diagonal=1)
+            self.objective_value = (torch.tensor(energy[-1], device=device) -
+                                    torch.sum(objective_matrix[objective_matrix < 0])).item()  # MA
+        return self.round_matrix
+
+    def get_rounded_solutions(self, Xs, Ws, use_similarities=True):
+        """
+        Batched (inference-only) version of get_rounded_solution, as called by forward, for many blocks at once.
+        Xs and Ws are lists of the fractional solutions and (upper-triangular) weight matrices of the blocks.
+        Returns the cluster labels (as in cluster_labels) and the objective values of all blocks; the attributes of
+        the layer are not updated
+        """
+        cluster_labels, objective_values = [None] * len(Xs), [None] * len(Xs)
+        # Blocks are grouped by dtypes, so that every block is rounded in its own precision
+        groups = {}
+        for i, (X, W) in enumerate(zip(Xs, Ws)):
+            groups.setdefault((X.dtype, W.dtype != torch.float64), []).append(i)
+        for (_, weights_f32), idxs in groups.items():
+            Ys, max_dists, W_syms = [], [], []
+            for i in idxs:
+                Y, max_dist = _get_dissimilarities(Xs[i], use_similarities=use_similarities,
+                                                   max_similarity=torch.max(Xs[i]))
+                W = Ws[i].detach()
+                Ys.append(Y.reshape(-1))
+                max_dists.append(max_dist)
+                W_syms.append((W + W.T).cpu().numpy().astype(np.float64).reshape(-1))
+            sizes = np.array([Xs[i].size(1) for i in idxs], dtype=np.int64)
+            all_labels, _objective_values = _batch_build_and_cut(np.concatenate(Ys), np.concatenate(W_syms), sizes,
+                                                                 np.array(max_dists, dtype=np.float64), weights_f32)
+            for i, labels, objective_value in zip(idxs, np.split(all_labels, np.cumsum(sizes)[:-1]),
+                                                  _objective_values):
+                cluster_labels[i] = torch.from_numpy(labels)
+                objective_values[i] = float(objective_value)
+        return cluster_labels, objective_values
+
+    def get_rounded_solution_condensed(self, x, weights, N, use_similarities=True, fill_value=None, verbose=False):
+        """
+        Condensed-form version of get_rounded_solution, which never allocates NxN tensors: x and weights are the
+        N(N-1)/2 condensed vectors of the fractional solution and of the edge weights (see
+        _get_condensed_dissimilarities for fill_value). Returns the condensed 0-1 decision values; round_matrix is
+        not set
+        """
+        device = x.device
+        Yc, max_dist = _get_condensed_dissimilarities(x, use_similarities=use_similarities, fill_value=fill_value)
+        w = weights.detach()
+        parents, energy, intra, selected, merges = _build_and_cut_condensed(Yc, w.cpu().numpy().astype(np.float64),
+                                                                            N, max_dist, w.dtype != torch.float64)
+        top, cluster_labels = _get_cut_labels(parents, selected, N)
 
-        max_node = D - 1
         if verbose:
-            print('Starting algorithm:')
-        for i in range(D - 1):
-            max_node += 1
-            min_minima_idx = torch.argmin(values).item()
-
-            # Merge the index of the minimum value of minimums across rows with the index of the minimum value in its row
-            merge_idx_1 = min_minima_idx
-            merge_idx_2 = indices[merge_idx_1].item()
-
-            # Find highest-altitude clusters corresponding to the merge indices
-            parent_1 = idx_to_parent[parent_to_idx[idx_to_parent[merge_idx_1]]].item()
-            parent_2 = idx_to_parent[parent_to_idx[idx_to_parent[merge_idx_2]]].item()
-
-            if verbose:
-                print(f'    #{i} Merging:', (merge_idx_1, merge_idx_2), 'i.e.', (parent_1, parent_2), '=>', max_node)
-
-            # Add parent for the clusters being merged
-            parents[parent_1] = max_node
-            parents[parent_2] = max_node
-
-            # Update mappings
-            idx_to_parent[merge_idx_1] = max_node
-            parent_to_idx[max_node] = merge_idx_1
-
-            # Update the matrix with merged values for cluster similarities
-            max_dist_mask = Y == _MAX_DIST
-            new_cluster_size = cluster_sizes[parent_1] + cluster_sizes[parent_2]
-            cluster_sizes[max_node] = new_cluster_size
-            new_merge_idx_1_values = (torch.min(Y[merge_idx_1, :], Y[:, merge_idx_1]) * cluster_sizes[parent_1] + \
-                                      torch.min(Y[:, merge_idx_2], Y[merge_idx_2, :]) * cluster_sizes[parent_2]) / \
-                                     new_cluster_size
-            Y[:, merge_idx_1] = new_merge_idx_1_values
-            Y[merge_idx_1, :] = new_merge_idx_1_values
-            Y[max_dist_mask] = _MAX_DIST
-            Y[:, merge_idx_2] = _MAX_DIST
-            Y[merge_idx_2, :] = _MAX_DIST
-
-            # Update nearest neighbour trackers
-            values[merge_idx_2] = _MAX_DIST
-
-            max_dist_mask = values == _MAX_DIST
-            values, indices = torch.min(Y, dim=1)
-            values[max_dist_mask] = _MAX_DIST
-
-            # Energy calculations
-            clustering[max_node] = clustering[parent_1] + clustering[parent_2]
-            leaf_indices = torch.where(clustering[max_node])[0]
-            leaf_edges = torch.meshgrid(leaf_indices, leaf_indices, indexing='ij')
-            energy[max_node] = energy[parent_1] + energy[parent_2]
-            merge_energy = torch.sum(weights[leaf_edges])
-            if merge_energy >= energy[max_node]:
-                energy[max_node] = merge_energy
-                clustering[max_node][clustering[max_node] > 0] = max_node
-                round_matrix[leaf_edges] = 1
-            if verbose:
-                print('Y:', Y)
-                print('\tminima (values):', values)
-                print('\tminima (indices):', indices)
-                print('\tparents:', parents)
-                print('\tparent_to_idx:', parent_to_idx)
-                print('\tidx_to_parent:', idx_to_parent)
-                print('\tcluster_sizes:', cluster_sizes)
-                print('\tclustering (current):', clustering[max_node])
-                print('round_matrix:')
-                print(round_matrix)
-                print()
-
-        self.round_matrix = round_matrix
-        self.cluster_labels = clustering[-1]
-        self.parents = parents
+            print('Merges (row indices):', merges.tolist())
+            print('\tparents:', parents)
+            print('\tenergy:', energy)
+            print('\tcluster energy:', intra)
+            print('\tselected:', np.where(selected)[0])
+            print()
+
+        top = torch.from_numpy(top)
+        rows, cols = triu_indices(N)
+        round_condensed = ((top[rows] == top[cols]) & (top[rows] != -1)).float().to(device)
+        self.round_matrix = None
+        self.cluster_labels = torch.from_numpy(cluster_labels)
+        self.parents = torch.from_numpy(parents)
+        self.node_energies = torch.from_numpy(energy)
+        self.cluster_energies = torch.from_numpy(intra)
         with torch.no_grad():
-            objective_matrix = weights * torch.triu(round_matrix, diagonal=1)
-            self.objective_value = (energy[max_node] - torch.sum(objective_matrix[objective_matrix < 0])).item()  # MA
-        return self.round_matrix
+            objective_vector = weights * round_condensed
+            self.objective_value = (torch.tensor(energy[-1], device=device) -
+                                    torch.sum(objective_vector[objective_vector < 0])).item()  # MA
+        return round_condensed
+
+    def get_rounded_solutions_condensed(self, xs, ws, Ns, use_similarities=True, fill_value=None):
+        """
+        Batched (inference-only) version of get_rounded_solution_condensed, with the same outputs as
+        get_rounded_solutions
+        """
+        cluster_labels, objective_values = [None] * len(xs), [None] * len(xs)
+        groups = {}
+        for i, (x, w) in enumerate(zip(xs, ws)):
+            groups.setdefault((x.dtype, w.dtype != torch.float64), []).append(i)
+        for (_, weights_f32), idxs in groups.items():
+            Ycs, max_dists, Wcs = [], [], []
+            for i in idxs:
+                Yc, max_dist = _get_condensed_dissimilarities(xs[i], use_similarities=use_similarities,
+                                                              fill_value=fill_value)
+                Ycs.append(Yc)
+                max_dists.append(max_dist)
+                Wcs.append(ws[i].detach().cpu().numpy().astype(np.float64))
+            sizes = np.array([Ns[i] for i in idxs], dtype=np.int64)
+            all_labels, _objective_values = _batch_build_and_cut_condensed(
+                np.concatenate(Ycs), np.concatenate(Wcs), sizes, np.array(max_dists, dtype=Ycs[0].dtype), weights_f32)
+            for i, labels, objective_value in zip(idxs, np.split(all_labels, np.cumsum(sizes)[:-1]),
+                                                  _objective_values):
+                cluster_labels[i] = torch.from_numpy(labels)
+                objective_values[i] = float(objective_value)
+        return cluster_labels, objective_values
+
+    def forward_condensed(self, x, w, N, use_similarities=True, fill_value=None):
+        """
+        forward on condensed inputs (see get_rounded_solution_condensed); returns the condensed solution
+        """
+        return x + (self.get_rounded_solution_condensed(x, w, N, use_similarities=use_similarities,
+                                                        fill_value=fill_value) - x).detach()
 
     def forward(self, X, W, use_similarities=True, return_triu=False):
         solution = X + (self.get_rounded_solution(X, W,
                                                   use_similarities=use_similarities,
                                                   max_similarity=torch.max(X)) - X).detach()
         if return_triu:
-            triu_indices = torch.triu_indices(len(solution), len(solution), offset=1)
-            return solution[triu_indices[0], triu_indices[1]]
+            return compress(solution)
         return solution
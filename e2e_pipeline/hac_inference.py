@@ -9,6 +9,7 @@ import logging
 from IPython import embed
 
 from e2e_scripts.train_utils import compute_b3_f1
+from utils.condensed_matrix import triu_indices_np
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
@@ -88,7 +89,7 @@ class HACInference:
         _thresh = threshold if threshold is not None else self.cut_threshold
         _data = []
         _g = hg.UndirectedGraph(N)
-        r, c = np.triu_indices(N, k=1)
+        r, c = triu_indices_np(N)
         _dists = 1. - torch.sigmoid(edge_weights).cpu().numpy().reshape(N*(N-1)//2)
         _g.add_edges(r, c)
         _hac, _hac_alts = hg.binary_partition_tree_average_linkage(_g, _dists)
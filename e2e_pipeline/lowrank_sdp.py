@@ -0,0 +1,72 @@
+import math
+
+import torch
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_default_rank(N):
+    # Barvinok-Pataki: an optimal solution of rank k exists with k(k+1)/2 <= N (number of equality constraints)
+    return min(N, int(math.ceil(math.sqrt(2 * N))) + 1)
+
+
+def _project_rows(V):
+    """
+    Project each row of V onto the nonnegative part of the unit sphere, so that X = VV^T satisfies diag(X) = 1 and
+    X >= 0. Rows that are entirely clipped are reset to the basis vector of their largest entry.
+    """
+    V_pos = torch.relu(V)
+    norms = torch.linalg.norm(V_pos, dim=1, keepdim=True)
+    dead_rows = (norms.squeeze(1) == 0)
+    if torch.any(dead_rows):
+        fallback = torch.zeros_like(V_pos[dead_rows])
+        fallback[torch.arange(len(fallback)), torch.argmax(V[dead_rows], dim=1)] = 1.
+        V_pos = V_pos.clone()
+        V_pos[dead_rows] = fallback
+        norms = torch.linalg.norm(V_pos, dim=1, keepdim=True)
+    return V_pos / norms
+
+
+def _ascent_step(V, W_sym, step_size):
+    return _project_rows(V + step_size * (W_sym @ V))
+
+
+def solve_lowrank_sdp(W_val, N, rank=None, max_iters=5000, tol=1e-6, n_diff_steps=10, seed=17, verbose=False):
+    """
+    Burer-Monteiro solver for the max-agree SDP: max <W, X> s.t. diag(X) = 1, X >= 0, X PSD.
+    X is factorized as VV^T with V an Nxk nonnegative matrix with unit-norm rows, which keeps every iterate feasible.
+    The problem is solved by projected gradient ascent without tracking gradients; the last `n_diff_steps` ascent
+    steps are then replayed from the converged factor with autograd enabled, which gives a (truncated) differentiable
+    map from W_val to X.
+    W_val is an NxN upper-triangular (shift 1) matrix of edge weights
+    Returns a symmetric NxN matrix of fractional, decision values with a 1-diagonal, and the number of iterations run
+    """
+    rank = get_default_rank(N) if rank is None or rank < 1 else min(rank, N)
+    W_sym = W_val + W_val.T
+    with torch.no_grad():
+        # Conservative step size: the max absolute row sum bounds the spectral norm of the symmetric weight matrix
+        lipschitz = torch.max(torch.sum(torch.abs(W_sym), dim=1)).item()
+        step_size = 1. / lipschitz if lipschitz > 0 else 1.
+        generator = torch.Generator(device='cpu').manual_seed(seed)
+        V = _project_rows(torch.rand((N, rank), generator=generator, dtype=W_val.dtype).to(W_val.device))
+        W_fixed = W_sym.detach()
+        prev_obj = 0.5 * torch.sum(W_fixed * (V @ V.T)).item()
+        n_iters = 0
+        for n_iters in range(1, max_iters + 1):
+            V = _ascent_step(V, W_fixed, step_size)
+            obj = 0.5 * torch.sum(W_fixed * (V @ V.T)).item()
+            if abs(obj - prev_obj) <= tol * max(1., abs(prev_obj)):
+                break
+            prev_obj = obj
+        if verbose:
+            logger.info(f'Low-rank SDP: N={N}, rank={rank}, iterations={n_iters}, objective={obj}')
+
+    # Replay the final ascent steps with autograd enabled to get gradients w.r.t. W_val
+    if W_val.requires_grad:
+        for _ in range(n_diff_steps):
+            V = _ascent_step(V, W_sym, step_size)
+    X = V @ V.T
+    return X, n_iters
@@ -1,10 +1,14 @@
 import torch
 
 from e2e_pipeline.mlp_layer import MLPLayer
-from e2e_pipeline.sdp_layer import SDPLayer
+from e2e_pipeline.sdp_layer import SDPLayer, get_max_agree_objective
+from e2e_pipeline.reduction_layer import CCReductionLayer
+from e2e_pipeline.exact_cc import solve_exact_cc, MAX_EXACT_SIZE
+from e2e_pipeline.sdp_pool import solve_sdp_batch
 from e2e_pipeline.hac_cut_layer import HACCutLayer
 from e2e_pipeline.trellis_cut_layer import TrellisCutLayer
 from e2e_pipeline.uncompress_layer import UncompressTransformLayer
+from utils.condensed_matrix import compress
 import logging
 from IPython import embed
 
@@ -16,7 +20,10 @@ class EntResModel(torch.nn.Module):
     def __init__(self, n_features, neumiss_depth, dropout_p, dropout_only_once, add_neumiss,
                  neumiss_deq, hidden_dim, n_hidden_layers, add_batchnorm, add_layernorm, activation,
                  negative_slope, hidden_config, sdp_max_iters, sdp_eps, sdp_scale=False, use_rounded_loss=True,
-                 return_triu_on_train=False, use_sdp=True):
+                 return_triu_on_train=False, use_sdp=True, sdp_solver="scs", sdp_lowrank_rank=-1,
+                 sdp_report_gap=False, sdp_warm_start=False, sdp_warm_start_mem_mb=1024, sdp_warm_start_dir=None,
+                 sdp_reduce=False, sdp_reduce_tol=0., sdp_contraction_ratio=1., exact_max_size=0,
+                 batch_round_max_size=0, batch_round_size=256, rounding="hac", trellis_linkages=None):
         super().__init__()
         # Layers
         self.mlp_layer = MLPLayer(n_features=n_features, neumiss_depth=neumiss_depth, dropout_p=dropout_p,
@@ -25,14 +32,37 @@ class EntResModel(torch.nn.Module):
                                   add_layernorm=add_layernorm, activation=activation, negative_slope=negative_slope,
                                   hidden_config=hidden_config)
         self.uncompress_layer = UncompressTransformLayer()
-        self.sdp_layer = SDPLayer(max_iters=sdp_max_iters, eps=sdp_eps, scale_input=sdp_scale)
+        self.sdp_layer = SDPLayer(max_iters=sdp_max_iters, eps=sdp_eps, scale_input=sdp_scale, solver=sdp_solver,
+                                  lowrank_rank=sdp_lowrank_rank, report_gap=sdp_report_gap,
+                                  warm_start=sdp_warm_start, warm_start_mem_mb=sdp_warm_start_mem_mb,
+                                  warm_start_dir=sdp_warm_start_dir)
+        self.reduction_layer = CCReductionLayer(tol=sdp_reduce_tol, contraction_ratio=sdp_contraction_ratio)
+        if rounding not in ["hac", "trellis"]:
+            raise ValueError("Invalid value for rounding")
+        if exact_max_size > MAX_EXACT_SIZE:
+            raise ValueError(f"exact_max_size is limited to {MAX_EXACT_SIZE}")
         self.hac_cut_layer = HACCutLayer()
+        self.trellis_cut_layer = TrellisCutLayer(linkages=trellis_linkages)
         # Configs
+        self.rounding = rounding  # "hac": HAC-cut; "trellis": cut of the trellis of the trellis_linkages HAC trees
         self.use_rounded_loss = use_rounded_loss
         self.return_triu_on_train = return_triu_on_train
         self.use_sdp = use_sdp
+        self.sdp_reduce = sdp_reduce
+        self.exact_max_size = exact_max_size  # Blocks up to this size are solved exactly at inference
+        # At inference, blocks up to this size can be rounded in batches of batch_round_size (see forward_eval_batch)
+        self.batch_round_max_size = batch_round_max_size
+        self.batch_round_size = batch_round_size
+        # Results of the last inference call
+        self.cluster_labels = None
+        self.round_objective_value = None
+        self.frac_objective_value = None
 
-    def forward(self, x, N, warmstart=False, verbose=False):
+    @property
+    def cut_layer(self):
+        return self.trellis_cut_layer if self.rounding == "trellis" else self.hac_cut_layer
+
+    def forward(self, x, N, warmstart=False, verbose=False, block_id=None):
         edge_weights = torch.squeeze(self.mlp_layer(x))
         if verbose:
             logger.info(f"Size of W = {edge_weights.size()}")
@@ -40,23 +70,176 @@ class EntResModel(torch.nn.Module):
         if warmstart:
             return edge_weights
 
+        if self.use_condensed(N):
+            return self.forward_condensed(edge_weights.reshape(-1), N, verbose=verbose)
+
         edge_weights_uncompressed = self.uncompress_layer(edge_weights, N)
         if verbose:
             logger.info(f"Size of W_matrix = {edge_weights_uncompressed.size()}")
             logger.info(f"\n{edge_weights_uncompressed}")
 
-        output_probs = self.sdp_layer(edge_weights_uncompressed, N, use_sdp=self.use_sdp, return_triu=(
-                    self.training and not self.use_rounded_loss and self.return_triu_on_train))
+        if not self.training and N <= self.exact_max_size:
+            return self.solve_exact(edge_weights_uncompressed, N, verbose=verbose)
+
+        return_triu = self.training and not self.use_rounded_loss and self.return_triu_on_train
+        output_probs = self.solve_relaxation(edge_weights_uncompressed, N, return_triu=return_triu, verbose=verbose,
+                                             block_id=block_id)
+        return self.round_output(output_probs, edge_weights_uncompressed, verbose=verbose)
+
+    def use_condensed(self, N):
+        """
+        Without the SDP, the sigmoid relaxation and the HAC-cut rounding are run on the N(N-1)/2 condensed edge
+        weights, without any NxN tensors: at inference (for blocks that are not solved exactly; the rounded solution
+        is then returned in condensed form) and in training when the output is condensed anyway (return_triu_on_train)
+        """
+        if self.use_sdp or self.rounding != "hac":
+            return False
+        if self.training:
+            return self.return_triu_on_train
+        return N > self.exact_max_size
+
+    def forward_condensed(self, edge_weights, N, verbose=False):
+        W_val, output_probs = self.sdp_layer.forward_condensed(edge_weights, N, verbose=verbose)
+        if verbose:
+            logger.info(f"Size of X = {output_probs.size()}")
+            logger.info(f"\n{output_probs}")
+        if self.training and not self.use_rounded_loss:
+            return output_probs
+
+        # The entries of the dense sigmoid matrix outside of the strict upper triangle are sigmoid(0)
+        pred_clustering = self.hac_cut_layer.forward_condensed(output_probs, W_val, N, fill_value=0.5)
+        if verbose:
+            logger.info(f"Size of X_r = {pred_clustering.size()}")
+            logger.info(f"\n{pred_clustering}")
+        self.cluster_labels = self.hac_cut_layer.cluster_labels
+        self.round_objective_value = self.hac_cut_layer.objective_value
+        self.frac_objective_value = self.sdp_layer.objective_value
+        return pred_clustering
+
+    def solve_relaxation(self, edge_weights_uncompressed, N, return_triu=False, verbose=False, block_id=None):
+        if self.use_sdp and self.sdp_reduce:
+            return self.reduction_layer(edge_weights_uncompressed, N, self.sdp_layer, return_triu=return_triu,
+                                        verbose=verbose, block_id=block_id)
+        return self.sdp_layer(edge_weights_uncompressed, N, use_sdp=self.use_sdp, return_triu=return_triu,
+                              block_id=block_id)
+
+    def round_output(self, output_probs, edge_weights_uncompressed, verbose=False):
         if verbose:
             logger.info(f"Size of X = {output_probs.size()}")
             logger.info(f"\n{output_probs}")
         if self.training and not self.use_rounded_loss:
             return output_probs
 
-        pred_clustering = self.hac_cut_layer(output_probs, edge_weights_uncompressed,
-                                             return_triu=(self.training and self.return_triu_on_train))
+        pred_clustering = self.cut_layer(output_probs, edge_weights_uncompressed,
+                                         return_triu=(self.training and self.return_triu_on_train))
         if verbose:
             logger.info(f"Size of X_r = {pred_clustering.size()}")
             logger.info(f"\n{pred_clustering}")
+        self.cluster_labels = self.cut_layer.cluster_labels
+        self.round_objective_value = self.cut_layer.objective_value
+        self.frac_objective_value = self.sdp_layer.objective_value
+
+        return pred_clustering
 
+    def solve_exact(self, edge_weights_uncompressed, N, verbose=False):
+        # Same scaling as in the SDP route, so that objective values are comparable across blocks
+        W_val = self.sdp_layer.scaled(edge_weights_uncompressed)
+        self.cluster_labels, pred_clustering, self.round_objective_value = solve_exact_cc(W_val, N)
+        self.frac_objective_value = self.round_objective_value  # No relaxation
+        self.sdp_layer.scs_objective_value, self.sdp_layer.objective_gap = None, None
+        if verbose:
+            logger.info(f"Exact solution: objective={self.round_objective_value}")
+            logger.info(f"\n{pred_clustering}")
         return pred_clustering
+
+    def forward_batch(self, xs, Ns, sdp_pool, verbose=False, block_ids=None):
+        """
+        Forward pass over a group of blocks, with all of their SDPs solved in one parallel call on sdp_pool (an
+        SDPWorkerPool). Returns the list of per-block outputs of forward()
+        """
+        if not self.use_sdp or self.sdp_layer.solver != "scs":
+            raise ValueError("Batched forward passes require use_sdp with the scs solver")
+        block_ids = block_ids if block_ids is not None else [None] * len(xs)
+        Ws, reductions, sdp_Ws, sdp_block_ids = [], [], [], []
+        for x, N, block_id in zip(xs, Ns, block_ids):
+            edge_weights = torch.squeeze(self.mlp_layer(x))
+            W_val = self.sdp_layer.scale(self.uncompress_layer(edge_weights, N))
+            reduction, sub_Ws = self.reduction_layer.reduce(W_val, N) if self.sdp_reduce else (None, None)
+            if reduction is None or (len(reduction) == 1 and reduction[0][2] == N):
+                # Nothing to reduce
+                reduction, sub_Ws = None, [W_val]
+                sdp_Ws.append(W_val)
+                sdp_block_ids.append(block_id)
+            else:
+                for i, sub_W in enumerate(sub_Ws):
+                    if sub_W is None:
+                        continue
+                    sdp_Ws.append(self.sdp_layer.scale(sub_W))
+                    sdp_block_ids.append(f'{block_id}:{i}' if block_id is not None else None)
+            Ws.append(W_val)
+            reductions.append((reduction, sub_Ws))
+
+        sdp_solutions = iter(solve_sdp_batch(self.sdp_layer, sdp_Ws, sdp_block_ids, sdp_pool, verbose=verbose))
+        return_triu = self.training and not self.use_rounded_loss and self.return_triu_on_train
+        outputs = []
+        for W_val, N, (reduction, sub_Ws) in zip(Ws, Ns, reductions):
+            sub_prob_matrices = [next(sdp_solutions) if sub_W is not None else None for sub_W in sub_Ws]
+            if reduction is None:
+                output_probs = sub_prob_matrices[0]
+            else:
+                output_probs = self.reduction_layer.expand(reduction, sub_prob_matrices, N, W_val.dtype,
+                                                           W_val.device)
+            # Objective of this block's solution, for round_output (the pooled solves do not set it on sdp_layer)
+            self.sdp_layer.objective_value = get_max_agree_objective(W_val, output_probs, verbose=verbose)
+            self.sdp_layer.scs_objective_value, self.sdp_layer.objective_gap = None, None
+            if return_triu:
+                output_probs = compress(output_probs)
+            outputs.append(self.round_output(output_probs, W_val, verbose=verbose))
+        return outputs
+
+    def forward_eval_batch(self, xs, Ns, verbose=False, block_ids=None):
+        """
+        Inference over a group of blocks: the relaxations are solved block by block, and the rounding of all of them
+        is done in one batched call. Returns one dict per block with its cluster labels and objective values
+        """
+        block_ids = block_ids if block_ids is not None else [None] * len(xs)
+        results, Xs, Ws, round_idxs = [], [], [], []
+        round_Ns = []
+        for x, N, block_id in zip(xs, Ns, block_ids):
+            edge_weights = torch.squeeze(self.mlp_layer(x))
+            if self.use_condensed(N):
+                W_val, output_probs = self.sdp_layer.forward_condensed(edge_weights.reshape(-1), N, verbose=verbose)
+                Xs.append(output_probs)
+                Ws.append(W_val)
+                round_Ns.append(N)
+                round_idxs.append(len(results))
+                results.append({'cluster_labels': None,
+                                'round_objective_value': None,
+                                'sdp_objective_value': self.sdp_layer.objective_value,
+                                'sdp_objective_gap': None})
+                continue
+            edge_weights_uncompressed = self.uncompress_layer(edge_weights, N)
+            if N <= self.exact_max_size:
+                self.solve_exact(edge_weights_uncompressed, N, verbose=verbose)
+                results.append({'cluster_labels': self.cluster_labels,
+                                'round_objective_value': self.round_objective_value,
+                                'sdp_objective_value': self.frac_objective_value,
+                                'sdp_objective_gap': None})
+                continue
+            Xs.append(self.solve_relaxation(edge_weights_uncompressed, N, verbose=verbose, block_id=block_id))
+            Ws.append(edge_weights_uncompressed)
+            round_idxs.append(len(results))
+            results.append({'cluster_labels': None,
+                            'round_objective_value': None,
+                            'sdp_objective_value': self.sdp_layer.objective_value,
+                            'sdp_objective_gap': self.sdp_layer.objective_gap})
+        if round_Ns:
+            # use_condensed holds for all the non-exact blocks
+            cluster_labels, objective_values = self.hac_cut_layer.get_rounded_solutions_condensed(Xs, Ws, round_Ns,
+                                                                                                  fill_value=0.5)
+        else:
+            cluster_labels, objective_values = self.cut_layer.get_rounded_solutions(Xs, Ws)
+        for i, labels, objective_value in zip(round_idxs, cluster_labels, objective_values):
+            results[i]['cluster_labels'] = labels
+            results[i]['round_objective_value'] = objective_value
+        return results
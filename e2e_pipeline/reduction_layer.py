@@ -0,0 +1,128 @@
+import torch
+import numpy as np
+import logging
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from IPython import embed
+
+from e2e_pipeline.sdp_layer import get_max_agree_objective
+from utils.condensed_matrix import compress, triu_indices_np
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CCReductionLayer(torch.nn.Module):
+    """
+    Pre-solver for the correlation clustering SDP. The weight graph is split into the connected components of its
+    positive edges (|w| > tol); the SDP decomposes exactly over these, since cross-component entries of X can be set
+    to 0. Within each component, nodes joined by overwhelmingly positive edges are contracted into super-nodes with
+    summed weights. The reduced SDPs are solved with the given SDPLayer and expanded back into an NxN matrix.
+    """
+
+    def __init__(self, tol=0., contraction_ratio=1.):
+        super().__init__()
+        self.tol = tol
+        # An edge (u, v) is contracted if w_uv >= contraction_ratio * (sum of |w| of the other edges of u or v).
+        # With a ratio of 1, moving u into the cluster of v can never decrease the (integral) max-agree objective.
+        self.contraction_ratio = contraction_ratio
+        self.reduced_sizes = None  # Stores the sizes of the reduced problems of the last run
+
+    def get_reduction(self, W_val, N):
+        """
+        W_val is an NxN upper-triangular (shift 1) matrix of edge weights
+        Returns a list of (node indices, super-node label of each node, number of super-nodes), one per component
+        """
+        W = W_val.detach().cpu().numpy()
+        rows, cols = triu_indices_np(N)
+        weights = W[rows, cols]
+        positive = weights > self.tol
+        n_components, component_labels = connected_components(
+            coo_matrix((np.ones(np.sum(positive)), (rows[positive], cols[positive])), shape=(N, N)), directed=False)
+
+        abs_W = np.abs(W + W.T)
+        degrees = np.sum(abs_W, axis=1)
+        rest = np.minimum(degrees[rows] - weights, degrees[cols] - weights)
+        contract = positive & (weights >= self.contraction_ratio * rest)
+        _, group_labels = connected_components(
+            coo_matrix((np.ones(np.sum(contract)), (rows[contract], cols[contract])), shape=(N, N)), directed=False)
+
+        reduction = []
+        for c in range(n_components):
+            node_idxs = np.where(component_labels == c)[0]
+            _, super_node_labels = np.unique(group_labels[node_idxs], return_inverse=True)
+            reduction.append((node_idxs, super_node_labels, int(np.max(super_node_labels)) + 1))
+        return reduction
+
+    def reduce(self, W_val, N):
+        """
+        W_val is an NxN upper-triangular (shift 1) matrix of edge weights
+        Returns the reduction (see get_reduction) and, per component, the upper-triangular matrix of summed
+        super-node weights (None for components that collapse into a single super-node)
+        """
+        reduction = self.get_reduction(W_val, N)
+        W_sym = W_val + W_val.T
+        sub_Ws = []
+        for node_idxs, super_node_labels, n_super_nodes in reduction:
+            if n_super_nodes == 1:
+                sub_Ws.append(None)
+                continue
+            # Sum the weights between the nodes of each pair of super-nodes
+            node_idxs_t = torch.tensor(node_idxs, device=W_val.device)
+            assignment = torch.zeros((len(node_idxs), n_super_nodes), dtype=W_val.dtype, device=W_val.device)
+            assignment[torch.arange(len(node_idxs)), torch.tensor(super_node_labels, device=W_val.device)] = 1.
+            sub_W = assignment.T @ W_sym[node_idxs_t][:, node_idxs_t] @ assignment
+            sub_Ws.append(torch.triu(sub_W, diagonal=1))
+        return reduction, sub_Ws
+
+    @staticmethod
+    def expand(reduction, sub_prob_matrices, N, dtype, device):
+        """
+        Expands the super-node solutions of every component (None for single super-nodes) back into an NxN matrix
+        """
+        pw_prob_matrix = torch.zeros((N, N), dtype=dtype, device=device)
+        for (node_idxs, super_node_labels, _), sub_prob_matrix in zip(reduction, sub_prob_matrices):
+            node_idxs_t = torch.tensor(node_idxs, device=device)
+            super_node_labels_t = torch.tensor(super_node_labels, device=device)
+            if sub_prob_matrix is None:
+                sub_prob_matrix = torch.ones((1, 1), dtype=dtype, device=device)
+            pw_prob_matrix[node_idxs_t[:, None], node_idxs_t[None, :]] = \
+                sub_prob_matrix[super_node_labels_t][:, super_node_labels_t].type(dtype)
+        return pw_prob_matrix
+
+    def forward(self, edge_weights_uncompressed, N, sdp_layer, return_triu=False, verbose=False, block_id=None):
+        # Scale the full matrix (as SDPLayer would), so that downstream layers see the same weights
+        W_val = sdp_layer.scale(edge_weights_uncompressed)
+
+        reduction, sub_Ws = self.reduce(W_val, N)
+        self.reduced_sizes = [n for _, _, n in reduction]
+        if verbose:
+            logger.info(f"Reduced problem of size {N} to {len(reduction)} components of sizes {self.reduced_sizes}")
+        if len(reduction) == 1 and reduction[0][2] == N:
+            # Nothing to reduce
+            return sdp_layer(W_val, N, use_sdp=True, return_triu=return_triu, verbose=verbose, block_id=block_id)
+
+        sub_prob_matrices, sub_objective_values, sub_scs_objective_values = [], [], []
+        for i, ((_, _, n_super_nodes), sub_W) in enumerate(zip(reduction, sub_Ws)):
+            if sub_W is None:
+                sub_prob_matrices.append(None)
+                continue
+            sub_prob_matrices.append(sdp_layer(sub_W, n_super_nodes, use_sdp=True, verbose=verbose,
+                                               block_id=f'{block_id}:{i}' if block_id is not None else None))
+            sub_objective_values.append(sdp_layer.objective_value)
+            sub_scs_objective_values.append(sdp_layer.scs_objective_value)
+        pw_prob_matrix = self.expand(reduction, sub_prob_matrices, N, W_val.dtype, W_val.device)
+
+        # Objective of the expanded solution on the full problem
+        sdp_layer.objective_value = get_max_agree_objective(W_val, pw_prob_matrix, verbose=verbose)
+        if len(sub_scs_objective_values) > 0 and all(v is not None for v in sub_scs_objective_values):
+            sdp_layer.scs_objective_value = sum(sub_scs_objective_values)
+            sdp_layer.objective_gap = (sdp_layer.scs_objective_value - sum(sub_objective_values)) / max(
+                abs(sdp_layer.scs_objective_value), 1e-8)
+        else:
+            sdp_layer.scs_objective_value, sdp_layer.objective_gap = None, None
+
+        if return_triu:
+            return compress(pw_prob_matrix)
+        return pw_prob_matrix
@@ -1,12 +1,20 @@
+import os
 import math
+import hashlib
+from collections import OrderedDict
 
 import torch
 import numpy as np
 import logging
 import cvxpy as cp
 from cvxpylayers.torch import CvxpyLayer
+from diffcp.cone_program import solve_internal, solve_and_derivative_internal
 from IPython import embed
 
+from utils.condensed_matrix import compress
+
+from e2e_pipeline.lowrank_sdp import solve_lowrank_sdp
+
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,6 +25,253 @@ class CvxpyException(Exception):
         self.data = data
 
 
+class SDPProblem:
+    """
+    Compiled, parameterized max-agree SDP for a fixed block size N.
+    The cvxpy problem is DPP-compliant in W, so repeated solves skip canonicalization; the CvxpyLayer used in
+    training is built lazily on first use.
+    """
+
+    def __init__(self, N):
+        self.N = N
+        self.X = cp.Variable((N, N), PSD=True)
+        self.W = cp.Parameter((N, N))
+        # build out constraint set
+        constraints = [
+            cp.diag(self.X) == np.ones((N,)),
+            self.X[:N, :] >= 0,
+        ]
+        # Note: maximizing the trace is equivalent to maximizing the sum_E (w_uv * X_uv) objective
+        # because W is upper-triangular and X is symmetric
+        self.prob = cp.Problem(cp.Maximize(cp.trace(self.W @ self.X)), constraints)
+        self._layer = None
+
+    @property
+    def layer(self):
+        if self._layer is None:
+            self._layer = CvxpyLayer(self.prob, parameters=[self.W], variables=[self.X])
+        return self._layer
+
+    def solve_cone_program(self, W_np, solver_args, warm_start=None, differentiate=False):
+        """
+        Solve the compiled cone program of the layer directly with SCS (optionally from a warm start (x, y, s)).
+        Returns the solution X as a numpy array, and the raw solver result (with x, y, s, info and, if
+        `differentiate` is set, the adjoint derivative DT)
+        Raises ValueError if SCS reports the problem as infeasible or unbounded (cvxpy returns an infinite value)
+        """
+        compiler = self.layer.compiler
+        c, _, neg_A, b = compiler.apply_parameters({self.W.id: W_np}, keep_zeros=True)
+        A = -neg_A  # cvxpy canonicalizes -A
+        solve_fn = solve_and_derivative_internal if differentiate else solve_internal
+        result = solve_fn(A, b, c, self.layer.cone_dims, warm_start=warm_start, **dict(solver_args))
+        result['shape'] = A.shape
+        if result['info']['status'].lower().startswith(('infeasible', 'unbounded')) \
+                or not np.isfinite(result['info'].get('pobj', 0.)):
+            raise ValueError()
+        X = compiler.split_solution(result['x'], active_vars={self.X.id})[self.X.id]
+        return X, result
+
+
+class _WarmStartSDPFn(torch.autograd.Function):
+    """
+    Differentiable SDP solve (same derivative as the cvxpylayer) that reads and updates the warm-start store.
+    """
+
+    @staticmethod
+    def forward(ctx, W_val, sdp, solver_args, store, block_id, verbose):
+        X, result = sdp.solve_cone_program(W_val.detach().cpu().double().numpy(), solver_args,
+                                           warm_start=store.get(block_id, sdp.N), differentiate=True)
+        store.put(block_id, sdp.N, result, verbose=verbose)
+        ctx.sdp, ctx.DT, ctx.shape = sdp, result['DT'], result['shape']
+        return torch.from_numpy(X).type(W_val.dtype).to(W_val.device)
+
+    @staticmethod
+    def backward(ctx, dX):
+        compiler = ctx.sdp.layer.compiler
+        dx = compiler.split_adjoint({ctx.sdp.X.id: dX.cpu().detach().double().numpy()})
+        dA, db, dc = ctx.DT(dx, np.zeros(ctx.shape[0]), np.zeros(ctx.shape[0]))
+        dW = compiler.apply_param_jac(dc, -dA, db)[ctx.sdp.W.id]
+        return torch.from_numpy(dW).type(dX.dtype).to(dX.device), None, None, None, None, None
+
+
+class SDPProblemCache:
+    """
+    Bounded LRU cache of compiled SDP problems (and their cvxpylayers), keyed by block size and solve method.
+    A single instance is shared by every SDPLayer in the process, so training and eval reuse the same entries.
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def get(self, N, solve_method="SCS"):
+        key = (N, solve_method)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.misses += 1
+        problem = SDPProblem(N)
+        self._cache[key] = problem
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return problem
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_lookups if n_lookups > 0 else 0.
+        }
+
+    def __len__(self):
+        return len(self._cache)
+
+
+SDP_PROBLEM_CACHE = SDPProblemCache()
+
+
+class SDPWarmStartStore:
+    """
+    LRU store of the last SCS iterates (x, y, s) per block, used to warm-start the next solve of the same block.
+    Entries beyond the memory budget are spilled to `spill_dir` (one .npz file per block) if set, or dropped.
+    The spill directory also lets warm starts outlive the (spawned) eval processes: see flush().
+    """
+
+    def __init__(self, max_memory_mb=1024, spill_dir=None):
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        self.spill_dir = spill_dir
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self._entries = OrderedDict()  # block_id -> {'N', 'x', 'y', 's', 'cold_iters'}
+        self._n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.n_solves = 0
+        self.n_iters = 0
+        self.n_iters_saved = 0
+
+    @staticmethod
+    def _entry_bytes(entry):
+        return entry['x'].nbytes + entry['y'].nbytes + entry['s'].nbytes
+
+    def _path(self, block_id):
+        return os.path.join(self.spill_dir, f'{hashlib.md5(str(block_id).encode()).hexdigest()}.npz')
+
+    def _spill(self, block_id, entry):
+        if self.spill_dir is None:
+            return
+        # Write to a temporary file first, since other processes may be reading from the same directory
+        path = self._path(block_id)
+        tmp_path = f'{path[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **entry)
+        os.replace(tmp_path, path)
+
+    def _load(self, block_id):
+        if self.spill_dir is None or not os.path.exists(self._path(block_id)):
+            return None
+        try:
+            with np.load(self._path(block_id)) as f:
+                return {k: (f[k] if f[k].ndim > 0 else f[k].item()) for k in f.files}
+        except (OSError, ValueError):
+            return None
+
+    def _insert(self, block_id, entry):
+        if block_id in self._entries:
+            self._n_bytes -= self._entry_bytes(self._entries.pop(block_id))
+        self._entries[block_id] = entry
+        self._n_bytes += self._entry_bytes(entry)
+        while self._n_bytes > self.max_bytes and len(self._entries) > 0:
+            _block_id, _entry = self._entries.popitem(last=False)
+            self._n_bytes -= self._entry_bytes(_entry)
+            self._spill(_block_id, _entry)
+
+    def _lookup(self, block_id):
+        if block_id in self._entries:
+            self._entries.move_to_end(block_id)
+            return self._entries[block_id]
+        entry = self._load(block_id)
+        if entry is not None:
+            self._insert(block_id, entry)
+        return entry
+
+    def get(self, block_id, N):
+        """
+        Returns the stored (x, y, s) for the block, or None if there is none for a problem of size N
+        """
+        entry = self._lookup(block_id) if block_id is not None else None
+        if entry is None or entry['N'] != N:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['x'], entry['y'], entry['s']
+
+    def put(self, block_id, N, result, verbose=False):
+        """
+        Stores the iterates of an SCS `result` for the block and records the iterations it took
+        """
+        n_iters = result['info']['iter']
+        self.n_solves += 1
+        self.n_iters += n_iters
+        if block_id is None:
+            return
+        entry = self._lookup(block_id)
+        # Iterations of the first (cold) solve of the block are the reference for the iterations saved
+        cold_iters = n_iters if entry is None or entry['N'] != N else entry['cold_iters']
+        if cold_iters != n_iters:
+            self.n_iters_saved += cold_iters - n_iters
+            if verbose:
+                logger.info(f'SDP warm start ({block_id}): {n_iters} iterations, {cold_iters - n_iters} saved')
+        self._insert(block_id, {'N': N, 'x': result['x'], 'y': result['y'], 's': result['s'],
+                                'cold_iters': cold_iters})
+
+    def flush(self):
+        """
+        Writes all in-memory entries to the spill directory (no-op without one)
+        """
+        for block_id, entry in self._entries.items():
+            self._spill(block_id, entry)
+
+    def clear(self):
+        self._entries.clear()
+        self._n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.n_solves = 0
+        self.n_iters = 0
+        self.n_iters_saved = 0
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'memory_mb': self._n_bytes / (1024 * 1024),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_lookups if n_lookups > 0 else 0.,
+            'mean_iters': self.n_iters / self.n_solves if self.n_solves > 0 else 0.,
+            'iters_saved': self.n_iters_saved
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
 def get_max_agree_objective(weights, probs, verbose=False):
     with torch.no_grad():
         objective_matrix = weights * torch.triu(probs, diagonal=1)
@@ -27,48 +282,75 @@ def get_max_agree_objective(weights, probs, verbose=False):
         return objective_value_MA
 
 
+def get_max_agree_objective_condensed(weights, probs, verbose=False):
+    """
+    get_max_agree_objective on the N(N-1)/2 condensed vectors of the edge weights and of the pairwise probabilities
+    """
+    with torch.no_grad():
+        objective_vector = weights * probs
+        objective_value_IC = torch.sum(objective_vector).item()
+        objective_value_MA = objective_value_IC - torch.sum(objective_vector[objective_vector < 0]).item()
+        if verbose:
+            logger.info(f'SDP objective: intra-cluster={objective_value_IC}, max-agree={objective_value_MA}')
+        return objective_value_MA
+
+
 class SDPLayer(torch.nn.Module):
-    def __init__(self, max_iters: int = 50000, eps: float = 1e-3, scale_input=False):
+    def __init__(self, max_iters: int = 50000, eps: float = 1e-3, scale_input=False, solver="scs", lowrank_rank=-1,
+                 report_gap=False, warm_start=False, warm_start_mem_mb=1024, warm_start_dir=None):
         super().__init__()
+        if solver not in ["scs", "lowrank"]:
+            raise ValueError("Invalid value for solver")
         self.max_iters = max_iters
         self.eps = eps
         self.scale_input = scale_input
+        self.solver = solver  # "scs": cvxpy/cvxpylayers with SCS; "lowrank": Burer-Monteiro factorization in torch
+        self.lowrank_rank = lowrank_rank  # Rank of the low-rank factorization; auto-selected if < 1
+        self.report_gap = report_gap  # In eval, also solve with SCS and record the gap to the low-rank objective
         self.objective_value = None  # Stores the last run objective value
+        self.scs_objective_value = None  # Stores the last SCS objective value (low-rank solver with report_gap only)
+        self.objective_gap = None  # Stores the last relative gap between the SCS and the low-rank objective
+        self.cache = SDP_PROBLEM_CACHE  # Compiled problems shared across all SDPLayer instances in the process
+        # Per-block SCS warm starts (only used by the SCS solver, for calls that pass a block_id)
+        self.warm_start_store = SDPWarmStartStore(max_memory_mb=warm_start_mem_mb,
+                                                  spill_dir=warm_start_dir) if warm_start else None
 
-    def build_and_solve_sdp(self, W_val, N, verbose=False):
+    def build_and_solve_sdp(self, W_val, N, verbose=False, block_id=None):
         """
         W_val is an NxN upper-triangular (shift 1) matrix of edge weights
+        block_id (optional) identifies the block across calls, to warm-start SCS from its previous solution
         Returns a symmetric NxN matrix of fractional, decision values with a 1-diagonal
         """
-        # Initialize the cvxpy layer
-        X = cp.Variable((N, N), PSD=True)
-        W = cp.Parameter((N, N))
-
-        # build out constraint set
-        constraints = [
-            cp.diag(X) == np.ones((N,)),
-            X[:N, :] >= 0,
-        ]
+        # Fetch the compiled problem for this block size
+        sdp = self.cache.get(N)
 
         try:
-            if self.training:
-                # create problem
-                prob = cp.Problem(cp.Maximize(cp.trace(W @ X)), constraints)
-                # Note: maximizing the trace is equivalent to maximizing the sum_E (w_uv * X_uv) objective
-                # because W is upper-triangular and X is symmetric
-                # Build the SDP cvxpylayer
-                cvxpy_layer = CvxpyLayer(prob, parameters=[W], variables=[X])
+            if self.warm_start_store is not None and block_id is not None:
+                solver_args = {
+                    "solve_method": "SCS",
+                    "verbose": verbose,
+                    "max_iters": self.max_iters,
+                    "eps": self.eps
+                }
+                if self.training:
+                    pw_prob_matrix = _WarmStartSDPFn.apply(W_val, sdp, solver_args, self.warm_start_store,
+                                                           block_id, verbose)
+                else:
+                    X, result = sdp.solve_cone_program(W_val.detach().cpu().double().numpy(), solver_args,
+                                                       warm_start=self.warm_start_store.get(block_id, N))
+                    self.warm_start_store.put(block_id, N, result, verbose=verbose)
+                    pw_prob_matrix = torch.tensor(X, device=W_val.device)
+            elif self.training:
                 # Forward pass through the SDP cvxpylayer
-                pw_prob_matrix = cvxpy_layer(W_val, solver_args={
+                pw_prob_matrix = sdp.layer(W_val, solver_args={
                     "solve_method": "SCS",
                     "verbose": verbose,
                     "max_iters": self.max_iters,
                     "eps": self.eps
                 })[0]
             else:
-                # create problem
-                prob = cp.Problem(cp.Maximize(cp.trace(W_val.cpu().numpy() @ X)), constraints)
-                _solve_val = prob.solve(
+                sdp.W.value = W_val.detach().cpu().numpy()
+                _solve_val = sdp.prob.solve(
                     solver=cp.SCS,
                     verbose=verbose,
                     max_iters=self.max_iters,
@@ -76,7 +358,7 @@ class SDPLayer(torch.nn.Module):
                 )
                 if _solve_val == float('inf'):
                     raise ValueError()
-                pw_prob_matrix = torch.tensor(X.value, device=W_val.device)
+                pw_prob_matrix = torch.tensor(sdp.X.value, device=W_val.device)
             # Fix to prevent invalid solution values close to 0 and 1 but outside the range
             pw_prob_matrix = torch.clamp(pw_prob_matrix, min=0, max=1)
         except:
@@ -93,24 +375,82 @@ class SDPLayer(torch.nn.Module):
         objective_value_MA = get_max_agree_objective(W_val, pw_prob_matrix, verbose=verbose)
         return objective_value_MA, pw_prob_matrix
 
+    def build_and_solve_lowrank_sdp(self, W_val, N, verbose=False):
+        """
+        W_val is an NxN upper-triangular (shift 1) matrix of edge weights
+        Returns a symmetric NxN matrix of fractional, decision values with a 1-diagonal
+        """
+        pw_prob_matrix, _ = solve_lowrank_sdp(W_val, N, rank=self.lowrank_rank, max_iters=self.max_iters,
+                                              verbose=verbose)
+        pw_prob_matrix = torch.clamp(pw_prob_matrix, min=0, max=1)
+        objective_value_MA = get_max_agree_objective(W_val, pw_prob_matrix, verbose=verbose)
+        if self.report_gap and not self.training:
+            self.scs_objective_value, _ = self.build_and_solve_sdp(W_val, N)
+            self.objective_gap = (self.scs_objective_value - objective_value_MA) / max(abs(self.scs_objective_value),
+                                                                                      1e-8)
+            if verbose:
+                logger.info(f'Low-rank SDP objective gap (relative to SCS): {self.objective_gap}')
+        return objective_value_MA, pw_prob_matrix
+
+    def flush_warm_starts(self):
+        if self.warm_start_store is not None:
+            self.warm_start_store.flush()
+
     def get_sigmoid_matrix(self, W_val, N, verbose=False):
         pw_prob_matrix = torch.sigmoid(W_val)
         objective_value_MA = get_max_agree_objective(W_val, pw_prob_matrix, verbose=verbose)
         return objective_value_MA, pw_prob_matrix
 
-    def forward(self, edge_weights_uncompressed, N, use_sdp=True, return_triu=False, verbose=False):
-        W_val = edge_weights_uncompressed
-        if self.scale_input:
-            with torch.no_grad():
-                scale_factor = torch.max(torch.abs(W_val))
-            if verbose:
-                logger.info(f"Scaling W_val by {scale_factor}")
+    def forward_condensed(self, edge_weights, N, verbose=False):
+        """
+        Sigmoid relaxation (use_sdp=False) on the N(N-1)/2 condensed vector of edge weights, without any NxN tensors.
+        Returns the edge weights (scaled, if scale_input) and the condensed pairwise probabilities
+        """
+        W_val = self.scaled(edge_weights, verbose=verbose)
+
+        self.scs_objective_value, self.objective_gap = None, None
+        pw_probs = torch.sigmoid(W_val)
+        self.objective_value = get_max_agree_objective_condensed(W_val, pw_probs, verbose=verbose)
+        return W_val, pw_probs
+
+    def get_scale_factor(self, W_val, verbose=False):
+        """
+        The max absolute weight of W_val if scale_input is set and it is non-zero, else None (nothing to scale)
+        """
+        if not self.scale_input or W_val.numel() == 0:
+            return None
+        with torch.no_grad():
+            scale_factor = torch.max(torch.abs(W_val))
+        if verbose:
+            logger.info(f"Scaling W_val by {scale_factor}")
+        return scale_factor if scale_factor > 0 else None
+
+    def scale(self, W_val, verbose=False):
+        """
+        If scale_input is set, scales W_val in place by its max absolute weight (all-zero blocks are left as is)
+        """
+        scale_factor = self.get_scale_factor(W_val, verbose=verbose)
+        if scale_factor is not None:
             W_val /= scale_factor
+        return W_val
+
+    def scaled(self, W_val, verbose=False):
+        """
+        Same as scale, but returns a new tensor instead of scaling W_val in place
+        """
+        scale_factor = self.get_scale_factor(W_val, verbose=verbose)
+        return W_val / scale_factor if scale_factor is not None else W_val
+
+    def forward(self, edge_weights_uncompressed, N, use_sdp=True, return_triu=False, verbose=False, block_id=None):
+        W_val = self.scale(edge_weights_uncompressed, verbose=verbose)
 
-        solver = self.build_and_solve_sdp if use_sdp else self.get_sigmoid_matrix
-        self.objective_value, pw_prob_matrix = solver(W_val, N, verbose)
+        self.scs_objective_value, self.objective_gap = None, None
+        if use_sdp and self.solver == "scs":
+            self.objective_value, pw_prob_matrix = self.build_and_solve_sdp(W_val, N, verbose, block_id=block_id)
+        else:
+            solver = self.build_and_solve_lowrank_sdp if use_sdp else self.get_sigmoid_matrix
+            self.objective_value, pw_prob_matrix = solver(W_val, N, verbose)
 
         if return_triu:
-            triu_indices = torch.triu_indices(len(pw_prob_matrix), len(pw_prob_matrix), offset=1)
-            return pw_prob_matrix[triu_indices[0], triu_indices[1]]
+            return compress(pw_prob_matrix)
         return pw_prob_matrix
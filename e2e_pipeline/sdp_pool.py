@@ -0,0 +1,180 @@
+import queue
+import torch
+import numpy as np
+import logging
+from torch.multiprocessing import get_context
+from IPython import embed
+
+from e2e_pipeline.sdp_layer import SDP_PROBLEM_CACHE, CvxpyException
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 10.  # Seconds between checks that the workers are alive while waiting for results
+
+
+def _worker_loop(task_queue, result_queue, cache_size=None):
+    """
+    Worker process: solves SDPs and keeps their derivatives (for the current generation only) until the backward
+    pass asks for the vector-Jacobian products
+    """
+    if cache_size is not None:
+        # Spawned workers start with a fresh module-level cache
+        SDP_PROBLEM_CACHE.resize(cache_size)
+    state = {}  # task_idx -> (compiled problem, adjoint derivative, shape of A)
+    generation = None
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        method, _generation, task_idx, payload = task
+        if _generation != generation:
+            # A new forward pass has started; the derivatives of earlier ones are no longer needed
+            state.clear()
+            generation = _generation
+        try:
+            if method == 'solve':
+                N, W_np, solver_args, warm_start = payload
+                sdp = SDP_PROBLEM_CACHE.get(N)
+                X, result = sdp.solve_cone_program(W_np, solver_args, warm_start=warm_start, differentiate=True)
+                state[task_idx] = (sdp, result['DT'], result['shape'])
+                result_queue.put((_generation, task_idx, None,
+                                  (X, {'x': result['x'], 'y': result['y'], 's': result['s'],
+                                       'info': {'iter': result['info']['iter']}})))
+            elif method == 'backward':
+                sdp, DT, shape = state.pop(task_idx)
+                compiler = sdp.layer.compiler
+                dx = compiler.split_adjoint({sdp.X.id: payload})
+                dA, db, dc = DT(dx, np.zeros(shape[0]), np.zeros(shape[0]))
+                result_queue.put((_generation, task_idx, None, compiler.apply_param_jac(dc, -dA, db)[sdp.W.id]))
+        except Exception as e:
+            result_queue.put((_generation, task_idx, repr(e), None))
+
+
+class SDPWorkerPool:
+    """
+    Persistent pool of processes that solve (and differentiate through) the SDPs of a group of blocks in parallel.
+    Each worker keeps its own compiled problem cache; tasks are assigned to workers by estimated cost (N^3), and the
+    backward pass of a task is sent to the worker that holds its derivative.
+    cache_size bounds each worker's compiled problem cache (the default size of SDP_PROBLEM_CACHE if None).
+    """
+
+    def __init__(self, n_workers, cache_size=None):
+        self.n_workers = n_workers
+        ctx = get_context('spawn')
+        self._task_queues = [ctx.Queue() for _ in range(n_workers)]
+        self._result_queue = ctx.Queue()
+        self._workers = [ctx.Process(target=_worker_loop,
+                                     args=(self._task_queues[i], self._result_queue, cache_size),
+                                     daemon=True) for i in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+        self._generation = 0
+        self._assignments = None
+        logger.info(f'Started SDP worker pool with {n_workers} workers')
+
+    def _collect(self, n_tasks):
+        """
+        Waits for the results of the n_tasks tasks of the current generation. Raises a CvxpyException if a task failed,
+        or if a worker died (e.g. crashed or was killed) before all the results came in
+        """
+        results, errors = [None] * n_tasks, []
+        n_collected = 0
+        while n_collected < n_tasks:
+            try:
+                generation, task_idx, error, result = self._result_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                dead_workers = [i for i, worker in enumerate(self._workers) if not worker.is_alive()]
+                if len(dead_workers) > 0:
+                    raise CvxpyException(data={'errors': [
+                        f'SDP worker {i} exited with code {self._workers[i].exitcode}' for i in dead_workers]})
+                continue
+            if generation != self._generation:
+                # Left over from an earlier call that failed
+                continue
+            n_collected += 1
+            if error is not None:
+                errors.append(f'Task {task_idx}: {error}')
+            results[task_idx] = result
+        if len(errors) > 0:
+            raise CvxpyException(data={'errors': errors})
+        return results
+
+    def solve(self, W_nps, solver_args, warm_starts):
+        """
+        Solves the SDPs for the given (upper-triangular, numpy) weight matrices.
+        Returns a list of (X, result) tuples, where result holds the final SCS iterates and iteration count
+        """
+        self._generation += 1
+        # Longest-processing-time-first assignment of tasks to workers
+        loads = [0.] * self.n_workers
+        self._assignments = [None] * len(W_nps)
+        for task_idx in sorted(range(len(W_nps)), key=lambda i: -len(W_nps[i])):
+            worker_idx = int(np.argmin(loads))
+            loads[worker_idx] += float(len(W_nps[task_idx])) ** 3
+            self._assignments[task_idx] = worker_idx
+            self._task_queues[worker_idx].put(('solve', self._generation, task_idx,
+                                               (len(W_nps[task_idx]), W_nps[task_idx], solver_args,
+                                                warm_starts[task_idx])))
+        return self._collect(len(W_nps))
+
+    def vjp(self, generation, dXs):
+        """
+        Returns the gradients w.r.t. the weight matrices of the solves of the given generation
+        """
+        if generation != self._generation:
+            raise RuntimeError('SDP worker pool: backward called after a newer forward pass')
+        for task_idx, dX in enumerate(dXs):
+            self._task_queues[self._assignments[task_idx]].put(('backward', generation, task_idx, dX))
+        return self._collect(len(dXs))
+
+    def close(self):
+        for task_queue in self._task_queues:
+            task_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+class _PooledSDPFn(torch.autograd.Function):
+    """
+    Differentiable solve of several SDPs at once on an SDPWorkerPool
+    """
+
+    @staticmethod
+    def forward(ctx, pool, solver_args, store, block_ids, verbose, *W_vals):
+        W_nps = [W_val.detach().cpu().double().numpy() for W_val in W_vals]
+        warm_starts = [store.get(block_id, len(W_np)) if store is not None else None
+                       for block_id, W_np in zip(block_ids, W_nps)]
+        results = pool.solve(W_nps, solver_args, warm_starts)
+        if store is not None:
+            for block_id, W_np, (_, result) in zip(block_ids, W_nps, results):
+                store.put(block_id, len(W_np), result, verbose=verbose)
+        ctx.pool, ctx.generation = pool, pool._generation
+        return tuple(torch.from_numpy(X).type(W_val.dtype).to(W_val.device)
+                     for (X, _), W_val in zip(results, W_vals))
+
+    @staticmethod
+    def backward(ctx, *dXs):
+        dWs = ctx.pool.vjp(ctx.generation, [dX.cpu().detach().double().numpy() for dX in dXs])
+        return (None, None, None, None, None) + tuple(torch.from_numpy(dW).type(dX.dtype).to(dX.device)
+                                                      for dW, dX in zip(dWs, dXs))
+
+
+def solve_sdp_batch(sdp_layer, W_vals, block_ids, pool, verbose=False):
+    """
+    Solves the SDPs of a group of (upper-triangular) weight matrices on the pool, with the settings (and the
+    warm-start store) of sdp_layer. Returns the list of fractional solutions
+    """
+    if len(W_vals) == 0:
+        return []
+    solver_args = {
+        "solve_method": "SCS",
+        "verbose": False,
+        "max_iters": sdp_layer.max_iters,
+        "eps": sdp_layer.eps
+    }
+    pw_prob_matrices = _PooledSDPFn.apply(pool, solver_args, sdp_layer.warm_start_store, block_ids, verbose,
+                                          *W_vals)
+    # Fix to prevent invalid solution values close to 0 and 1 but outside the range
+    return [torch.clamp(pw_prob_matrix, min=0, max=1) for pw_prob_matrix in pw_prob_matrices]
@@ -1,29 +1,70 @@
 import torch
-from ecc.ecc_layer import cluster_labels_to_matrix
+import numpy as np
+from e2e_pipeline.sdp_layer import get_max_agree_objective
+from utils.condensed_matrix import compress
 from utils.trellis_helper_fns import build_trellis, cut_trellis
 from scipy import sparse
 
 
 class TrellisCutLayer(torch.nn.Module):
     """
-    Takes the SDP solution as input and executes the trellis-cut rounding algorithm in the forward pass
+    Takes the SDP solution as input and executes the trellis-cut rounding algorithm in the forward pass: the HAC trees
+    of all the given linkages (see ecc.trellis.LINKAGES; default: all) are merged into a trellis, and the best cut of
+    the trellis is the clustering. Drop-in replacement for HACCutLayer.
     Executes a straight-through estimator in the backward pass
     """
-    def __init__(self):
+    def __init__(self, linkages=None):
         super().__init__()
+        self.linkages = linkages
+        self.round_matrix = None
+        self.cluster_labels = None
+        self.objective_value = None
+        self.cut_obj_value = None
+        self.num_ecc_satisfied = None
 
-    def get_rounded_solution(self, edge_weights, pw_probs, only_avg_hac=False):
-        t = build_trellis(pw_probs.detach().numpy(), only_avg_hac=only_avg_hac)
-        pred_clustering, cut_obj_value, num_ecc_satisfied = cut_trellis(t, sparse.coo_matrix(edge_weights.detach().numpy()))
+    def cut(self, X, weights):
+        """
+        Returns the cluster labels (0 to n_clusters - 1), the intra-cluster weight sum and the number of satisfied
+        ECCs of the best trellis cut
+        """
+        D = X.size(1)
+        if D == 1:
+            return torch.zeros(1, dtype=torch.long), 0., 0
+        # Shift the similarities to be positive, so that the graph is complete; linkage trees are invariant to this
+        pw_probs = X.detach().cpu().numpy().astype(np.float64)
+        pw_probs = pw_probs - np.min(pw_probs) + 1.
+        np.fill_diagonal(pw_probs, 0.)
+        t = build_trellis(pw_probs, linkages=self.linkages)
+        pred_clustering, cut_obj_value, num_ecc_satisfied = cut_trellis(
+            t, sparse.coo_matrix(weights.detach().cpu().numpy()))
+        cluster_labels = torch.from_numpy(np.unique(pred_clustering, return_inverse=True)[1].reshape(-1))
+        return cluster_labels, cut_obj_value, num_ecc_satisfied
 
-        self.cut_obj_value = cut_obj_value
-        self.num_ecc_satisfied = num_ecc_satisfied
-        self.pred_clustering = pred_clustering
+    def get_rounded_solution(self, X, weights):
+        """
+        X is a symmetric NxN matrix of fractional, decision values with a 1-diagonal (output from the SDP layer)
+        weights is an NxN upper-triangular (shift 1) matrix of edge weights
+        Return a symmetric NxN matrix of 0-1 decision values with a 1-diagonal
+        """
+        self.cluster_labels, self.cut_obj_value, self.num_ecc_satisfied = self.cut(X, weights)
+        self.round_matrix = (self.cluster_labels[:, None] == self.cluster_labels[None, :]).float().to(X.device)
+        self.objective_value = get_max_agree_objective(weights, self.round_matrix)
+        return self.round_matrix
 
-        # Return an NxN matrix of 0s and 1s based on the predicted clustering
-        round_mat = cluster_labels_to_matrix(self.pred_clustering)
+    def get_rounded_solutions(self, Xs, Ws):
+        """
+        Same interface as HACCutLayer.get_rounded_solutions; blocks are cut one at a time
+        """
+        cluster_labels, objective_values = [], []
+        for X, W in zip(Xs, Ws):
+            labels, _, _ = self.cut(X, W)
+            round_matrix = (labels[:, None] == labels[None, :]).float().to(X.device)
+            cluster_labels.append(labels)
+            objective_values.append(get_max_agree_objective(W, round_matrix))
+        return cluster_labels, objective_values
 
-        return round_mat
-
-    def forward(self, X, only_avg_hac=False):
-        return X + (self.get_rounded_solution(X, only_avg_hac) - X).detach()
\ No newline at end of file
+    def forward(self, X, W, return_triu=False):
+        solution = X + (self.get_rounded_solution(X, W) - X).detach()
+        if return_triu:
+            return compress(solution)
+        return solution
@@ -0,0 +1,52 @@
+"""
+Converts the preprocessed features pickles to memory-mapped block stores (see s2and/block_store.py), which
+e2e_scripts/train_utils.read_blockwise_features then opens instead of the pickles, and brings the block metadata
+sidecars of the splits up to date.
+Run from command line:
+    python e2e_scripts/convert_features_to_block_store.py --dataset_name="pubmed"
+"""
+import argparse
+import glob
+import logging
+import os
+from time import time
+
+from s2and.consts import PREPROCESSED_DATA_DIR
+from s2and.block_store import convert_pickle_to_block_store, has_current_block_store, load_block_metadata
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Parser(argparse.ArgumentParser):
+    def __init__(self):
+        super().__init__()
+        self.add_argument(
+            "--dataset_name", type=str, help="Dataset to convert (all datasets if not set)"
+        )
+        self.add_argument(
+            "--dataset_seed", type=int, help="Seed to convert (all seeds if not set)"
+        )
+        self.add_argument(
+            "--overwrite", action="store_true", help="Rewrite block stores that already exist"
+        )
+
+
+if __name__ == '__main__':
+    parser = Parser()
+    args = parser.parse_args()
+    logger.info("Script arguments:")
+    logger.info(args.__dict__)
+
+    dataset = args.dataset_name if args.dataset_name is not None else "*"
+    seed = args.dataset_seed if args.dataset_seed is not None else "*"
+    for pkl_path in sorted(glob.glob(os.path.join(PREPROCESSED_DATA_DIR, dataset, f"seed{seed}", "*_features.pkl"))):
+        if has_current_block_store(pkl_path) and not args.overwrite:
+            logger.info(f"Skipping {pkl_path} (already converted)")
+        else:
+            start_time = time()
+            convert_pickle_to_block_store(pkl_path)
+            logger.info(f"Converted {pkl_path} in {time() - start_time:.1f}s")
+        # Recomputed from the store if outdated (the store is the features the splits are now read from)
+        load_block_metadata(pkl_path)
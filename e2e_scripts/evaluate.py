@@ -15,7 +15,7 @@ import torch
 from e2e_pipeline.cc_inference import CCInference
 from e2e_pipeline.hac_inference import HACInference
 from e2e_pipeline.sdp_layer import CvxpyException
-from e2e_scripts.train_utils import compute_b3_f1, save_to_wandb_run, copy_and_load_model
+from e2e_scripts.train_utils import compute_b3_f1, save_to_wandb_run, copy_and_load_model, get_block_id
 
 from IPython import embed
 
@@ -56,6 +56,29 @@ def _fork_iter(batch_idx, _fork_id, _shared_list, eval_fn, **kwargs):
     return _proc
 
 
+def _handle_cvxpy_exception(e, model_type, tqdm_label, data, block_size, _errors, run_dir, debug):
+    """
+    Logs (and stores) the error of a failed block; re-raises it unless in debug mode
+    """
+    logger.info(e)
+    _error_obj = {
+        'id': f'e_{int(time())}',
+        'method': 'eval',
+        'model_type': model_type,
+        'data_split': tqdm_label,
+        'model_call_args': {
+            'data': data.detach().tolist(),
+            'block_size': block_size
+        },
+        'cvxpy_layer_args': e.data
+    }
+    if _errors is not None:
+        _errors.append(_error_obj)
+        save_to_wandb_run({'errors': _errors}, 'errors.json', run_dir, logger)
+    if not debug:  # if tqdm_label is not 'dev' and not debug:
+        raise CvxpyException(data=_error_obj)
+
+
 def evaluate(model, dataloader, overfit_batch_idx=-1, clustering_fn=None, clustering_threshold=None,
              val_dataloader=None, tqdm_label='', device=None, verbose=False, debug=False, _errors=None,
              run_dir='./', tqdm_position=None, model_args=None, return_iter=False, fork_size=-1,
@@ -78,10 +101,51 @@ def evaluate(model, dataloader, overfit_batch_idx=-1, clustering_fn=None, cluste
         'sdp': [],
         'round': [],
         'block_idxs': [],
-        'block_sizes': []
+        'block_sizes': [],
+        'sdp_gap': []
     }
     max_pred_id = -1
     n_exceptions = 0
+    # Small blocks are clustered in batches (with one batched HAC-cut rounding call); not for single-block runs
+    batch_round_max_size = model.batch_round_max_size if overfit_batch_idx == -1 else 0
+    _batch = []  # (idx, data, cluster_ids) of the blocks waiting to be clustered
+
+    def _add_result(idx, block_size, cluster_ids, result):
+        nonlocal max_pred_id
+        pred_cluster_ids = (result['cluster_labels'] + (max_pred_id + 1)).tolist()
+        cc_obj_vals['round'].append(result['round_objective_value'])
+        cc_obj_vals['sdp'].append(result['sdp_objective_value'])
+        cc_obj_vals['block_idxs'].append(idx)
+        cc_obj_vals['block_sizes'].append(block_size)
+        if result['sdp_objective_gap'] is not None:
+            cc_obj_vals['sdp_gap'].append(result['sdp_objective_gap'])
+        all_gold.extend(np.reshape(cluster_ids, (block_size,)))
+        max_pred_id = max(pred_cluster_ids)
+        all_pred.extend(pred_cluster_ids)
+
+    def _flush_batch():
+        nonlocal n_exceptions
+        block_ids = [get_block_id(dataloader, idx) for idx, _, _ in _batch]
+        try:
+            results = model.forward_eval_batch([data for _, data, _ in _batch], [len(c) for _, _, c in _batch],
+                                               verbose=verbose, block_ids=block_ids)
+        except CvxpyException:
+            # Redo the batch block by block, to only skip the failing blocks
+            results = []
+            for (idx, data, cluster_ids), block_id in zip(_batch, block_ids):
+                try:
+                    results += model.forward_eval_batch([data], [len(cluster_ids)], verbose=verbose,
+                                                        block_ids=[block_id])
+                except CvxpyException as e:
+                    _handle_cvxpy_exception(e, 'e2e', tqdm_label, data, len(cluster_ids), _errors, run_dir, debug)
+                    n_exceptions += 1
+                    logger.info(f'Caught CvxpyException {n_exceptions}: skipping batch')
+                    results.append(None)
+        for (idx, _, cluster_ids), result in zip(_batch, results):
+            if result is not None:
+                _add_result(idx, len(cluster_ids), cluster_ids, result)
+        _batch.clear()
+
     pbar = tqdm(dataloader, desc=f'Eval {tqdm_label}', position=tqdm_position, disable=disable_tqdm)
     for (idx, batch) in enumerate(pbar):
         if overfit_batch_idx > -1:
@@ -89,7 +153,8 @@ def evaluate(model, dataloader, overfit_batch_idx=-1, clustering_fn=None, cluste
                 continue
             if idx > overfit_batch_idx:
                 break
-        data, _, cluster_ids = batch
+        # The train split's loader also yields the block size
+        data, _, cluster_ids = batch[:3]
         block_size = len(cluster_ids)
         pbar.set_description(f'Eval {tqdm_label} (sz={block_size})')
         data = data.reshape(-1, n_features).float()
@@ -105,46 +170,35 @@ def evaluate(model, dataloader, overfit_batch_idx=-1, clustering_fn=None, cluste
                 continue
         # Forward pass through the e2e model
         data = data.to(device)
+        if block_size <= batch_round_max_size:
+            _batch.append((idx, data, cluster_ids))
+            if len(_batch) >= model.batch_round_size:
+                _flush_batch()
+            continue
         try:
-            _ = model(data, block_size, verbose=verbose)
+            _ = model(data, block_size, verbose=verbose, block_id=get_block_id(dataloader, idx))
         except CvxpyException as e:
-            logger.info(e)
-            _error_obj = {
-                'id': f'e_{int(time())}',
-                'method': 'eval',
-                'model_type': 'e2e',
-                'data_split': tqdm_label,
-                'model_call_args': {
-                    'data': data.detach().tolist(),
-                    'block_size': block_size
-                },
-                'cvxpy_layer_args': e.data
-            }
-            if _errors is not None:
-                _errors.append(_error_obj)
-                save_to_wandb_run({'errors': _errors}, 'errors.json', run_dir, logger)
-            if not debug:  # if tqdm_label is not 'dev' and not debug:
-                raise CvxpyException(data=_error_obj)
+            _handle_cvxpy_exception(e, 'e2e', tqdm_label, data, block_size, _errors, run_dir, debug)
             n_exceptions += 1
             logger.info(f'Caught CvxpyException {n_exceptions}: skipping batch')
             continue
-        pred_cluster_ids = (model.hac_cut_layer.cluster_labels + (max_pred_id + 1)).tolist()
-        cc_obj_vals['round'].append(model.hac_cut_layer.objective_value)
-        cc_obj_vals['sdp'].append(model.sdp_layer.objective_value)
-        cc_obj_vals['block_idxs'].append(idx)
-        cc_obj_vals['block_sizes'].append(block_size)
-        all_gold += list(np.reshape(cluster_ids, (block_size,)))
-        max_pred_id = max(pred_cluster_ids)
-        all_pred += list(pred_cluster_ids)
+        result = {
+            'cluster_labels': model.cluster_labels,
+            'round_objective_value': model.round_objective_value,
+            'sdp_objective_value': model.frac_objective_value,
+            'sdp_objective_gap': model.sdp_layer.objective_gap
+        }
+        _add_result(idx, block_size, cluster_ids, result)
         if overfit_batch_idx > -1 and return_iter:
+            model.sdp_layer.flush_warm_starts()
             return {
-                'cluster_labels': model.hac_cut_layer.cluster_labels,
-                'round_objective_value': model.hac_cut_layer.objective_value,
-                'sdp_objective_value': model.sdp_layer.objective_value,
+                **result,
                 'block_idx': idx,
                 'block_size': block_size,
                 'cluster_ids': cluster_ids
             }
+    if len(_batch) > 0:
+        _flush_batch()
 
     if fork_enabled and len(_procs) > 0:
         _procs.sort(key=lambda x: x[1])  # To visualize progress
@@ -156,14 +210,10 @@ def evaluate(model, dataloader, overfit_batch_idx=-1, clustering_fn=None, cluste
             logger.info("Error: All forked eval iterations did not return results")
             raise ValueError("All forked eval iterations did not return results")
         for _data in _shared_list:
-            pred_cluster_ids = (_data['cluster_labels'] + (max_pred_id + 1)).tolist()
-            cc_obj_vals['round'].append(_data['round_objective_value'])
-            cc_obj_vals['sdp'].append(_data['sdp_objective_value'])
-            cc_obj_vals['block_idxs'].append(_data['block_idx'])
-            cc_obj_vals['block_sizes'].append(_data['block_size'])
-            all_gold += list(np.reshape(_data['cluster_ids'], (_data['block_size'],)))
-            max_pred_id = max(pred_cluster_ids)
-            all_pred += list(pred_cluster_ids)
+            _add_result(_data['block_idx'], _data['block_size'], _data['cluster_ids'], _data)
+
+    # Persist this pass's warm starts for the next eval process
+    model.sdp_layer.flush_warm_starts()
 
     vmeasure = v_measure_score(all_gold, all_pred)
     b3_f1 = compute_b3_f1(all_gold, all_pred)[2]
@@ -194,10 +244,57 @@ def evaluate_pairwise(model, dataloader, overfit_batch_idx=-1, mode="macro", ret
             'sdp': [],
             'round': [],
             'block_idxs': [],
-            'block_sizes': []
+            'block_sizes': [],
+            'sdp_gap': [],
+            'routes': []
         }
         max_pred_id = -1  # In each iteration, add to all blockwise predicted IDs to distinguish from previous blocks
         n_exceptions = 0
+        if clustering_fn.__class__ is CCInference and not return_iter:
+            clustering_fn.router.reset_log()  # Routes of this evaluation only
+        # Small blocks are clustered in batches (with one batched HAC-cut rounding call); not for single-block runs
+        batch_round_max_size = clustering_fn.batch_round_max_size if (
+                clustering_fn.__class__ is CCInference and overfit_batch_idx == -1) else 0
+        _batch = []  # (idx, data, edge_weights, cluster_ids) of the blocks waiting to be clustered
+
+        def _add_cc_result(idx, block_size, cluster_ids, result):
+            nonlocal max_pred_id
+            pred_cluster_ids = (np.asarray(result['cluster_labels']) + (max_pred_id + 1)).tolist()
+            cc_obj_vals['round'].append(result['round_objective_value'])
+            cc_obj_vals['sdp'].append(result['sdp_objective_value'])
+            cc_obj_vals['block_idxs'].append(idx)
+            cc_obj_vals['block_sizes'].append(block_size)
+            cc_obj_vals['routes'].append(result['route'])
+            if result['sdp_objective_gap'] is not None:
+                cc_obj_vals['sdp_gap'].append(result['sdp_objective_gap'])
+            all_gold.extend(np.reshape(cluster_ids, (block_size,)))
+            max_pred_id = max(pred_cluster_ids)
+            all_pred.extend(pred_cluster_ids)
+
+        def _flush_batch():
+            nonlocal n_exceptions
+            block_ids = [get_block_id(dataloader, idx) for idx, _, _, _ in _batch]
+            try:
+                results = clustering_fn.forward_batch([w for _, _, w, _ in _batch], [len(c) for _, _, _, c in _batch],
+                                                      threshold=clustering_threshold, block_ids=block_ids)
+            except CvxpyException:
+                # Redo the batch block by block, to only skip the failing blocks
+                results = []
+                for (idx, data, edge_weights, cluster_ids), block_id in zip(_batch, block_ids):
+                    try:
+                        results += clustering_fn.forward_batch([edge_weights], [len(cluster_ids)],
+                                                               threshold=clustering_threshold, block_ids=[block_id])
+                    except CvxpyException as e:
+                        _handle_cvxpy_exception(e, 'pairwise_cc', tqdm_label, data, len(cluster_ids), _errors,
+                                                run_dir, debug)
+                        n_exceptions += 1
+                        logger.info(f'Caught CvxpyException {n_exceptions}: skipping batch')
+                        results.append(None)
+            for (idx, _, _, cluster_ids), result in zip(_batch, results):
+                if result is not None:
+                    _add_cc_result(idx, len(cluster_ids), cluster_ids, result)
+            _batch.clear()
+
         pbar = tqdm(dataloader, desc=f'Eval {tqdm_label}', position=tqdm_position, disable=disable_tqdm)
         for (idx, batch) in enumerate(pbar):
             if overfit_batch_idx > -1:
@@ -205,14 +302,16 @@ def evaluate_pairwise(model, dataloader, overfit_batch_idx=-1, mode="macro", ret
                     continue
                 if idx > overfit_batch_idx:
                     break
-            data, _, cluster_ids = batch
+            # The train split's loader also yields the block size
+            data, _, cluster_ids = batch[:3]
             block_size = len(cluster_ids)
             pbar.set_description(f'Eval {tqdm_label} (sz={block_size})')
             data = data.reshape(-1, n_features).float()
             if data.shape[0] == 0:
                 # Only one signature in block; manually assign a unique cluster
                 pred_cluster_ids = [max_pred_id + 1]
-            elif fork_enabled and block_size >= fork_size and clustering_fn.__class__ is CCInference:
+            elif fork_enabled and block_size >= fork_size and clustering_fn.__class__ is CCInference and \
+                    clustering_fn.router.route(block_size) in ("sdp", "nosdp"):
                 logger.info(f"Eval fork info: len(_procs)={len(_procs)}, len(_shared_list)={len(_shared_list)}")
                 if (len(_procs) - len(_shared_list)) < max_parallel_forks:
                     _proc = _fork_iter(idx, _fork_id, _shared_list, evaluate_pairwise, **fn_args)
@@ -223,46 +322,49 @@ def evaluate_pairwise(model, dataloader, overfit_batch_idx=-1, mode="macro", ret
             data = data.to(device)
             try:
                 edge_weights = model(data, N=block_size, warmstart=True, verbose=verbose)  # Setting warmstart to True returns weights
-                pred_cluster_ids = clustering_fn(edge_weights, block_size, min_id=(max_pred_id + 1),
-                                                 threshold=clustering_threshold)
+                if block_size <= batch_round_max_size:
+                    _batch.append((idx, data, edge_weights, cluster_ids))
+                    if len(_batch) >= clustering_fn.batch_round_size:
+                        _flush_batch()
+                    continue
+                if clustering_fn.__class__ is CCInference:
+                    pred_cluster_ids = clustering_fn(edge_weights, block_size, min_id=(max_pred_id + 1),
+                                                     threshold=clustering_threshold,
+                                                     block_id=get_block_id(dataloader, idx))
+                else:
+                    pred_cluster_ids = clustering_fn(edge_weights, block_size, min_id=(max_pred_id + 1),
+                                                     threshold=clustering_threshold)
             except CvxpyException as e:
-                logger.info(e)
-                _error_obj = {
-                    'id': f'e_{int(time())}',
-                    'method': 'eval',
-                    'model_type': 'pairwise_cc',
-                    'data_split': tqdm_label,
-                    'model_call_args': {
-                        'data': data.detach().tolist(),
-                        'block_size': block_size
-                    },
-                    'cvxpy_layer_args': e.data
-                }
-                if _errors is not None:
-                    _errors.append(_error_obj)
-                    save_to_wandb_run({'errors': _errors}, 'errors.json', run_dir, logger)
-                if not debug:  # if tqdm_label is not 'dev' and not debug:
-                    raise CvxpyException(data=_error_obj)
+                _handle_cvxpy_exception(e, 'pairwise_cc', tqdm_label, data, block_size, _errors, run_dir, debug)
                 n_exceptions += 1
                 logger.info(f'Caught CvxpyException {n_exceptions}: skipping batch')
                 continue
             if clustering_fn.__class__ is CCInference:
-                cc_obj_vals['round'].append(clustering_fn.hac_cut_layer.objective_value)
-                cc_obj_vals['sdp'].append(clustering_fn.sdp_layer.objective_value)
+                cc_obj_vals['round'].append(clustering_fn.round_objective_value)
+                cc_obj_vals['sdp'].append(clustering_fn.frac_objective_value)
                 cc_obj_vals['block_idxs'].append(idx)
                 cc_obj_vals['block_sizes'].append(block_size)
+                cc_obj_vals['routes'].append(clustering_fn.route)
+                if clustering_fn.sdp_layer.objective_gap is not None:
+                    cc_obj_vals['sdp_gap'].append(clustering_fn.sdp_layer.objective_gap)
             all_gold += list(np.reshape(cluster_ids, (block_size,)))
             max_pred_id = max(pred_cluster_ids)
             all_pred += list(pred_cluster_ids)
             if overfit_batch_idx > -1 and return_iter:
+                clustering_fn.sdp_layer.flush_warm_starts()
                 return {
                     'cluster_labels': list(np.array(pred_cluster_ids) - (max_pred_id + 1)),
-                    'round_objective_value': clustering_fn.hac_cut_layer.objective_value,
-                    'sdp_objective_value': clustering_fn.sdp_layer.objective_value,
+                    'round_objective_value': clustering_fn.round_objective_value,
+                    'sdp_objective_value': clustering_fn.frac_objective_value,
+                    'sdp_objective_gap': clustering_fn.sdp_layer.objective_gap,
+                    'route': clustering_fn.route,
+                    'route_seconds': clustering_fn.router.log[-1][2],
                     'block_idx': idx,
                     'block_size': block_size,
                     'cluster_ids': cluster_ids
                 }
+        if len(_batch) > 0:
+            _flush_batch()
 
         if fork_enabled and len(_procs) > 0:
             _procs.sort(key=lambda x: x[1])  # To visualize progress
@@ -274,14 +376,13 @@ def evaluate_pairwise(model, dataloader, overfit_batch_idx=-1, mode="macro", ret
                 logger.info("Error: All forked eval iterations did not return results")
                 raise ValueError("All forked eval iterations did not return results")
             for _data in _shared_list:
-                pred_cluster_ids = (_data['cluster_labels'] + (max_pred_id + 1)).tolist()
-                cc_obj_vals['round'].append(_data['round_objective_value'])
-                cc_obj_vals['sdp'].append(_data['sdp_objective_value'])
-                cc_obj_vals['block_idxs'].append(_data['block_idx'])
-                cc_obj_vals['block_sizes'].append(_data['block_size'])
-                all_gold += list(np.reshape(_data['cluster_ids'], (_data['block_size'],)))
-                max_pred_id = max(pred_cluster_ids)
-                all_pred += list(pred_cluster_ids)
+                _add_cc_result(_data['block_idx'], _data['block_size'], _data['cluster_ids'], _data)
+                # Forked blocks were routed in their own process; record them here too
+                clustering_fn.router.record(_data['block_size'], _data['route'], _data['route_seconds'])
+
+        if clustering_fn.__class__ is CCInference:
+            # Persist this pass's warm starts for the next eval process
+            clustering_fn.sdp_layer.flush_warm_starts()
 
         vmeasure = v_measure_score(all_gold, all_pred)
         b3_f1 = compute_b3_f1(all_gold, all_pred)[2]
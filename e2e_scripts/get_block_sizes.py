@@ -4,10 +4,11 @@ import json
 import logging
 import os
 import numpy as np
-import pickle
 from time import time
 from tqdm import tqdm
 
+from s2and.block_store import load_block_metadata
+
 from IPython import embed
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
@@ -70,13 +71,12 @@ if __name__ == '__main__':
             for split in splits:
                 _blk_szs = []
                 fpath = os.path.join(dataset_path, f'seed{seed}', f'{split}_features.pkl')
-                with open(fpath, 'rb') as fh:
-                    block_dict = pickle.load(fh)
-                    for k in block_dict.keys():
-                        assert k not in _seen_blk
-                        _seen_blk.add(k)
-                        _, _, cluster_ids = block_dict[k]
-                        _blk_szs.append(len(cluster_ids))
+                # Block ids and sizes from the metadata sidecar of the split (computed once if missing)
+                metadata = load_block_metadata(fpath)
+                for k, blk_sz in zip(metadata['block_ids'].tolist(), metadata['block_sizes'].tolist()):
+                    assert k not in _seen_blk
+                    _seen_blk.add(k)
+                    _blk_szs.append(blk_sz)
                 result[dataset][seed][split] = {
                     'n_blocks': len(_blk_szs),
                     'min': np.min(_blk_szs),
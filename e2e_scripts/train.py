@@ -2,6 +2,8 @@ import glob
 import json
 import os
 import time
+import shutil
+import tempfile
 import logging
 import random
 import copy
@@ -13,14 +15,17 @@ from tqdm import tqdm
 from torch.multiprocessing import set_start_method, Manager
 
 from e2e_pipeline.cc_inference import CCInference
+from e2e_pipeline.cc_router import CCRouter
 from e2e_pipeline.hac_inference import HACInference
 from e2e_pipeline.model import EntResModel
 from e2e_pipeline.pairwise_model import PairwiseModel
-from e2e_pipeline.sdp_layer import CvxpyException
+from e2e_pipeline.sdp_layer import CvxpyException, SDP_PROBLEM_CACHE
+from e2e_pipeline.sdp_pool import SDPWorkerPool
 from e2e_scripts.evaluate import evaluate, evaluate_pairwise
 from e2e_scripts.train_utils import DEFAULT_HYPERPARAMS, get_dataloaders, get_matrix_size_from_triu, \
     uncompress_target_tensor, count_parameters, log_cc_objective_values, save_to_wandb_run, FrobeniusLoss, \
-    get_feature_count, _check_process, fork_eval, init_eval, dev_eval
+    get_feature_count, _check_process, fork_eval, init_eval, dev_eval, get_block_id, \
+    try_train_pooled_group, record_train_error
 from utils.parser import Parser
 
 from IPython import embed
@@ -78,11 +83,14 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                 'aminer': 3,
                 'kisti': 3,
                 'arnetminer': 5
-            }
+            },
+            'e2e_lowrank': {}
         }
         n_epochs_override = None
         if not hyp['pairwise_mode']:
             _training_method = 'e2e' if hyp['use_sdp'] else 'nosdp'
+            if hyp['use_sdp'] and hyp['sdp_solver'] == 'lowrank':
+                _training_method = 'e2e_lowrank'
             if hyp['dataset'] in max_epochs_by_dataset[_training_method] and \
                     hyp["n_epochs"] > max_epochs_by_dataset[_training_method][hyp['dataset']]:
                 n_epochs_override = max_epochs_by_dataset[_training_method][hyp['dataset']]
@@ -126,6 +134,29 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
         sdp_max_iters = hyp["sdp_max_iters"]
         sdp_eps = hyp["sdp_eps"]
         sdp_scale = hyp["sdp_scale"]
+        sdp_solver = hyp["sdp_solver"]
+        sdp_lowrank_rank = hyp["sdp_lowrank_rank"]
+        sdp_report_gap = hyp["sdp_report_gap"]
+        sdp_warm_start = hyp["sdp_warm_start"] and sdp_solver == "scs"
+        sdp_warm_start_mem_mb = hyp["sdp_warm_start_mem_mb"]
+        sdp_warm_start_dir = hyp["sdp_warm_start_dir"]
+        if sdp_warm_start and sdp_warm_start_dir is None:
+            # Spilled warm starts are shared with the (spawned) eval processes through this directory
+            sdp_warm_start_dir = tempfile.mkdtemp(prefix='sdp_warm_starts_')
+        sdp_reduce = hyp["sdp_reduce"]
+        sdp_reduce_tol = hyp["sdp_reduce_tol"]
+        sdp_contraction_ratio = hyp["sdp_contraction_ratio"]
+        sdp_pool_batch_size = hyp["sdp_pool_batch_size"]
+        exact_max_size = hyp["exact_max_size"]
+        batch_round_max_size = hyp["batch_round_max_size"]
+        batch_round_size = hyp["batch_round_size"]
+        rounding = hyp["rounding"]
+        trellis_linkages = hyp["trellis_linkages"]
+        router_sdp_max_size = hyp["router_sdp_max_size"]
+        router_nosdp_max_size = hyp["router_nosdp_max_size"]
+        router_time_budget = hyp["router_time_budget"]
+        sdp_pool = None
+        SDP_PROBLEM_CACHE.resize(hyp["sdp_cache_size"])
         grad_acc = hyp['batch_size'] if hyp["gradient_accumulation"] else 1
         overfit_batch_idx = hyp['overfit_batch_idx']
         clustering_metrics = {'b3_f1': 0, 'vmeasure': 1}
@@ -139,6 +170,15 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
 
         # Get data loaders (optionally with imputation, normalization)
         if training_mode:
+            # Overfitting runs sample the train blocks in dataset order, and step after their block
+            shuffle_buckets = hyp["shuffle_buckets"] and not pairwise_mode and overfit_batch_idx == -1
+            bucket_ratio = hyp["bucket_ratio"] if overfit_batch_idx == -1 else None
+            pair_budget = grad_acc if overfit_batch_idx == -1 else 1
+            min_block_pairs = 2 if add_batchnorm else 1  # Blocks with fewer pairs are skipped by the training loop
+            num_workers = hyp["dataloader_num_workers"]
+            prefetch_factor = hyp["dataloader_prefetch_factor"]
+            # Overfitting runs index the pairwise train dataset, which is then not streamed
+            stream_pairwise = hyp["stream_pairwise"] and overfit_batch_idx == -1
             train_dataloader, val_dataloader, test_dataloader = get_dataloaders(hyp["dataset"],
                                                                                 hyp["dataset_random_seed"],
                                                                                 hyp["convert_nan"], hyp["nan_value"],
@@ -147,8 +187,19 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                                                                 hyp["subsample_sz_dev"],
                                                                                 pairwise_mode, batch_size,
                                                                                 drop_feat_idxs=hyp["drop_feat_idxs"],
-                                                                                keep_feat_idxs=hyp["keep_feat_idxs"])
-            n_features = train_dataloader.dataset[0][0].shape[1]
+                                                                                keep_feat_idxs=hyp["keep_feat_idxs"],
+                                                                                materialize=hyp["materialize_data"],
+                                                                                materialize_cache_dir=hyp["materialize_cache_dir"],
+                                                                                shuffle=shuffle_buckets,
+                                                                                pair_budget=pair_budget,
+                                                                                bucket_ratio=bucket_ratio,
+                                                                                min_block_pairs=min_block_pairs,
+                                                                                num_workers=num_workers,
+                                                                                prefetch_factor=prefetch_factor,
+                                                                                pin_memory=device.type == 'cuda',
+                                                                                stream_pairwise=stream_pairwise,
+                                                                                shuffle_buffer_size=hyp["pairwise_shuffle_buffer"])
+            n_features = train_dataloader.dataset.n_features
         else:
             n_features = get_feature_count(hyp["dataset"], hyp["dataset_random_seed"])
 
@@ -157,7 +208,10 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
             model_args = (n_features, neumiss_depth, dropout_p, dropout_only_once, add_neumiss,
                          neumiss_deq, hidden_dim, n_hidden_layers, add_batchnorm, add_layernorm, activation,
                          negative_slope, hidden_config, sdp_max_iters, sdp_eps, sdp_scale,
-                         use_rounded_loss, (e2e_loss == "bce"), use_sdp)
+                         use_rounded_loss, (e2e_loss == "bce"), use_sdp, sdp_solver, sdp_lowrank_rank,
+                         sdp_report_gap, sdp_warm_start, sdp_warm_start_mem_mb, sdp_warm_start_dir, sdp_reduce,
+                         sdp_reduce_tol, sdp_contraction_ratio, exact_max_size, batch_round_max_size,
+                         batch_round_size, rounding, trellis_linkages)
             model = EntResModel(*model_args)
             # Define eval
             eval_fn = evaluate
@@ -175,10 +229,8 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                         n_pos = train_dataloader.dataset[overfit_batch_idx][1].sum()
                         pos_weight = (len(train_dataloader.dataset[overfit_batch_idx][1]) - n_pos) / n_pos
                     else:
-                        _n_pos, _n_total = 0., 0.
-                        for _i in range(len(train_dataloader.dataset)):
-                            _n_pos += train_dataloader.dataset[_i][1].sum()
-                            _n_total += len(train_dataloader.dataset[_i][1])
+                        _label_stats = train_dataloader.dataset.get_label_stats()
+                        _n_pos, _n_total = _label_stats['n_pos'], _label_stats['n_pairs']
                         pos_weight = (_n_total - _n_pos) / _n_pos if _n_pos > 0 else 1.
                 if n_warmstart_epochs > 0:
                     train_dataloader_pairwise = get_dataloaders(hyp["dataset"],
@@ -190,7 +242,14 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                                                 hyp["subsample_sz_dev"],
                                                                 pairwise_mode=True, batch_size=hyp['batch_size'],
                                                                 split='train', drop_feat_idxs=hyp["drop_feat_idxs"],
-                                                                keep_feat_idxs=hyp["keep_feat_idxs"])
+                                                                keep_feat_idxs=hyp["keep_feat_idxs"],
+                                                                materialize=hyp["materialize_data"],
+                                                                materialize_cache_dir=hyp["materialize_cache_dir"],
+                                                                num_workers=num_workers,
+                                                                prefetch_factor=prefetch_factor,
+                                                                pin_memory=device.type == 'cuda',
+                                                                stream_pairwise=stream_pairwise,
+                                                                shuffle_buffer_size=hyp["pairwise_shuffle_buffer"])
                     # Define loss
                     loss_fn_pairwise = torch.nn.BCEWithLogitsLoss(pos_weight=torch.tensor(pos_weight))
         else:
@@ -200,7 +259,12 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
             model = PairwiseModel(*model_args)
             # Define eval
             eval_fn = evaluate_pairwise
-            cc_inference = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp)
+            cc_inference = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp, sdp_solver, sdp_lowrank_rank,
+                                       sdp_report_gap, sdp_warm_start, sdp_warm_start_mem_mb, sdp_warm_start_dir,
+                                       sdp_reduce, sdp_reduce_tol, sdp_contraction_ratio, exact_max_size,
+                                       CCRouter(exact_max_size, router_sdp_max_size if use_sdp else 0,
+                                                router_nosdp_max_size, router_time_budget),
+                                       batch_round_max_size, batch_round_size, rounding, trellis_linkages)
             pairwise_clustering_fns = [cc_inference, HACInference(), cc_inference]
             pairwise_clustering_fns[0].eval()
             pairwise_clustering_fn_labels = ['cc', 'hac', 'cc-fixed']
@@ -214,7 +278,9 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                                                       pairwise_mode=False, batch_size=1,
                                                                       split=['dev', 'test'],
                                                                       drop_feat_idxs=hyp["drop_feat_idxs"],
-                                                                      keep_feat_idxs=hyp["keep_feat_idxs"])
+                                                                      keep_feat_idxs=hyp["keep_feat_idxs"],
+                                                                      materialize=hyp["materialize_data"],
+                                                                      materialize_cache_dir=hyp["materialize_cache_dir"])
             if training_mode:  # => model will be used for training
                 # Define loss
                 pos_weight = None
@@ -225,8 +291,9 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                 1].sum()
                         pos_weight = torch.tensor((batch_size - n_pos) / n_pos if n_pos > 0 else 1.)
                     else:
-                        n_pos = train_dataloader.dataset[:][1].sum()
-                        pos_weight = torch.tensor((len(train_dataloader.dataset) - n_pos) / n_pos if n_pos > 0 else 1.)
+                        _label_stats = train_dataloader.dataset.get_label_stats()
+                        n_pos = _label_stats['n_pos']
+                        pos_weight = torch.tensor((_label_stats['n_pairs'] - n_pos) / n_pos if n_pos > 0 else 1.)
                 loss_fn_pairwise = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
         logger.info(f"Model loaded: {model}", )
 
@@ -246,8 +313,21 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
 
         if eval_all_only:
             # Run all inference variants on the test set and exit
-            cc_inference_sdp = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp=True)
-            cc_inference_nosdp = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp=False)
+            cc_inference_sdp = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp=True, sdp_solver=sdp_solver,
+                                           sdp_lowrank_rank=sdp_lowrank_rank, sdp_report_gap=sdp_report_gap,
+                                           sdp_warm_start=sdp_warm_start, sdp_warm_start_mem_mb=sdp_warm_start_mem_mb,
+                                           sdp_warm_start_dir=sdp_warm_start_dir, sdp_reduce=sdp_reduce,
+                                           sdp_reduce_tol=sdp_reduce_tol, sdp_contraction_ratio=sdp_contraction_ratio,
+                                           exact_max_size=exact_max_size,
+                                           router=CCRouter(exact_max_size, router_sdp_max_size,
+                                                           router_nosdp_max_size, router_time_budget),
+                                           batch_round_max_size=batch_round_max_size,
+                                           batch_round_size=batch_round_size, rounding=rounding,
+                                           trellis_linkages=trellis_linkages)
+            cc_inference_nosdp = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp=False,
+                                             batch_round_max_size=batch_round_max_size,
+                                             batch_round_size=batch_round_size, rounding=rounding,
+                                             trellis_linkages=trellis_linkages)
             inference_fns = [HACInference(),
                              cc_inference_sdp, cc_inference_sdp,
                              cc_inference_nosdp, cc_inference_nosdp]
@@ -266,7 +346,9 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                                                       pairwise_mode=False, batch_size=1,
                                                                       split=['dev', 'test'],
                                                                       drop_feat_idxs=hyp["drop_feat_idxs"],
-                                                                      keep_feat_idxs=hyp["keep_feat_idxs"])
+                                                                      keep_feat_idxs=hyp["keep_feat_idxs"],
+                                                                      materialize=hyp["materialize_data"],
+                                                                      materialize_cache_dir=hyp["materialize_cache_dir"])
             start_time = time.time()
             with torch.no_grad():
                 model.eval()
@@ -308,7 +390,9 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                                   hyp["normalize_data"], hyp["subsample_sz_train"],
                                                   hyp["subsample_sz_dev"], pairwise_mode,
                                                   batch_size, split=eval_only_split, drop_feat_idxs=hyp["drop_feat_idxs"],
-                                                  keep_feat_idxs=hyp["keep_feat_idxs"])
+                                                  keep_feat_idxs=hyp["keep_feat_idxs"],
+                                                  materialize=hyp["materialize_data"],
+                                                  materialize_cache_dir=hyp["materialize_cache_dir"])
                 eval_scores = eval_fn(model, eval_dataloader, tqdm_label=eval_only_split, device=device, verbose=verbose,
                                       debug=debug, _errors=_errors, model_args=model_args, run_dir=run.dir)
                 logger.info(f"Eval: {eval_only_split}_{list(eval_metric_to_idx)[0]}={eval_scores[0]}, " +
@@ -377,21 +461,13 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                                               val_dataloader=val_dataloader, return_dict=_return_dict,
                                                               run_dir=run.dir),
                                   model=model, run_dir=run.dir, device=device, logger=logger)
-            if not pairwise_mode and grad_acc > 1:
-                grad_acc_steps = []
-                _seen_pw = 0
-                _seen_blk = 0
-                for d in train_dataloader.dataset:
-                    _blk_sz = len(d[1])
-                    _seen_pw += _blk_sz
-                    _seen_blk += 1
-                    if _seen_pw >= grad_acc:
-                        grad_acc_steps.append(_seen_blk)
-                        _seen_pw = 0
-                        _seen_blk = 0
-                if _seen_blk > 0:
-                    grad_acc_steps.append(_seen_blk)
-                logger.info(f"grad_acc step schedule: {grad_acc_steps}")
+            if not pairwise_mode:
+                _step_sizes = train_dataloader.sampler.step_sizes
+                logger.info(f"Gradient accumulation: {len(_step_sizes)} steps of {np.mean(_step_sizes):.1f} blocks "
+                            f"on average (max {max(_step_sizes, default=0)})")
+
+            if not pairwise_mode and use_sdp and sdp_solver == "scs" and hyp["sdp_pool_workers"] > 0:
+                sdp_pool = SDPWorkerPool(hyp["sdp_pool_workers"], cache_size=hyp["sdp_cache_size"])
 
             model.train()
             start_time = time.time()  # Tracks full training runtime
@@ -412,8 +488,7 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                 running_loss = []
                 n_exceptions = 0
 
-                grad_acc_count = 0
-                grad_acc_idx = 0
+                _pool_group = []
                 optimizer.zero_grad()
 
                 pbar = tqdm(_train_dataloader, desc=f"{'Warm-starting' if warmstart_mode else 'Training'} {epoch_idx + 1}",
@@ -442,9 +517,12 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                         if batch_idx > overfit_batch_idx:
                             break
                     if not pairwise_mode and not warmstart_mode:
-                        data, target, _ = batch
+                        data, target, _, block_size = batch
+                        # Number of blocks the loss is averaged over, and whether the optimizer steps after this block
+                        grad_acc_denom, _step = _train_dataloader.sampler.get_step(batch_idx)
                     else:
                         data, target = batch
+                        grad_acc_denom, _step = 1, True
                     data = data.reshape(-1, n_features).float()
                     if data.shape[0] == 0:
                         # Block contains only one signature
@@ -452,7 +530,8 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                     if add_batchnorm and data.shape[0] == 1:
                         # Block contains only one signature pair; batchnorm throws error
                         continue
-                    block_size = get_matrix_size_from_triu(data)
+                    if pairwise_mode or warmstart_mode:
+                        block_size = get_matrix_size_from_triu(data)
                     pbar.set_description(f"{'Warm-starting' if warmstart_mode else 'Training'} {epoch_idx + 1} " + \
                                          f"(sz={len(data) if (pairwise_mode or warmstart_mode) else block_size})")
                     target = target.flatten().float()
@@ -463,26 +542,46 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
 
                     # Forward pass through the e2e or pairwise model
                     data, target = data.to(device), target.to(device)
+                    if sdp_pool is not None and not warmstart_mode:
+                        # Queue the block; queued blocks have their SDPs solved together on the worker pool, at the
+                        # latest right before the next optimizer step
+                        _pool_group.append((data, target, block_size, get_block_id(_train_dataloader, batch_idx),
+                                            grad_acc_denom))
+                        if len(_pool_group) < sdp_pool_batch_size and not _step:
+                            continue
+                        _losses = try_train_pooled_group(model, _pool_group, sdp_pool, loss_fn, e2e_loss,
+                                                         pos_weight, device, verbose, debug, _errors, run.dir,
+                                                         logger, epoch_idx, batch_idx)
+                        _pool_group = []
+                        if _losses is None:
+                            n_exceptions += 1
+                            logger.info(
+                                f'Caught CvxpyException in pooled call (count -> {n_exceptions}): skipping group')
+                            continue
+                        if _step:
+                            if hyp["max_grad_norm"] != -1:
+                                torch.nn.utils.clip_grad_norm_(
+                                    model.parameters(), hyp["max_grad_norm"]
+                                )
+                            optimizer.step()
+                            optimizer.zero_grad()
+                        if verbose:
+                            logger.info(f"Loss = {np.sum(_losses)}")
+                        running_loss += _losses
+                        wandb.log({f'train_loss': np.mean(running_loss)})
+                        continue
                     try:
-                        output = model(data, N=block_size, warmstart=warmstart_mode, verbose=verbose)
+                        if not pairwise_mode and not warmstart_mode:
+                            output = model(data, N=block_size, verbose=verbose,
+                                           block_id=get_block_id(_train_dataloader, batch_idx))
+                        else:
+                            output = model(data, N=block_size, warmstart=warmstart_mode, verbose=verbose)
                     except CvxpyException as e:
                         logger.info(e)
-                        _error_obj = {
-                            'id': f'tf_{int(time.time())}',
-                            'epoch_idx': epoch_idx,
-                            'batch_idx': batch_idx,
-                            'method': 'train_forward',
-                            'model_type': 'e2e' if not pairwise_mode else 'pairwise',
-                            'data_split': 'train',
-                            'model_call_args': {
-                                'data': data.detach().tolist(),
-                                'block_size': block_size
-                            },
-                            'cvxpy_layer_args': e.data
-                        }
-                        if _errors is not None:
-                            _errors.append(_error_obj)
-                            save_to_wandb_run({'errors': _errors}, 'errors.json', run.dir, logger)
+                        record_train_error(_errors, run.dir, logger, 'tf', 'train_forward', epoch_idx, batch_idx,
+                                           'e2e' if not pairwise_mode else 'pairwise',
+                                           {'data': data.detach().tolist(), 'block_size': block_size},
+                                           cvxpy_layer_args=e.data)
                         if debug:
                             n_exceptions += 1
                             logger.info(
@@ -491,7 +590,6 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
 
                     # Calculate the loss
                     if not pairwise_mode and not warmstart_mode:
-                        grad_acc_denom = 1 if grad_acc == 1 else grad_acc_steps[grad_acc_idx]
                         if e2e_loss != "bce":
                             target = uncompress_target_tensor(target, device=device)
                         if verbose:
@@ -508,48 +606,50 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
 
                     try:
                         loss.backward()
-                        if not pairwise_mode and grad_acc > 1:
-                            grad_acc_count += len(data)
                     except Exception as e:
                         logger.info(e)
                         if isinstance(e, CvxpyException):
-                            _error_obj = {
-                                'id': f'tb_{int(time.time())}',
-                                'epoch_idx': epoch_idx,
-                                'batch_idx': batch_idx,
-                                'method': 'train_backward',
-                                'model_type': 'e2e' if not pairwise_mode else 'pairwise',
-                                'data_split': 'train',
-                                'model_call_args': {
-                                    'data': data.detach().tolist(),
-                                    'block_size': block_size
-                                }
-                            }
-                            if _errors is not None:
-                                _errors.append(_error_obj)
-                                save_to_wandb_run({'errors': _errors}, 'errors.json', run.dir, logger)
+                            record_train_error(_errors, run.dir, logger, 'tb', 'train_backward', epoch_idx, batch_idx,
+                                               'e2e' if not pairwise_mode else 'pairwise',
+                                               {'data': data.detach().tolist(), 'block_size': block_size})
                             if debug:
                                 n_exceptions += 1
                                 logger.info(
                                     f'Caught CvxpyException in backward call (count -> {n_exceptions}): skipping batch')
                                 continue
-                    if pairwise_mode or (batch_idx == len(_train_dataloader) - 1) \
-                            or grad_acc == 1 or grad_acc_count >= grad_acc:
+                    if _step:
                         if hyp["max_grad_norm"] != -1:
                             torch.nn.utils.clip_grad_norm_(
                                 model.parameters(), hyp["max_grad_norm"]
                             )
                         optimizer.step()
                         optimizer.zero_grad()
-                        if grad_acc > 1:
-                            grad_acc_count = 0
-                            grad_acc_idx += 1
 
                     if verbose:
                         logger.info(f"Loss = {loss.item()}")
                     running_loss.append(loss.item())
                     wandb.log({f'train_loss{"_warmstart" if warmstart_mode else ""}': np.mean(running_loss)})
 
+                if len(_pool_group) > 0 and not early_terminate:
+                    # Blocks left queued when the last batches of the epoch were skipped
+                    _losses = try_train_pooled_group(model, _pool_group, sdp_pool, loss_fn, e2e_loss, pos_weight,
+                                                     device, verbose, debug, _errors, run.dir, logger, epoch_idx,
+                                                     batch_idx)
+                    _pool_group = []
+                    if _losses is None:
+                        n_exceptions += 1
+                        logger.info(
+                            f'Caught CvxpyException in pooled call (count -> {n_exceptions}): skipping group')
+                        optimizer.zero_grad()
+                    else:
+                        running_loss += _losses
+                        if hyp["max_grad_norm"] != -1:
+                            torch.nn.utils.clip_grad_norm_(
+                                model.parameters(), hyp["max_grad_norm"]
+                            )
+                        optimizer.step()
+                        optimizer.zero_grad()
+
                 if warmstart_mode:
                     logger.info(f"Warmstart epoch loss = {np.mean(running_loss)}")
                     wandb.log({f'train_warmstart_epoch_loss': np.mean(running_loss)})
@@ -574,6 +674,14 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
 
                     logger.info(f"Epoch loss = {np.mean(running_loss)}")
                     wandb.log({f'train_epoch_loss': np.mean(running_loss)})
+                    if not pairwise_mode and use_sdp:
+                        _cache_stats = SDP_PROBLEM_CACHE.stats()
+                        logger.info(f"SDP problem cache: {_cache_stats}")
+                        wandb.log({f'sdp_cache_{k}': v for k, v in _cache_stats.items()})
+                        if model.sdp_layer.warm_start_store is not None:
+                            _warm_start_stats = model.sdp_layer.warm_start_store.stats()
+                            logger.info(f"SDP warm starts: {_warm_start_stats}")
+                            wandb.log({f'sdp_warm_start_{k}': v for k, v in _warm_start_stats.items()})
 
                     # Get model performance on dev (or 'train' for overfitting runs)
                     _proc = fork_eval(target=dev_eval,
@@ -662,8 +770,23 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                                             split_name=f'best_test_{pairwise_clustering_fn_labels[i]}',
                                                             log_prefix='Final', verbose=True, logger=logger)
                     # Run all inference variants on the test set
-                    cc_inference_sdp = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp=True)
-                    cc_inference_nosdp = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp=False)
+                    cc_inference_sdp = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp=True,
+                                                   sdp_solver=sdp_solver, sdp_lowrank_rank=sdp_lowrank_rank,
+                                                   sdp_report_gap=sdp_report_gap, sdp_warm_start=sdp_warm_start,
+                                                   sdp_warm_start_mem_mb=sdp_warm_start_mem_mb,
+                                                   sdp_warm_start_dir=sdp_warm_start_dir, sdp_reduce=sdp_reduce,
+                                                   sdp_reduce_tol=sdp_reduce_tol,
+                                                   sdp_contraction_ratio=sdp_contraction_ratio,
+                                                   exact_max_size=exact_max_size,
+                                                   router=CCRouter(exact_max_size, router_sdp_max_size,
+                                                                   router_nosdp_max_size, router_time_budget),
+                                                   batch_round_max_size=batch_round_max_size,
+                                                   batch_round_size=batch_round_size, rounding=rounding,
+                                                   trellis_linkages=trellis_linkages)
+                    cc_inference_nosdp = CCInference(sdp_max_iters, sdp_eps, sdp_scale, use_sdp=False,
+                                                     batch_round_max_size=batch_round_max_size,
+                                                     batch_round_size=batch_round_size, rounding=rounding,
+                                                     trellis_linkages=trellis_linkages)
                     inference_fns = [HACInference(),
                                      cc_inference_sdp, cc_inference_sdp,
                                      cc_inference_nosdp, cc_inference_nosdp]
@@ -682,7 +805,9 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
                                                                               pairwise_mode=False, batch_size=1,
                                                                               split=['dev', 'test'],
                                                                               drop_feat_idxs=hyp["drop_feat_idxs"],
-                                                                              keep_feat_idxs=hyp["keep_feat_idxs"])
+                                                                              keep_feat_idxs=hyp["keep_feat_idxs"],
+                                                                              materialize=hyp["materialize_data"],
+                                                                              materialize_cache_dir=hyp["materialize_cache_dir"])
                     with torch.no_grad():
                         model.eval()
                         clustering_threshold = None
@@ -728,6 +853,10 @@ def train(hyperparams={}, verbose=False, project=None, entity=None, tags=None, g
         # Cleanup
         for filename in glob.glob(os.path.join(run.dir, "_temp_state_dict*")):
             os.remove(filename)
+        if sdp_warm_start and hyp["sdp_warm_start_dir"] is None:
+            shutil.rmtree(sdp_warm_start_dir, ignore_errors=True)
+        if sdp_pool is not None:
+            sdp_pool.close()
         logger.info(f"Run directory: {run.dir}")
         logger.info("End of train() call")
 
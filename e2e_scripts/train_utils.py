@@ -15,11 +15,16 @@ import torch
 import numpy as np
 import wandb
 from time import time
-from sklearn.preprocessing import StandardScaler
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SequentialSampler
+from torch.utils.data.dataloader import default_collate
+from e2e_pipeline.sdp_layer import CvxpyException
 from s2and.consts import PREPROCESSED_DATA_DIR
-from s2and.data import S2BlocksDataset
+from s2and.data import S2BlocksDataset, S2PairwiseStreamDataset, BlockBucketSampler, get_blockwise_scaler_stats, \
+    get_scaler_from_stats
+from s2and.block_store import BlockFeatureStore, get_block_store_path, get_source_fingerprint, \
+    has_current_block_store, is_block_store, load_block_metadata
 from s2and.eval import b3_precision_recall_fscore
+from utils.condensed_matrix import uncompress
 from torch import Tensor
 from torch.multiprocessing import Process
 
@@ -48,6 +53,14 @@ DEFAULT_HYPERPARAMS = {
     "normalize_data": True,
     "drop_feat_idxs": [],
     "keep_feat_idxs": [],
+    "materialize_data": False,  # Transform the features once into float32 tensors (see S2BlocksDataset.materialize)
+    "materialize_cache_dir": None,  # If set, materialized features are cached in memmap files in this directory
+    "bucket_ratio": None,  # e2e only; if set (e.g. 2.), sample train blocks in buckets of sizes [r^k, r^(k+1))
+    "shuffle_buckets": False,  # e2e only; shuffle the train blocks within buckets, and the accumulation steps
+    "dataloader_num_workers": 0,  # Processes loading the train blocks ahead of the training loop (0: none)
+    "dataloader_prefetch_factor": 2,  # Blocks prefetched by each dataloader worker
+    "stream_pairwise": False,  # Stream the pairwise/warm-start train pairs in batches, instead of stacking them
+    "pairwise_shuffle_buffer": 200000,  # Number of train pairs shuffled together when streaming (0: no shuffling)
     # Model config
     "neumiss_deq": False,
     "neumiss_depth": 20,
@@ -67,6 +80,27 @@ DEFAULT_HYPERPARAMS = {
     "sdp_max_iters": 50000,
     "sdp_eps": 1e-3,
     "sdp_scale": True,
+    "sdp_cache_size": 512,  # Max number of compiled SDP problems (one per block size) kept in memory
+    "sdp_solver": "scs",  # "scs", "lowrank"
+    "sdp_lowrank_rank": -1,  # lowrank only; rank of the SDP factorization (auto-selected if -1)
+    "sdp_report_gap": False,  # lowrank only; also solve with SCS during eval and log the objective gap
+    "sdp_warm_start": False,  # scs only; warm-start SCS with the previous solution of the same block
+    "sdp_warm_start_mem_mb": 1024,  # Memory budget of the warm-start store; older entries are spilled to disk
+    "sdp_warm_start_dir": None,  # Spill directory of the warm-start store (a temporary directory if None)
+    "sdp_reduce": False,  # Split into positive-edge components and contract strong edges before solving the SDP
+    # (in training, the cross-component and contracted entries of X are then constants, with no gradient)
+    "sdp_reduce_tol": 0.,  # Positive edges with weight <= tol are ignored when splitting into components
+    "sdp_contraction_ratio": 1.,  # Contract edges with weight >= ratio * (other incident |weights|); inf disables
+    "sdp_pool_workers": 0,  # e2e scs only; solve the SDPs of groups of training blocks on a pool of processes
+    "sdp_pool_batch_size": 32,  # Max number of blocks per group sent to the SDP worker pool
+    "exact_max_size": 10,  # Inference only; blocks of up to this size are clustered exactly (0 disables; max 10)
+    "router_sdp_max_size": -1,  # CC inference only; blocks larger than this skip the SDP (-1: no limit)
+    "router_nosdp_max_size": -1,  # CC inference only; blocks larger than this skip HAC-cut for higra HAC (-1: no limit)
+    "router_time_budget": None,  # CC inference only; per-block seconds; routes predicted to exceed it are skipped
+    "batch_round_max_size": 20,  # Inference only; blocks up to this size are rounded in batches (0 disables)
+    "batch_round_size": 256,  # Max number of blocks per batched rounding call
+    "rounding": "hac",  # {'hac', 'trellis'}: HAC-cut, or cut of a trellis of several HAC trees (slower, better cuts)
+    "trellis_linkages": None,  # List of linkages of the trellis trees (see ecc.trellis.LINKAGES); None: all
     # Training config
     "batch_size": 8000,  # pairwise only; used by e2e if gradient_accumulation is true
     "lr": 1e-3,
@@ -89,6 +123,12 @@ DEFAULT_HYPERPARAMS = {
 
 
 def read_blockwise_features(pkl):
+    # Memory-mapped block store (see s2and/block_store.py) if there is one next to the pickle, unless it is outdated
+    store_path = get_block_store_path(pkl)
+    if has_current_block_store(pkl):
+        return BlockFeatureStore(store_path)
+    if is_block_store(store_path):
+        logger.warning(f"Ignoring block store {store_path}: older than {pkl}")
     blockwise_data: Dict[str, Tuple[np.ndarray, np.ndarray]]
     with open(pkl, "rb") as _pkl_file:
         blockwise_data = pickle.load(_pkl_file)
@@ -101,8 +141,56 @@ def _get_feat_idxs(_n_features, _keep_feat_idxs, _drop_feat_idxs):
     return np.array(list(_keep - _drop))
 
 
+def get_scaler_stats(pkl, read_fn=None):
+    """
+    Per-feature statistics of a split (see s2and.data.get_blockwise_scaler_stats), read from the sidecar file next
+    to the split (<split>_scaler_stats.npz) if it is up to date, or computed in one pass over the blocks (of the
+    split returned by read_fn, if given) and saved to it otherwise
+    """
+    stats_path = pkl.replace("_features.pkl", "_scaler_stats.npz")
+    fingerprint = get_source_fingerprint(pkl)
+    if os.path.isfile(stats_path):
+        with np.load(stats_path) as _stats:
+            stats = dict(_stats)
+        if np.array_equal(stats.pop('source_fingerprint'), fingerprint):
+            return stats
+    stats = get_blockwise_scaler_stats(read_fn() if read_fn is not None else read_blockwise_features(pkl))
+    try:
+        np.savez(stats_path, source_fingerprint=fingerprint, **stats)
+    except OSError as e:
+        logger.warning(f"Could not save the feature statistics to {stats_path}: {e}")
+    return stats
+
+
+def _collate_block(batch):
+    # default_collate, without copying the (materialized) feature tensors of single-block batches
+    if len(batch) == 1 and torch.is_tensor(batch[0][0]):
+        return (batch[0][0].unsqueeze(0), batch[0][1].unsqueeze(0)) + tuple(default_collate([batch[0][2:]]))
+    return default_collate(batch)
+
+
+def _collate_block_tensors(batch):
+    """
+    Collates a single block into (X, y, cluster_ids, N): float32 tensors of size [n_pairs, f] and [n_pairs,] (no copy
+    for materialized blocks), the list of cluster ids and the block size
+    """
+    if len(batch) != 1:
+        raise ValueError("Blocks of different sizes cannot be collated together; use one block per batch")
+    X, y, cluster_ids = batch[0]
+    return (torch.as_tensor(X, dtype=torch.float32), torch.as_tensor(y, dtype=torch.float32).reshape(-1),
+            list(cluster_ids), len(cluster_ids))
+
+
 def get_dataloaders(dataset, dataset_seed, convert_nan, nan_value, normalize, subsample_sz_train, subsample_sz_dev,
-                    pairwise_mode, batch_size, shuffle=False, split=None, drop_feat_idxs=[], keep_feat_idxs=[]):
+                    pairwise_mode, batch_size, shuffle=False, split=None, drop_feat_idxs=[], keep_feat_idxs=[],
+                    materialize=False, materialize_cache_dir=None, pair_budget=1, bucket_ratio=None, min_block_pairs=1,
+                    num_workers=0, prefetch_factor=2, pin_memory=False, stream_pairwise=False, shuffle_buffer_size=0):
+    """
+    In blockwise mode, the train split is sampled by a BlockBucketSampler (with pair_budget, bucket_ratio, shuffle and
+    min_block_pairs) and yields (X, y, cluster_ids, N) batches; the dev and test splits yield the blocks in
+    descending size order. In pairwise mode with stream_pairwise, the train split is an S2PairwiseStreamDataset (with
+    shuffle_buffer_size; not materialized). The train split is loaded by num_workers worker processes, if > 0
+    """
     pickle_path = {
         'train': f"{PREPROCESSED_DATA_DIR}/{dataset}/seed{dataset_seed}/train_features.pkl",
         'dev': f"{PREPROCESSED_DATA_DIR}/{dataset}/seed{dataset_seed}/val_features.pkl",
@@ -113,26 +201,59 @@ def get_dataloaders(dataset, dataset_seed, convert_nan, nan_value, normalize, su
         'dev': subsample_sz_dev,
         'test': -1
     }
-    train_scaler = StandardScaler()
-    train_X = np.concatenate(list(map(lambda x: x[0], read_blockwise_features(pickle_path['train']).values())))
-    train_scaler.fit(train_X)
+    block_dicts = {}  # Each split is read at most once
+
+    def _read_split(_split):
+        if _split not in block_dicts:
+            block_dicts[_split] = read_blockwise_features(pickle_path[_split])
+        return block_dicts[_split]
+
+    # The train split is only read here if its statistics are not saved yet (and then only once)
+    splits = ['train', 'dev', 'test'] if split is None else [split] if type(split) is str else split
+    train_stats = get_scaler_stats(pickle_path['train'],
+                                   read_fn=(lambda: _read_split('train')) if 'train' in splits else None)
     # Additionally drop features that are all nan's at training
-    all_nan_idxs = list(np.where(train_scaler.n_samples_seen_ == 0)[0]) \
-        if type(train_scaler.n_samples_seen_) == np.ndarray else []
+    all_nan_idxs = list(np.where(train_stats['n_samples_seen'] == 0)[0])
     if len(all_nan_idxs) > 0:
         logger.info(f"Dropped {len(all_nan_idxs)} all NaN features: {all_nan_idxs}")
-    feat_idxs = _get_feat_idxs(train_X.shape[1], keep_feat_idxs, drop_feat_idxs + all_nan_idxs)
-    if len(feat_idxs) != train_X.shape[1]:
-        train_scaler.fit(train_X[:, feat_idxs])
-
+    feat_idxs = _get_feat_idxs(len(train_stats['mean']), keep_feat_idxs, drop_feat_idxs + all_nan_idxs)
+    train_scaler = get_scaler_from_stats(train_stats, feat_idxs)
 
     def _get_dataloader(_split):
-        dataset = S2BlocksDataset(read_blockwise_features(pickle_path[_split]), convert_nan=convert_nan,
+        loader_kwargs = {}
+        if _split == 'train' and num_workers > 0:
+            # Forked workers share the (memory-mapped or materialized) blocks of the parent process
+            loader_kwargs = dict(num_workers=num_workers, prefetch_factor=prefetch_factor,
+                                 multiprocessing_context='fork', pin_memory=pin_memory)
+        if _split == 'train' and pairwise_mode and stream_pairwise:
+            label_stats = None
+            if subsample_sz[_split] == -1:
+                # All pairs are streamed: their labels are counted in the metadata of the split
+                metadata = load_block_metadata(pickle_path[_split], read_fn=lambda: _read_split(_split))
+                label_stats = {'n_pairs': int(metadata['block_n_pairs'].sum()),
+                               'n_pos': int(metadata['block_n_pos'].sum())}
+            dataset = S2PairwiseStreamDataset(_read_split(_split), batch_size, convert_nan=convert_nan,
+                                              nan_value=nan_value, scale=normalize, scaler=train_scaler,
+                                              subsample_sz=subsample_sz[_split], feat_idxs=feat_idxs,
+                                              buffer_size=shuffle_buffer_size, label_stats=label_stats)
+            return DataLoader(dataset, batch_size=None, **loader_kwargs)
+        dataset = S2BlocksDataset(_read_split(_split), convert_nan=convert_nan,
                                   nan_value=nan_value, scale=normalize, scaler=train_scaler,
                                   subsample_sz=subsample_sz[_split],
                                   pairwise_mode=pairwise_mode, sort_desc=(_split in ['dev', 'test']),
                                   feat_idxs=feat_idxs)
-        dataloader = DataLoader(dataset, shuffle=shuffle, batch_size=batch_size)
+        if materialize:
+            dataset.materialize(cache_dir=materialize_cache_dir,
+                                source_key=(pickle_path[_split], get_source_fingerprint(pickle_path[_split]).tolist(),
+                                            subsample_sz[_split]))
+        if _split == 'train' and not pairwise_mode:
+            sampler = BlockBucketSampler(dataset, pair_budget=pair_budget, bucket_ratio=bucket_ratio, shuffle=shuffle,
+                                         min_pairs=min_block_pairs)
+            return DataLoader(dataset, sampler=sampler, batch_size=1, collate_fn=_collate_block_tensors,
+                              **loader_kwargs)
+        dataloader = DataLoader(dataset, shuffle=shuffle, batch_size=batch_size,
+                                collate_fn=_collate_block if materialize and not pairwise_mode else None,
+                                **loader_kwargs)
         return dataloader
 
     if split is None:
@@ -146,20 +267,15 @@ def get_dataloaders(dataset, dataset_seed, convert_nan, nan_value, normalize, su
 
 def get_feature_count(dataset, dataset_seed):
     data_fpath = f"{PREPROCESSED_DATA_DIR}/{dataset}/seed{dataset_seed}/test_features.pkl"
-    block_dict = read_blockwise_features(data_fpath)
-    return next(iter(block_dict.values()))[0].shape[1]
+    return int(load_block_metadata(data_fpath, read_fn=lambda: read_blockwise_features(data_fpath))['n_features'])
 
 
 def uncompress_target_tensor(compressed_targets, make_symmetric=True, device=None):
     device = device if device is not None else torch.device("cuda" if torch.cuda.is_available() else "cpu")
     n = round(math.sqrt(2 * compressed_targets.size(dim=0))) + 1
     # Convert the 1D pairwise-similarities list to nxn upper triangular matrix
-    ind0, ind1 = torch.triu_indices(n, n, offset=1)
-    target = torch.eye(n, device=device)
-    target[ind0, ind1] = compressed_targets
-    if make_symmetric:
-        target[ind1, ind0] = compressed_targets
-    return target
+    return uncompress(compressed_targets.to(device=device, dtype=torch.get_default_dtype()), n,
+                      make_symmetric=make_symmetric, ones_diagonal=True)
 
 
 # Count parameters in the model
@@ -170,6 +286,80 @@ def get_matrix_size_from_triu(triu):
     return round(math.sqrt(2 * len(triu))) + 1
 
 
+def get_block_id(dataloader, batch_idx):
+    """
+    Returns the id of the block at batch_idx of a blockwise dataloader (in the current epoch), or None if it cannot be
+    identified (randomly sampled or batched loaders, pairwise datasets)
+    """
+    if isinstance(dataloader.sampler, BlockBucketSampler):
+        idx = dataloader.sampler.order[batch_idx]
+    elif isinstance(dataloader.sampler, SequentialSampler) and dataloader.batch_size == 1:
+        idx = batch_idx
+    else:
+        return None
+    blockwise_ids = getattr(dataloader.dataset, 'blockwise_ids', None)
+    return blockwise_ids[idx] if blockwise_ids is not None else None
+
+
+def train_pooled_group(model, group, sdp_pool, loss_fn, e2e_loss, pos_weight, device, verbose):
+    """
+    Forward and backward pass (without the optimizer step) for a group of blocks, with all of their SDPs solved
+    on sdp_pool. group is a list of (data, target, block_size, block_id, grad_acc_denom) tuples, where
+    grad_acc_denom is the number of blocks of the accumulation step of the block. Returns the per-block losses
+    """
+    outputs = model.forward_batch([g[0] for g in group], [g[2] for g in group], sdp_pool, verbose=verbose,
+                                  block_ids=[g[3] for g in group])
+    losses = []
+    for output, (_, target, _, _, grad_acc_denom) in zip(outputs, group):
+        if e2e_loss != "bce":
+            target = uncompress_target_tensor(target, device=device)
+        if pos_weight is not None:
+            loss_fn.weight = target * pos_weight + (1 - target)
+        losses.append(loss_fn(output.view_as(target), target) / grad_acc_denom)
+    torch.stack(losses).sum().backward()
+    return [loss.item() for loss in losses]
+
+
+def try_train_pooled_group(model, group, sdp_pool, loss_fn, e2e_loss, pos_weight, device, verbose, debug, _errors,
+                           run_dir, logger, epoch_idx, batch_idx):
+    """
+    train_pooled_group, with a CvxpyException recorded (see record_train_error) and re-raised, or, in debug mode,
+    with the group skipped. Returns the per-block losses, or None if the group was skipped
+    """
+    try:
+        return train_pooled_group(model, group, sdp_pool, loss_fn, e2e_loss, pos_weight, device, verbose)
+    except CvxpyException as e:
+        logger.info(e)
+        _error_obj = record_train_error(_errors, run_dir, logger, 'tp', 'train_pooled', epoch_idx, batch_idx, 'e2e',
+                                        {'block_sizes': [g[2] for g in group]}, cvxpy_layer_args=e.data)
+        if not debug:
+            raise CvxpyException(data=_error_obj)
+        return None
+
+
+def record_train_error(_errors, run_dir, logger, id_prefix, method, epoch_idx, batch_idx, model_type,
+                       model_call_args, cvxpy_layer_args=None):
+    """
+    Builds the error object of a failed training call and, if _errors is a list, appends it and saves the list
+    to the errors.json file of the run. Returns the error object
+    """
+    _error_obj = {
+        'id': f'{id_prefix}_{int(time())}',
+        'epoch_idx': epoch_idx,
+        'batch_idx': batch_idx,
+        'method': method,
+        'model_type': model_type,
+        'data_split': 'train',
+        'model_call_args': model_call_args
+    }
+    if cvxpy_layer_args is not None:
+        _error_obj['cvxpy_layer_args'] = cvxpy_layer_args
+    if _errors is not None:
+        _errors.append(_error_obj)
+        save_to_wandb_run({'errors': _errors}, 'errors.json', run_dir, logger)
+    return _error_obj
+
+
 def compute_b3_f1(true_cluster_ids, pred_cluster_ids):
     """
     Compute the B^3 variant of precision, recall and F-score.
@@ -205,6 +395,24 @@ def log_cc_objective_values(scores, split_name, log_prefix, verbose, logger, plo
                f'{split_name}_obj_round': total_round_obj,
                f'{split_name}_obj_ratio': mean_approx_ratio})
 
+    # Gap between the low-rank and the SCS SDP objectives (only recorded with sdp_solver="lowrank")
+    if len(scores[2].get('sdp_gap', [])) > 0:
+        mean_sdp_gap = np.mean(scores[2]['sdp_gap'])
+        max_sdp_gap = np.max(scores[2]['sdp_gap'])
+        if verbose:
+            logger.info(f"{log_prefix}: {split_name}_obj_sdp_gap_mean={mean_sdp_gap}, " +
+                        f"{split_name}_obj_sdp_gap_max={max_sdp_gap}")
+        wandb.log({f'{split_name}_obj_sdp_gap_mean': mean_sdp_gap,
+                   f'{split_name}_obj_sdp_gap_max': max_sdp_gap})
+
+    # Number of blocks that took each inference route (CCInference only)
+    if len(scores[2].get('routes', [])) > 0:
+        route_counts = {f'{split_name}_route_{route}': n for route, n in
+                        zip(*np.unique(scores[2]['routes'], return_counts=True))}
+        if verbose:
+            logger.info(f"{log_prefix}: {route_counts}")
+        wandb.log({k: int(v) for k, v in route_counts.items()})
+
     # TODO: Implement plotting the approx. ratio v/s block sizes
 
 
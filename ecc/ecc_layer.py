@@ -29,6 +29,7 @@ from sklearn.metrics import adjusted_rand_score as rand_idx
 from sklearn.metrics import homogeneity_completeness_v_measure as cluster_f1
 
 from ecc.trellis import Trellis
+from utils.trellis_helper_fns import cut_trellis
 
 
 def cluster_labels_to_matrix(labels):
@@ -97,6 +98,15 @@ class EccClusterer(object):
         self.ecc_mx = None
         self.incompat_mx = None
 
+        # incremental constraint bookkeeping (see `add_constraint`)
+        self._csr_features = csr_matrix(self.features)
+        self._bin_features = self.features.astype(bool).tocsc()
+        self._incompat_buf = np.zeros(
+                (self.num_points+self.max_num_ecc, self.max_num_ecc),
+                dtype=bool)
+        self._pos_feats_points = []
+        self._var_vals = {}
+
         n = self.num_points + self.max_num_ecc
 
         # formulate SDP
@@ -144,72 +154,84 @@ class EccClusterer(object):
         self.rounding_layer = TrellisCutLayer(ecc_clusterer_obj=self)
 
     def add_constraint(self, ecc_constraint: csr_matrix):
+        # Only the new constraint's bookkeeping is computed: a column and a
+        # row of `incompat_mx`, the points satisfying each of its positive
+        # features, and its incompatibilities with the previous constraints
+        ecc_constraint = csr_matrix(ecc_constraint)
+        new_ecc_idx = self.num_ecc
         self.ecc_constraints.append(ecc_constraint)
-        self.ecc_mx = sp_vstack(self.ecc_constraints)
+        self.ecc_mx = (ecc_constraint if self.ecc_mx is None
+                       else sp_vstack([self.ecc_mx, ecc_constraint],
+                                      format='csr'))
         self.num_ecc += 1
+        active_n = self.num_points + self.num_ecc
 
         # "negative" sdp constraints
-        uni_feats = sp_vstack([self.features, self.ecc_mx])
-        self.incompat_mx = np.zeros(
-                (self.num_points+self.num_ecc, self.num_ecc), dtype=bool)
-        self._set_incompat_mx(self.num_points+self.num_ecc,
-                              self.num_ecc,
-                              uni_feats.indptr,
-                              uni_feats.indices,
-                              uni_feats.data,
+        self.incompat_mx = self._incompat_buf[:active_n, :self.num_ecc]
+        new_incompat = np.zeros((active_n, 1), dtype=bool)
+        self._set_incompat_mx(self.num_points,
+                              1,
+                              self._csr_features.indptr,
+                              self._csr_features.indices,
+                              self._csr_features.data,
+                              ecc_constraint.indptr,
+                              ecc_constraint.indices,
+                              ecc_constraint.data,
+                              new_incompat[:self.num_points])
+        self._set_incompat_mx(self.num_ecc,
+                              1,
                               self.ecc_mx.indptr,
                               self.ecc_mx.indices,
                               self.ecc_mx.data,
-                              self.incompat_mx)
+                              ecc_constraint.indptr,
+                              ecc_constraint.indices,
+                              ecc_constraint.data,
+                              new_incompat[self.num_points:])
+        self.incompat_mx[:, new_ecc_idx] = new_incompat[:, 0]
+        self.incompat_mx[self.num_points+new_ecc_idx, :] = \
+                new_incompat[self.num_points:, 0]
 
         # "positive" sdp constraints
-        bin_features = self.features.astype(bool).tocsc()
-        pos_ecc_mx = (self.ecc_mx > 0)
-        (ecc_indices,
+        pos_ecc_mx = (ecc_constraint > 0)
+        (_,
          points_indptr,
          points_indices) = self._get_feat_satisfied_hyperplanes(
-                 bin_features.indptr,
-                 bin_features.indices,
+                 self._bin_features.indptr,
+                 self._bin_features.indices,
                  pos_ecc_mx.indptr,
                  pos_ecc_mx.indices,
-                 self.incompat_mx)
+                 new_incompat)
+        points_indices = np.array(points_indices, dtype=np.int64)
+        self._pos_feats_points.append([
+                points_indices[points_indptr[idx]:points_indptr[idx+1]]
+                    for idx in range(len(points_indptr)-1)
+        ])
 
         # if there is no way a single cluster can satisfy both constraints...
-        for idx, i in enumerate(ecc_indices):
-            pos_feats_points = points_indices[
-                    points_indptr[idx]:
-                    points_indptr[idx+1]
-            ]
-            for j in range(i+1, self.num_ecc):
-                all_pos_incompat = True
-                for l in pos_feats_points:
-                    if not self.incompat_mx[l, j]:
-                        all_pos_incompat = False
-                        break
-                if all_pos_incompat:
-                    self.incompat_mx[i, j] = True
-                    self.incompat_mx[j, i] = True
-
-        # update problem constraint parameters
-        active_U = self.U.value[:self.num_ecc, :self.num_points+self.num_ecc]
-        active_U[self.incompat_mx.T] = 0.0
-
-        self.var_vals = defaultdict(list)
-        pos_feat_idx = 0
-        curr_ecc_idx = 0
-        for ptr_idx, i in enumerate(ecc_indices):
-            if i != curr_ecc_idx:
-                pos_feat_idx = 0
-                curr_ecc_idx = i
-            start, end = points_indptr[ptr_idx], points_indptr[ptr_idx+1]
-            self.As[pos_feat_idx].value[:, i] = 0.0
-            for j in points_indices[start:end]:
-                self.As[pos_feat_idx].value[j, i] = 1.0
-                self.var_vals[(pos_feat_idx, i)].append(j)
-            pos_feat_idx += 1
+        for i in range(new_ecc_idx):
+            for pos_feats_points in self._pos_feats_points[i]:
+                if np.all(self.incompat_mx[pos_feats_points, new_ecc_idx]):
+                    self.incompat_mx[i, new_ecc_idx] = True
+                    self.incompat_mx[new_ecc_idx, i] = True
+
+        # # update problem constraint parameters (only the entries of the new
+        # # column and rows of `incompat_mx` can have changed)
+        # active_U = self.U.value[:self.num_ecc, :active_n]
+        # active_U[new_ecc_idx, self.incompat_mx[:, new_ecc_idx]] = 0.0
+        # active_U[self.incompat_mx[self.num_points+new_ecc_idx, :],
+        #          self.num_points+new_ecc_idx] = 0.0
+        # active_U[self.incompat_mx[new_ecc_idx, :], new_ecc_idx] = 0.0
+
+        for pos_feat_idx, pos_feats_points in enumerate(
+                self._pos_feats_points[new_ecc_idx]):
+            # self.As[pos_feat_idx].value[:, new_ecc_idx] = 0.0
+            # self.As[pos_feat_idx].value[pos_feats_points, new_ecc_idx] = 1.0
+            if pos_feats_points.size > 0:
+                self._var_vals[(pos_feat_idx, new_ecc_idx)] = \
+                        pos_feats_points.tolist()
 
         self.var_vals = dict(
-                sorted(self.var_vals.items(), key=lambda x: len(x[1]))
+                sorted(self._var_vals.items(), key=lambda x: len(x[1]))
         )
 
     @staticmethod
@@ -329,11 +351,11 @@ class EccClusterer(object):
 
         if self.incompat_mx is not None:
             # discourage incompatible nodes from clustering together
-            self.incompat_mx = np.concatenate(
+            incompat_mx = np.concatenate(
                     (np.zeros((active_n, self.num_points), dtype=bool),
                      self.incompat_mx), axis=1
             )
-            pw_probs[self.incompat_mx] -= np.sum(pw_probs)
+            pw_probs[incompat_mx] -= np.sum(pw_probs)
 
         # pw_probs = np.triu(pw_probs, k=1)
         # pw_probs.retain_grad()  # debug: view the backward pass result
@@ -345,107 +367,13 @@ class EccClusterer(object):
         t.fit(only_avg_hac=only_avg_hac)
         return t
 
-    def get_intra_cluster_energy(self, leaves: np.ndarray):
-        row_mask = np.isin(self.edge_weights.row, leaves)
-        col_mask = np.isin(self.edge_weights.col, leaves)
-        data_mask = row_mask & col_mask
-        return np.sum(self.edge_weights.data[data_mask])
-
-    def get_num_ecc_sat(self, leaves: np.ndarray, num_points: int):
-        point_leaves = leaves[leaves < num_points]
-        ecc_indices = leaves[leaves >= num_points] - num_points
-        if ecc_indices.squeeze().size == 0:
-            return 0
-        feats = get_cluster_feats(self.features[point_leaves])
-        ecc_avail = self.ecc_mx[ecc_indices]
-        to_satisfy = (ecc_avail > 0).sum(axis=1)
-        num_ecc_sat = ((feats @ ecc_avail.T).T == to_satisfy).sum()
-        return num_ecc_sat
-
-    @staticmethod
-    @nb.njit(parallel=True)
-    def get_membership_data(indptr: np.ndarray,
-                            indices: np.ndarray):
-        data = np.empty(indices.shape, dtype=np.int64)
-        for i in nb.prange(indptr.size-1):
-            for j in nb.prange(indptr[i], indptr[i+1]):
-                data[j] = i
-        return data
-
-    @staticmethod
-    @nb.njit
-    def merge_memberships(lchild_indices: np.ndarray,
-                          lchild_data: np.ndarray,
-                          rchild_indices: np.ndarray,
-                          rchild_data: np.ndarray,
-                          parent_indices: np.ndarray,
-                          parent_data: np.ndarray):
-        assert lchild_indices.size == lchild_data.size
-        assert rchild_indices.size == rchild_data.size
-        assert parent_indices.size == parent_data.size
-        assert (lchild_data.size + rchild_data.size) == parent_data.size
-        lchild_ptr = 0
-        rchild_ptr = 0
-        for i in range(parent_data.size):
-            if (rchild_ptr == rchild_indices.size or
-                    (lchild_ptr < lchild_indices.size and
-                     lchild_indices[lchild_ptr] < rchild_indices[rchild_ptr])):
-                assert parent_indices[i] == lchild_indices[lchild_ptr]
-                parent_data[i] = lchild_data[lchild_ptr]
-                lchild_ptr += 1
-            else:
-                assert parent_indices[i] == rchild_indices[rchild_ptr]
-                assert (lchild_ptr == lchild_indices.size
-                        or lchild_indices[lchild_ptr] != rchild_indices[rchild_ptr])
-                parent_data[i] = rchild_data[rchild_ptr]
-                rchild_ptr += 1
-
     def cut_trellis(self, t: Trellis):
-        membership_indptr = t.leaves_indptr
-        membership_indices = t.leaves_indices
-        membership_data = self.get_membership_data(membership_indptr,
-                                                   membership_indices)
-        obj_vals = np.zeros((t.num_nodes,))
-        num_ecc_sat = np.zeros((t.num_nodes,))
-
-        for node in t.internal_nodes_topo_ordered():
-            node_start = membership_indptr[node]
-            node_end = membership_indptr[node+1]
-            leaves = membership_indices[node_start:node_end]
-            if self.num_ecc > 0:
-                num_ecc_sat[node] = self.get_num_ecc_sat(
-                        leaves, self.num_points)
-            obj_vals[node] = self.get_intra_cluster_energy(leaves)
-            for lchild, rchild in t.get_child_pairs_iter(node):
-                cpair_num_ecc_sat = num_ecc_sat[lchild] + num_ecc_sat[rchild]
-                cpair_obj_val = obj_vals[lchild] + obj_vals[rchild]
-                if (num_ecc_sat[node] < cpair_num_ecc_sat 
-                    or (num_ecc_sat[node] == cpair_num_ecc_sat
-                        and obj_vals[node] < cpair_obj_val)):
-                    num_ecc_sat[node] = cpair_num_ecc_sat
-                    obj_vals[node] = cpair_obj_val
-                    lchild_start = membership_indptr[lchild]
-                    lchild_end = membership_indptr[lchild+1]
-                    rchild_start = membership_indptr[rchild]
-                    rchild_end = membership_indptr[rchild+1]
-                    self.merge_memberships(
-                            membership_indices[lchild_start:lchild_end],
-                            membership_data[lchild_start:lchild_end],
-                            membership_indices[rchild_start:rchild_end],
-                            membership_data[rchild_start:rchild_end],
-                            membership_indices[node_start:node_end],
-                            membership_data[node_start:node_end],
-                    )
-
-        # The value of `node` is the root since we iterate over the trellis
-        # nodes in topological order bottom up. Moreover, the values of
-        # `node_start` and `node_end` also correspond to the root of the
-        # trellis.
-        best_clustering = membership_data[node_start:node_end]
+        best_clustering, obj_val, num_ecc_sat = cut_trellis(
+                t, self.edge_weights, self.features, self.ecc_mx)
         if self.num_ecc > 0:
             best_clustering = best_clustering[:-self.num_ecc]
 
-        return best_clustering, obj_vals[node], num_ecc_sat[node]
+        return best_clustering, obj_val, num_ecc_sat
 
     def pred(self, only_avg_hac: bool = False):
         num_ecc = len(self.ecc_constraints)
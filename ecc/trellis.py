@@ -1,38 +1,57 @@
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+import os
 
 import higra as hg
 import numba as nb
 import numpy as np
 
 
+# Linkages of the HAC trees merged into the trellis
+LINKAGES = {
+    'average': hg.binary_partition_tree_average_linkage,
+    'single': hg.binary_partition_tree_single_linkage,
+    'complete': hg.binary_partition_tree_complete_linkage,
+    'exponential_neg': lambda g, dists: hg.binary_partition_tree_exponential_linkage(g, dists, -1.0),
+    'exponential_pos': lambda g, dists: hg.binary_partition_tree_exponential_linkage(g, dists, 1.0),
+}
+
+
+@nb.njit
+def _leaf_hash(leaf: int) -> np.uint64:
+    # splitmix64 of the leaf index; the hash of a leaf set is the (wrapping) sum of its leaf hashes
+    z = np.uint64(leaf) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
 @nb.njit
-def get_trellis_node_id(
-        leaves_indptr: np.ndarray,
-        leaves_indices: np.ndarray,
-        new_leaves: np.ndarray
-    ) -> Tuple[np.int64, np.ndarray, np.ndarray]:
-    num_trellis_nodes = leaves_indptr.size - 1
-    num_new_leaves = new_leaves.size
-    node_id = -1
-    for i in range(num_trellis_nodes):
-        ptr = leaves_indptr[i]
-        next_ptr = leaves_indptr[i+1]
-        if (next_ptr - ptr) == num_new_leaves:
+def _grow(arr: np.ndarray, min_size: int) -> np.ndarray:
+    # Amortized (doubling) growth of a buffer
+    if arr.size >= min_size:
+        return arr
+    new_arr = np.empty(max(2 * arr.size, min_size), dtype=arr.dtype)
+    new_arr[:arr.size] = arr
+    return new_arr
+
+
+@nb.njit
+def _find_trellis_node(node_index, node_next, node_hash: np.uint64, leaves_indptr: np.ndarray,
+                       leaves_indices: np.ndarray, leaves: np.ndarray) -> np.int64:
+    # Returns the id of the trellis node with exactly these (sorted) leaves, or -1
+    node_id = node_index[node_hash] if node_hash in node_index else -1
+    while node_id != -1:
+        ptr = leaves_indptr[node_id]
+        if leaves_indptr[node_id + 1] - ptr == leaves.size:
             match = True
-            for idx, j in enumerate(range(ptr, next_ptr)):
-                if leaves_indices[j] != new_leaves[idx]:
+            for i in range(leaves.size):
+                if leaves_indices[ptr + i] != leaves[i]:
                     match = False
                     break
             if match:
-                node_id = i
-                break
-    if node_id == -1:
-        # node does not exist yet; create new trellis node in `leaves_*`
-        node_id = num_trellis_nodes
-        leaves_indptr = np.append(
-                leaves_indptr, leaves_indptr[-1] + num_new_leaves)
-        leaves_indices = np.append(leaves_indices, new_leaves)
-    return node_id, leaves_indptr, leaves_indices
+                return node_id
+        node_id = node_next[node_id]
+    return -1
 
 
 @nb.njit
@@ -40,111 +59,146 @@ def build_trellis_from_trees(trees: np.ndarray):
     num_trees = trees.shape[0]
     num_tree_nodes = trees.shape[1]
     num_leaves = (num_tree_nodes + 1) // 2
+
+    # Trellis nodes, in CSR form over their sorted leaves (buffers grow by doubling)
+    num_trellis_nodes = num_leaves
     leaves_indptr = np.arange(num_leaves+1, dtype=np.int64)
     leaves_indices = np.arange(num_leaves, dtype=np.int64)
-    child_pairs_indptr = np.zeros((num_leaves+1,), dtype=np.int64)
-    child_pairs_indices = np.empty((0,), dtype=np.int64)
-    curr_leaves_mask = np.empty((num_leaves,), dtype=np.bool_)
-    lchild_leaves_mask = np.empty((num_leaves,), dtype=np.bool_)
-    rchild_leaves_mask = np.empty((num_leaves,), dtype=np.bool_)
+    # Hashed index of the nodes by leaf set; nodes with the same hash are chained through node_next
+    node_index = nb.typed.Dict.empty(key_type=nb.types.uint64, value_type=nb.types.int64)
+    node_hashes = np.empty(num_leaves, dtype=np.uint64)
+    node_next = np.full(num_leaves, -1, dtype=np.int64)
+    for i in range(num_leaves):
+        node_hashes[i] = _leaf_hash(i)
+        node_next[i] = node_index[node_hashes[i]] if node_hashes[i] in node_index else -1
+        node_index[node_hashes[i]] = i
+    # Child pairs of each node, as linked lists in insertion order
+    num_pairs = 0
+    pairs = np.empty((num_leaves, 2), dtype=np.int64)
+    pair_next = np.empty(num_leaves, dtype=np.int64)
+    first_pair = np.full(num_leaves, -1, dtype=np.int64)
+    last_pair = np.full(num_leaves, -1, dtype=np.int64)
+
+    children = np.empty((num_tree_nodes, 2), dtype=np.int64)
+    num_children = np.empty(num_tree_nodes, dtype=np.int64)
+    tree_to_trellis = np.empty(num_tree_nodes, dtype=np.int64)
+    curr_leaves_buffer = np.empty(num_leaves, dtype=np.int64)
 
     for b in range(num_trees):
-        membership = np.arange(num_leaves)
+        # Children of every tree node in one pass over the parents array (the root is its own parent)
+        num_children[:] = 0
+        for node in range(num_tree_nodes):
+            parent = trees[b, node]
+            if parent != node:
+                children[parent, num_children[parent]] = node
+                num_children[parent] += 1
+        tree_to_trellis[:num_leaves] = np.arange(num_leaves)
         for curr in range(num_leaves, num_tree_nodes):
-            child_mask = (trees[b] == curr)
-            children = np.where(child_mask)[0]
-            for i in range(num_leaves):
-                if membership[i] == children[0]:
-                    lchild_leaves_mask[i] = True
-                    rchild_leaves_mask[i] = False
-                    curr_leaves_mask[i] = True
-                elif membership[i] == children[1]:
-                    lchild_leaves_mask[i] = False
-                    rchild_leaves_mask[i] = True
-                    curr_leaves_mask[i] = True
+            lchild_node_id = tree_to_trellis[children[curr, 0]]
+            rchild_node_id = tree_to_trellis[children[curr, 1]]
+
+            # Sorted leaves of the node, merged from the sorted leaves of its children
+            l_ptr, l_end = leaves_indptr[lchild_node_id], leaves_indptr[lchild_node_id + 1]
+            r_ptr, r_end = leaves_indptr[rchild_node_id], leaves_indptr[rchild_node_id + 1]
+            num_curr_leaves = (l_end - l_ptr) + (r_end - r_ptr)
+            for i in range(num_curr_leaves):
+                if r_ptr == r_end or (l_ptr < l_end and leaves_indices[l_ptr] < leaves_indices[r_ptr]):
+                    curr_leaves_buffer[i] = leaves_indices[l_ptr]
+                    l_ptr += 1
                 else:
-                    lchild_leaves_mask[i] = False
-                    rchild_leaves_mask[i] = False
-                    curr_leaves_mask[i] = False
-
-            membership[curr_leaves_mask] = curr
-
-            curr_leaves = np.where(curr_leaves_mask)[0]
-            lchild_leaves = np.where(lchild_leaves_mask)[0]
-            rchild_leaves = np.where(rchild_leaves_mask)[0]
-
-            prev_num_trellis_nodes = leaves_indptr.size - 1
-            (lchild_node_id,
-             leaves_indptr,
-             leaves_indices) = get_trellis_node_id(
-                    leaves_indptr, leaves_indices, lchild_leaves)
-            (rchild_node_id,
-             leaves_indptr,
-             leaves_indices) = get_trellis_node_id(
-                    leaves_indptr, leaves_indices, rchild_leaves)
-            assert lchild_node_id < prev_num_trellis_nodes
-            assert rchild_node_id < prev_num_trellis_nodes
-
-            (curr_node_id,
-             leaves_indptr,
-             leaves_indices) = get_trellis_node_id(
-                    leaves_indptr, leaves_indices, curr_leaves)
-            assert curr_node_id <= prev_num_trellis_nodes
-
-            if curr_node_id == prev_num_trellis_nodes:
-                child_pairs_indptr = np.append(
-                        child_pairs_indptr, child_pairs_indptr[-1]+2)
-                child_pairs_indices = np.append(
-                        child_pairs_indices,
-                        [lchild_node_id, rchild_node_id])
+                    curr_leaves_buffer[i] = leaves_indices[r_ptr]
+                    r_ptr += 1
+            curr_leaves = curr_leaves_buffer[:num_curr_leaves]
+
+            curr_hash = node_hashes[lchild_node_id] + node_hashes[rchild_node_id]
+            curr_node_id = _find_trellis_node(node_index, node_next, curr_hash, leaves_indptr, leaves_indices,
+                                              curr_leaves)
+            if curr_node_id == -1:
+                # node does not exist yet; create new trellis node
+                curr_node_id = num_trellis_nodes
+                num_trellis_nodes += 1
+                ptr = leaves_indptr[curr_node_id]
+                leaves_indptr = _grow(leaves_indptr, num_trellis_nodes + 1)
+                leaves_indptr[num_trellis_nodes] = ptr + curr_leaves.size
+                leaves_indices = _grow(leaves_indices, ptr + curr_leaves.size)
+                leaves_indices[ptr:ptr + curr_leaves.size] = curr_leaves
+                node_hashes = _grow(node_hashes, num_trellis_nodes)
+                node_next = _grow(node_next, num_trellis_nodes)
+                first_pair = _grow(first_pair, num_trellis_nodes)
+                last_pair = _grow(last_pair, num_trellis_nodes)
+                node_hashes[curr_node_id] = curr_hash
+                node_next[curr_node_id] = node_index[curr_hash] if curr_hash in node_index else -1
+                node_index[curr_hash] = curr_node_id
+                tree_to_trellis[curr] = curr_node_id
+                first_pair[curr_node_id] = -1
+                last_pair[curr_node_id] = -1
+                new_pair = (lchild_node_id, rchild_node_id)
             else:
-                ptr = child_pairs_indptr[curr_node_id]
-                next_ptr = child_pairs_indptr[curr_node_id+1]
+                tree_to_trellis[curr] = curr_node_id
                 already_exists = False
-                for i in range(ptr, next_ptr, 2):
-                    if child_pairs_indices[i] == lchild_node_id:
-                        assert child_pairs_indices[i+1] == rchild_node_id
+                pair_id = first_pair[curr_node_id]
+                while pair_id != -1:
+                    if pairs[pair_id, 0] == lchild_node_id:
+                        assert pairs[pair_id, 1] == rchild_node_id
                         already_exists = True
                         break
-                if not already_exists:
-                    child_pairs_indptr[curr_node_id+1:] += 2
-                    child_pairs_indices = np.concatenate((
-                            child_pairs_indices[:next_ptr],
-                            np.array(sorted([lchild_node_id, rchild_node_id]),
-                                     dtype=np.int64),
-                            child_pairs_indices[next_ptr:]
-                    ))
-
-    return (leaves_indptr,
-            leaves_indices,
+                    pair_id = pair_next[pair_id]
+                if already_exists:
+                    continue
+                # Child pairs added to existing nodes are stored sorted
+                new_pair = (min(lchild_node_id, rchild_node_id), max(lchild_node_id, rchild_node_id))
+
+            if num_pairs == pairs.shape[0]:
+                _pairs = np.empty((2 * num_pairs, 2), dtype=np.int64)
+                _pairs[:num_pairs] = pairs
+                pairs = _pairs
+            pair_next = _grow(pair_next, num_pairs + 1)
+            pairs[num_pairs, 0], pairs[num_pairs, 1] = new_pair
+            pair_next[num_pairs] = -1
+            if last_pair[curr_node_id] == -1:
+                first_pair[curr_node_id] = num_pairs
+            else:
+                pair_next[last_pair[curr_node_id]] = num_pairs
+            last_pair[curr_node_id] = num_pairs
+            num_pairs += 1
+
+    # Child pairs in CSR form
+    child_pairs_indptr = np.zeros((num_trellis_nodes+1,), dtype=np.int64)
+    child_pairs_indices = np.empty((2 * num_pairs,), dtype=np.int64)
+    ptr = 0
+    for node_id in range(num_trellis_nodes):
+        pair_id = first_pair[node_id] if node_id >= num_leaves else -1
+        while pair_id != -1:
+            child_pairs_indices[ptr] = pairs[pair_id, 0]
+            child_pairs_indices[ptr+1] = pairs[pair_id, 1]
+            ptr += 2
+            pair_id = pair_next[pair_id]
+        child_pairs_indptr[node_id+1] = ptr
+
+    return (leaves_indptr[:num_trellis_nodes+1].copy(),
+            leaves_indices[:leaves_indptr[num_trellis_nodes]].copy(),
             child_pairs_indptr,
             child_pairs_indices)
 
 
 class Trellis(object):
 
-    def __init__(self, adj_mx: np.ndarray):
+    def __init__(self, adj_mx: np.ndarray, linkages=None):
         self.adj_mx = adj_mx
         self.n = adj_mx.shape[0]
+        self.linkages = list(LINKAGES) if linkages is None else list(linkages)
+        for linkage in self.linkages:
+            if linkage not in LINKAGES:
+                raise ValueError(f'Invalid linkage: {linkage}')
         self.topo_order = None
 
     def fit(self, only_avg_hac=False):
-        # get the HAC tree, not necessarily contained in beam search
+        # get the HAC trees, not necessarily contained in beam search
         g, w = hg.adjacency_matrix_2_undirected_graph(self.adj_mx)
         dists = -1.0 * w
 
-        # build these five trees, maybe change later if it makes sense
-        if only_avg_hac:
-            trees = [hg.binary_partition_tree_average_linkage(g, dists)[0].parents()]
-        else:
-            trees = [
-                hg.binary_partition_tree_average_linkage(g, dists)[0].parents(),
-                hg.binary_partition_tree_single_linkage(g, dists)[0].parents(),
-                hg.binary_partition_tree_complete_linkage(g, dists)[0].parents(),
-                hg.binary_partition_tree_exponential_linkage(g, dists, -1.0)[0].parents(),
-                hg.binary_partition_tree_exponential_linkage(g, dists, 1.0)[0].parents()
-            ]
-        trees = np.vstack(trees)
+        linkages = ['average'] if only_avg_hac else self.linkages
+        trees = np.vstack(self.build_trees(g, dists, linkages))
 
         # build trellis
         (self.leaves_indptr,
@@ -169,3 +223,15 @@ class Trellis(object):
                 self.child_pairs_indptr[node_idx+1], 2):
             yield (self.child_pairs_indices[i],
                    self.child_pairs_indices[i+1])
+
+    @staticmethod
+    def build_trees(g, dists: np.ndarray, linkages):
+        """
+        Parents arrays of the HAC trees of each linkage, built concurrently (higra releases the GIL)
+        """
+        def build_tree(linkage):
+            return LINKAGES[linkage](g, dists)[0].parents()
+        if len(linkages) == 1:
+            return [build_tree(linkages[0])]
+        with ThreadPoolExecutor(max_workers=min(len(linkages), os.cpu_count() or 1)) as executor:
+            return list(executor.map(build_tree, linkages))
@@ -0,0 +1,313 @@
+"""
+Columnar on-disk store of blockwise pairwise features, as an alternative to the features pickles.
+
+A store is a directory holding:
+    X.npy: float32 array of size [total number of pairs, f], the features of all blocks back to back
+    y.npy: float32 array of size [total number of pairs,], the pairwise labels
+    cluster_ids.npy: unicode array of size [total number of signatures,], the cluster ids of all blocks
+    index.npz: block_ids, pair_offsets and signature_offsets (of size number of blocks + 1) of the blocks
+
+The arrays are opened with np.memmap (read-only), so a store is opened without reading its content, and blocks are
+served as zero-copy views that all processes opening the store share through the page cache.
+
+Each split (pickle and/or store) can also have a small metadata sidecar (<split>_features_metadata.npz, see
+get_block_metadata) with the block ids, sizes and label counts, and the feature count and NaN counts of the split.
+"""
+from typing import Callable, Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+import os
+import shutil
+import pickle
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("s2and")
+
+BlockTuple = Tuple[np.ndarray, np.ndarray, Union[List[str], np.ndarray]]
+
+X_FILE = "X.npy"
+Y_FILE = "y.npy"
+CLUSTER_IDS_FILE = "cluster_ids.npy"
+INDEX_FILE = "index.npz"
+METADATA_SUFFIX = "_metadata.npz"
+
+
+def get_block_store_path(pkl_path: str) -> str:
+    """
+    The path of the block store corresponding to a features pickle (e.g. train_features.pkl -> train_features/)
+    """
+    return pkl_path[: -len(".pkl")] if pkl_path.endswith(".pkl") else pkl_path
+
+
+def is_block_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def has_current_block_store(pkl_path: str) -> bool:
+    """
+    Whether the features pickle has a block store next to it that is not older than the pickle (a pickle rewritten
+    after its store, e.g. featurized again without writing stores, supersedes the store)
+    """
+    index_path = os.path.join(get_block_store_path(pkl_path), INDEX_FILE)
+    if not os.path.isfile(index_path):
+        return False
+    return not os.path.isfile(pkl_path) or os.stat(index_path).st_mtime_ns >= os.stat(pkl_path).st_mtime_ns
+
+
+class BlockFeatureStore(Mapping):
+    """
+    Read-only mapping of block id -> (X, y, cluster_ids) over a block store directory, with the same layout as the
+    dicts of the features pickles. X and y are views into the memory-mapped arrays of the store
+
+    Parameters
+    ----------
+    path: str
+        the directory of the store
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        index = np.load(os.path.join(path, INDEX_FILE))
+        self.block_ids: List[str] = index["block_ids"].tolist()
+        self.pair_offsets: np.ndarray = index["pair_offsets"]
+        self.signature_offsets: np.ndarray = index["signature_offsets"]
+        self._block_idxs = {block_id: i for i, block_id in enumerate(self.block_ids)}
+        self.X = np.load(os.path.join(path, X_FILE), mmap_mode="r")
+        self.y = np.load(os.path.join(path, Y_FILE), mmap_mode="r")
+        self.cluster_ids = np.load(os.path.join(path, CLUSTER_IDS_FILE), mmap_mode="r")
+
+    @property
+    def n_features(self) -> int:
+        return self.X.shape[1]
+
+    def block_size(self, block_id: str) -> int:
+        i = self._block_idxs[block_id]
+        return int(self.signature_offsets[i + 1] - self.signature_offsets[i])
+
+    def __getitem__(self, block_id: str) -> BlockTuple:
+        i = self._block_idxs[block_id]
+        start, end = self.pair_offsets[i], self.pair_offsets[i + 1]
+        sig_start, sig_end = self.signature_offsets[i], self.signature_offsets[i + 1]
+        return self.X[start:end], self.y[start:end], self.cluster_ids[sig_start:sig_end].tolist()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.block_ids)
+
+    def __reduce__(self):
+        # Pickled by path rather than content (e.g. when sent to dataloader workers or spawned processes)
+        return self.__class__, (self.path,)
+
+    def __len__(self) -> int:
+        return len(self.block_ids)
+
+
+def write_block_store(block_dict: Mapping[str, BlockTuple], path: str, n_features: Optional[int] = None) -> str:
+    """
+    Writes blockwise features to a block store. The arrays are filled block by block, so block_dict can be any
+    mapping that loads its blocks lazily. The store is written to a temporary directory that replaces path at the end
+
+    Parameters
+    ----------
+    block_dict: Mapping[str, BlockTuple]
+        block id -> (X, y, cluster_ids), as in the features pickles
+    path: str
+        the directory of the store
+    n_features: int
+        the number of features, only needed if all blocks are empty
+
+    Returns
+    -------
+    str: the path of the store
+    """
+    block_ids = list(block_dict.keys())
+    pair_offsets = np.zeros(len(block_ids) + 1, dtype=np.int64)
+    signature_offsets = np.zeros(len(block_ids) + 1, dtype=np.int64)
+    cluster_ids = []
+    for i, block_id in enumerate(block_ids):
+        X, y, block_cluster_ids = block_dict[block_id]
+        if len(X) > 0:
+            n_features = X.shape[1]
+        pair_offsets[i + 1] = pair_offsets[i] + len(X)
+        signature_offsets[i + 1] = signature_offsets[i] + len(block_cluster_ids)
+        cluster_ids += [str(c) for c in block_cluster_ids]
+    if n_features is None:
+        raise ValueError("n_features is required when all blocks are empty")
+
+    tmp_path = path.rstrip(os.sep) + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    X_all = np.lib.format.open_memmap(
+        os.path.join(tmp_path, X_FILE), mode="w+", dtype=np.float32, shape=(int(pair_offsets[-1]), n_features)
+    )
+    y_all = np.lib.format.open_memmap(
+        os.path.join(tmp_path, Y_FILE), mode="w+", dtype=np.float32, shape=(int(pair_offsets[-1]),)
+    )
+    for i, block_id in enumerate(block_ids):
+        X, y, _ = block_dict[block_id]
+        if len(X) > 0:
+            X_all[pair_offsets[i] : pair_offsets[i + 1]] = X
+            y_all[pair_offsets[i] : pair_offsets[i + 1]] = y
+    X_all.flush()
+    y_all.flush()
+    del X_all, y_all
+    np.save(os.path.join(tmp_path, CLUSTER_IDS_FILE), np.array(cluster_ids, dtype=np.str_))
+    np.savez(
+        os.path.join(tmp_path, INDEX_FILE),
+        block_ids=np.array(block_ids, dtype=np.str_),
+        pair_offsets=pair_offsets,
+        signature_offsets=signature_offsets,
+    )
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    logger.info(f"Wrote {len(block_ids)} blocks ({pair_offsets[-1]} pairs) to {path}")
+    return path
+
+
+def convert_pickle_to_block_store(pkl_path: str, path: Optional[str] = None) -> str:
+    """
+    Converts a features pickle ({block_id: [X, y, cluster_ids]}) to a block store
+
+    Parameters
+    ----------
+    pkl_path: str
+        the path of the pickle
+    path: str
+        the directory of the store; defaults to the pickle path without its extension
+
+    Returns
+    -------
+    str: the path of the store
+    """
+    with open(pkl_path, "rb") as _pkl_file:
+        block_dict: Dict[str, BlockTuple] = pickle.load(_pkl_file)
+    return write_block_store(block_dict, path if path is not None else get_block_store_path(pkl_path))
+
+
+def get_source_fingerprint(pkl_path: str) -> np.ndarray:
+    """
+    Size and modification time of the features a split is read from: its block store if it is current (see
+    has_current_block_store), else its pickle
+    """
+    store_path = get_block_store_path(pkl_path)
+    stat = os.stat(os.path.join(store_path, INDEX_FILE) if has_current_block_store(pkl_path) else pkl_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def get_block_metadata_path(pkl_path: str) -> str:
+    """
+    The path of the metadata sidecar of a split (e.g. train_features.pkl -> train_features_metadata.npz)
+    """
+    return get_block_store_path(pkl_path) + METADATA_SUFFIX
+
+
+def get_block_metadata(block_dict: Mapping[str, BlockTuple], n_features: Optional[int] = None) -> Dict[str, np.ndarray]:
+    """
+    Computes the metadata of blockwise features in one pass over the blocks
+
+    Parameters
+    ----------
+    block_dict: Mapping[str, BlockTuple]
+        block id -> (X, y, cluster_ids), as in the features pickles
+    n_features: int
+        the number of features, only needed if all blocks are empty
+
+    Returns
+    -------
+    Dict[str, np.ndarray]: block_ids, block_sizes (number of signatures), block_n_pairs and block_n_pos (number of
+        pairs and of positive pairs) of each block, n_features, and feature_nan_counts (number of NaN values of each
+        feature, over all pairs)
+    """
+    block_ids = list(block_dict.keys())
+    block_sizes = np.zeros(len(block_ids), dtype=np.int64)
+    block_n_pairs = np.zeros(len(block_ids), dtype=np.int64)
+    block_n_pos = np.zeros(len(block_ids), dtype=np.int64)
+    feature_nan_counts = None
+    for i, block_id in enumerate(block_ids):
+        X, y, cluster_ids = block_dict[block_id]
+        block_sizes[i] = len(cluster_ids)
+        block_n_pairs[i] = len(y)
+        if len(y) > 0:
+            block_n_pos[i] = int(np.sum(y))
+            nan_counts = np.isnan(X).sum(axis=0)
+            feature_nan_counts = nan_counts if feature_nan_counts is None else feature_nan_counts + nan_counts
+    if feature_nan_counts is None:
+        if n_features is None:
+            raise ValueError("n_features is required when all blocks are empty")
+        feature_nan_counts = np.zeros(n_features, dtype=np.int64)
+    return {
+        "block_ids": np.array(block_ids, dtype=np.str_),
+        "block_sizes": block_sizes,
+        "block_n_pairs": block_n_pairs,
+        "block_n_pos": block_n_pos,
+        "n_features": np.array(len(feature_nan_counts), dtype=np.int64),
+        "feature_nan_counts": feature_nan_counts.astype(np.int64),
+    }
+
+
+def write_block_metadata(
+    block_dict: Mapping[str, BlockTuple], pkl_path: str, n_features: Optional[int] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Computes the metadata of a split (see get_block_metadata) and saves it to the sidecar file of the split, along
+    with the fingerprint of its features (so that the features have to be written first)
+
+    Parameters
+    ----------
+    block_dict: Mapping[str, BlockTuple]
+        the blockwise features of the split
+    pkl_path: str
+        the path of the features pickle of the split
+    n_features: int
+        the number of features, only needed if all blocks are empty
+
+    Returns
+    -------
+    Dict[str, np.ndarray]: the metadata
+    """
+    metadata = get_block_metadata(block_dict, n_features)
+    np.savez(get_block_metadata_path(pkl_path), source_fingerprint=get_source_fingerprint(pkl_path), **metadata)
+    return metadata
+
+
+def load_block_metadata(
+    pkl_path: str, read_fn: Optional[Callable[[], Mapping[str, BlockTuple]]] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Reads the metadata of a split from its sidecar file if it is up to date with the features of the split, or
+    computes it (from the split returned by read_fn, or else from its block store or pickle) and saves it otherwise
+
+    Parameters
+    ----------
+    pkl_path: str
+        the path of the features pickle of the split
+    read_fn: Callable
+        returns the blockwise features of the split, if they need to be read
+
+    Returns
+    -------
+    Dict[str, np.ndarray]: the metadata (see get_block_metadata)
+    """
+    metadata_path = get_block_metadata_path(pkl_path)
+    if os.path.isfile(metadata_path):
+        with np.load(metadata_path) as _metadata:
+            metadata = dict(_metadata)
+        if np.array_equal(metadata.pop("source_fingerprint"), get_source_fingerprint(pkl_path)):
+            return metadata
+    if read_fn is not None:
+        block_dict = read_fn()
+    elif has_current_block_store(pkl_path):
+        block_dict = BlockFeatureStore(get_block_store_path(pkl_path))
+    else:
+        with open(pkl_path, "rb") as _pkl_file:
+            block_dict = pickle.load(_pkl_file)
+    logger.info(f"Computing the block metadata of {pkl_path}")
+    metadata = get_block_metadata(block_dict)
+    try:
+        np.savez(metadata_path, source_fingerprint=get_source_fingerprint(pkl_path), **metadata)
+    except OSError as e:
+        logger.warning(f"Could not save the block metadata to {metadata_path}: {e}")
+    return metadata
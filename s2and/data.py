@@ -1,6 +1,7 @@
 from typing import Optional, Union, Dict, List, Any, Tuple, Set, NamedTuple
 
 import os
+import tempfile
 import json
 import math
 import numpy as np
@@ -8,8 +9,10 @@ import pandas as pd
 import logging
 import pickle
 import multiprocessing
+import hashlib
 
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 from tqdm import tqdm
 
 from functools import reduce
@@ -114,6 +117,106 @@ class MiniPaper(NamedTuple):
     journal_name: Optional[str]
     authors: List[str]
 
+def get_condensed_submatrix_indices(idxs_to_keep: np.ndarray, n: int) -> np.ndarray:
+    """
+    Maps a set of kept rows of an n x n pairwise matrix, stored in condensed form (the n*(n-1)/2 entries of its
+    strict upper triangle, in row-major order), to the condensed indices of the pairs of the kept submatrix
+
+    Parameters
+    ----------
+    idxs_to_keep: np.ndarray
+        indices of the kept rows (in [0, n))
+    n: int
+        number of rows of the full matrix
+
+    Returns
+    -------
+    np.ndarray: condensed indices (into the full matrix) of the pairs between kept rows, in increasing order,
+        i.e. in the condensed order of the submatrix of the kept rows
+    """
+    idxs_to_keep = np.unique(np.asarray(idxs_to_keep, dtype=np.int64))
+    rows, cols = np.triu_indices(len(idxs_to_keep), k=1)
+    i, j = idxs_to_keep[rows], idxs_to_keep[cols]
+    return i * (n - 1) - i * (i - 1) // 2 + j - i - 1
+
+
+def get_blockwise_scaler_stats(block_dict: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]],
+                               feat_idxs: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """
+    Per-feature statistics of the pairwise features of all blocks, as computed by StandardScaler.fit on their
+    concatenation (NaNs are ignored), but accumulated block by block (with the pairwise update of Chan et al.)
+    without concatenating the blocks
+
+    Parameters
+    ----------
+    block_dict: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+        block id -> (X, y, cluster_ids), as in S2BlocksDataset
+    feat_idxs: np.ndarray
+        the features to use (all if None)
+
+    Returns
+    -------
+    Dict[str, np.ndarray]: per-feature mean, var, scale (as in StandardScaler; NaN for features that are all NaN)
+        and n_samples_seen (the number of non-NaN values)
+    """
+    n_samples_seen, mean, m2 = None, None, None
+    for X, _, _ in block_dict.values():
+        if len(X) == 0:
+            continue
+        X = np.asarray(X if feat_idxs is None else X[:, feat_idxs], dtype=np.float64)
+        block_n = np.sum(~np.isnan(X), axis=0)
+        with np.errstate(invalid="ignore"):
+            block_mean = np.nansum(X, axis=0) / np.maximum(block_n, 1)
+            block_m2 = np.nansum((X - block_mean) ** 2, axis=0)
+        if n_samples_seen is None:
+            n_samples_seen, mean, m2 = block_n, block_mean, block_m2
+            continue
+        total_n = n_samples_seen + block_n
+        delta = block_mean - mean
+        mean = mean + delta * block_n / np.maximum(total_n, 1)
+        m2 = m2 + block_m2 + delta ** 2 * n_samples_seen * block_n / np.maximum(total_n, 1)
+        n_samples_seen = total_n
+    if n_samples_seen is None:
+        raise ValueError("No pairs to compute the feature statistics on")
+
+    all_nan = n_samples_seen == 0
+    mean = np.where(all_nan, np.nan, mean)
+    var = np.where(all_nan, np.nan, m2 / np.maximum(n_samples_seen, 1))
+    # Near-constant features are not scaled (same rule as StandardScaler)
+    eps = np.finfo(np.float64).eps
+    with np.errstate(invalid="ignore"):
+        constant = var <= n_samples_seen * eps * var + (n_samples_seen * mean * eps) ** 2
+    scale = np.sqrt(var)
+    scale[constant] = 1.0
+    return {"mean": mean, "var": var, "scale": scale, "n_samples_seen": n_samples_seen.astype(np.int64)}
+
+
+def get_scaler_from_stats(stats: Dict[str, np.ndarray], feat_idxs: Optional[np.ndarray] = None) -> StandardScaler:
+    """
+    A fitted StandardScaler from the statistics of get_blockwise_scaler_stats, restricted to feat_idxs (all features
+    if None); the same as a StandardScaler fit on the (selected) features
+
+    Parameters
+    ----------
+    stats: Dict[str, np.ndarray]
+        the output of get_blockwise_scaler_stats
+    feat_idxs: np.ndarray
+        the features to keep
+
+    Returns
+    -------
+    StandardScaler: the fitted scaler
+    """
+    idxs = slice(None) if feat_idxs is None else feat_idxs
+    scaler = StandardScaler()
+    scaler.mean_ = np.asarray(stats["mean"])[idxs]
+    scaler.var_ = np.asarray(stats["var"])[idxs]
+    scaler.scale_ = np.asarray(stats["scale"])[idxs]
+    scaler.n_samples_seen_ = np.asarray(stats["n_samples_seen"])[idxs]
+    scaler.n_features_in_ = len(scaler.mean_)
+    return scaler
+
+
 class S2BlocksDataset(Dataset):
     """
     Class to define a Torch Dataset that can be leveraged by a Dataloader
@@ -125,6 +228,8 @@ class S2BlocksDataset(Dataset):
                 Y (Binary Class labels, 1D array of size [n(n-1)/2,])
                 cluster_ids (cluster ids, 1D array of size [n]), where
             n is the number of signatures in a S2 block and f is the number of pairwise features
+        (or a BlockFeatureStore, whose blocks are then kept as zero-copy views of the memory-mapped store:
+        feature selection and NaN conversion are applied on access, and never modify the source arrays)
     """
     def __init__(self, block_dict: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]],
                  convert_nan=True, nan_value=-1, scale=False, scaler=None, subsample_sz=-1,
@@ -137,19 +242,17 @@ class S2BlocksDataset(Dataset):
         self.scaler = scaler
         if self.scale and self.scaler is None:
             # Fit scaler on input data
-            all_X = np.concatenate(list(map(lambda x: x[0], self.block_dict.values())))
-            if feat_idxs is not None:
-                all_X = all_X[:, feat_idxs]
-            self.scaler = StandardScaler()
-            self.scaler.fit(all_X)
+            self.scaler = get_scaler_from_stats(get_blockwise_scaler_stats(self.block_dict, feat_idxs))
         self.subsample_sz = subsample_sz
+        self.feat_idxs = feat_idxs  # Applied on access (to the pairs of a block, or to the stacked pairs)
 
         self.blockwise_data = []
         self.blockwise_keys = []
+        self.blockwise_ids = []  # Unique per entry (subsampled chunks of a block get the chunk offset appended)
+        self._entry_keys = []  # Identify the source pairs of each entry (see materialize)
+        self.materialized = False
         for dict_key in self.block_dict.keys():
             X, y, cluster_ids = self.block_dict[dict_key]
-            if feat_idxs is not None:
-                X = X[:, feat_idxs]
             if X.shape[0] != 0 and self.subsample_sz > -1:
                 # Split large blocks into subsampled blocks with the same key
                 matrix_sz = len(cluster_ids)
@@ -157,28 +260,35 @@ class S2BlocksDataset(Dataset):
                     shuffled_idxs = np.random.choice(range(matrix_sz), matrix_sz, replace=False)
                     for i in range(0, matrix_sz, self.subsample_sz):
                         matrix_idxs_to_keep = np.sort(shuffled_idxs[i:i + self.subsample_sz])
-                        matrix_idxs_to_remove = np.delete(shuffled_idxs, matrix_idxs_to_keep)
-                        idxs_to_remove = []
-                        for midx in matrix_idxs_to_remove:
-                            idxs_to_remove += self.get_indices_by_matrix_idx(midx, matrix_sz)
-                        idxs_to_remove = np.sort(np.unique(idxs_to_remove))
-                        idxs_to_keep = np.delete(np.arange(len(X)), idxs_to_remove)
+                        idxs_to_keep = get_condensed_submatrix_indices(matrix_idxs_to_keep, matrix_sz)
                         _X = X[idxs_to_keep]
                         _y = y[idxs_to_keep]
                         _clusterIds = list(np.array(cluster_ids)[matrix_idxs_to_keep])
                         _clusterIds = list(map(lambda x: f'{x}_{i}', _clusterIds))
                         self.blockwise_data.append((_X, _y, _clusterIds))
                         self.blockwise_keys.append(dict_key)
+                        self.blockwise_ids.append(f'{dict_key}_{i}')
+                        self._entry_keys.append(f'{dict_key}:{hashlib.sha1(idxs_to_keep.tobytes()).hexdigest()}')
                 else:
                     self.blockwise_data.append((X, y, cluster_ids))
                     self.blockwise_keys.append(dict_key)
+                    self.blockwise_ids.append(dict_key)
+                    self._entry_keys.append(dict_key)
             else:
                 self.blockwise_data.append((X, y, cluster_ids))
                 self.blockwise_keys.append(dict_key)
+                self.blockwise_ids.append(dict_key)
+                self._entry_keys.append(dict_key)
         if sort_desc:
             self.blockwise_keys = list(map(lambda x: x[1], sorted(enumerate(self.blockwise_keys),
                                                                   key=lambda x: len(self.blockwise_data[x[0]][2]),
                                                                   reverse=True)))
+            self.blockwise_ids = list(map(lambda x: x[1], sorted(enumerate(self.blockwise_ids),
+                                                                 key=lambda x: len(self.blockwise_data[x[0]][2]),
+                                                                 reverse=True)))
+            self._entry_keys = list(map(lambda x: x[1], sorted(enumerate(self._entry_keys),
+                                                               key=lambda x: len(self.blockwise_data[x[0]][2]),
+                                                               reverse=True)))
             self.blockwise_data.sort(key=lambda x: -len(x[2]))
         if self.pairwise_mode:
             self.pairwise_data = {'X': [], 'y': []}
@@ -188,32 +298,358 @@ class S2BlocksDataset(Dataset):
                 self.pairwise_data['y'].append(tup[1])
                 self.cluster_ids += tup[2]
             self.pairwise_data['X'] = np.vstack(self.pairwise_data['X'])
+            if self.feat_idxs is not None:
+                self.pairwise_data['X'] = self.pairwise_data['X'][:, self.feat_idxs]
             self.pairwise_data['y'] = np.hstack(self.pairwise_data['y'])
             self.cluster_ids = np.array(self.cluster_ids)
             del self.blockwise_data
             del self.blockwise_keys
+            del self.blockwise_ids
 
     def __len__(self):
         return len(self.blockwise_data) if not self.pairwise_mode else len(self.pairwise_data['X'])
 
-    @staticmethod
-    def get_indices_by_matrix_idx(K, n):
-        first_pos = list(range(K * (n - 1) - K * (K - 1) // 2, K * (n - 1) - K * (K - 1) // 2 + (n - K - 2) + 1))
-        second_pos = [k * (n - 1) - k * (k - 1) // 2 + K - k - 1 for k in range(K)]
-        return first_pos + second_pos
+    @property
+    def n_features(self) -> int:
+        if self.pairwise_mode:
+            return self.pairwise_data['X'].shape[1]
+        if self.feat_idxs is not None:
+            return len(self.feat_idxs)
+        return self.blockwise_data[0][0].shape[1] if len(self.blockwise_data) > 0 else 0
+
+    def get_label_stats(self) -> Dict[str, int]:
+        """
+        Returns the number of pairs (n_pairs) and of positive pairs (n_pos) of the dataset
+        """
+        ys = [self.pairwise_data['y']] if self.pairwise_mode else [y for _, y, _ in self.blockwise_data]
+        return {'n_pairs': int(sum(len(y) for y in ys)), 'n_pos': int(sum(float(y.sum()) for y in ys))}
+
+    def _get_materialize_key(self, source_key):
+        key = hashlib.sha1()
+        key.update(repr((source_key, self.pairwise_mode, self.convert_nan, self.nan_value,
+                         self.scale and self.scaler is not None)).encode())
+        key.update("\n".join(self._entry_keys).encode())
+        if self.feat_idxs is not None:
+            key.update(np.asarray(self.feat_idxs, dtype=np.int64).tobytes())
+        if self.scale and self.scaler is not None:
+            key.update(np.asarray(self.scaler.mean_, dtype=np.float64).tobytes())
+            key.update(np.asarray(self.scaler.scale_, dtype=np.float64).tobytes())
+        return key.hexdigest()
+
+    def materialize(self, cache_dir: Optional[str] = None, source_key: Optional[Any] = None):
+        """
+        Applies feature selection, NaN conversion and scaling to all entries once (without modifying the source
+        arrays), and keeps the results as float32 torch tensors: views into one contiguous buffer, which __getitem__
+        then returns as is. With cache_dir, the buffer is a memmap file in cache_dir, keyed by source_key (which
+        should identify the source data) and by the entries and transforms of the dataset, and later runs with the
+        same key map it instead of recomputing it
+        """
+        if self.materialized:
+            return self
+        if self.pairwise_mode:
+            entries = [(self.pairwise_data['X'], self.pairwise_data['y'])]
+            n_features = self.pairwise_data['X'].shape[1]
+        else:
+            entries = [(X, y) for X, y, _ in self.blockwise_data]
+            n_features = len(self.feat_idxs) if self.feat_idxs is not None else \
+                entries[0][0].shape[1] if len(entries) > 0 else 0
+        offsets = np.cumsum([0] + [len(y) for _, y in entries])
+
+        X_path, y_path = "", ""
+        if cache_dir is not None:
+            key = self._get_materialize_key(source_key)
+            X_path, y_path = os.path.join(cache_dir, f"{key}.X.npy"), os.path.join(cache_dir, f"{key}.y.npy")
+        if cache_dir is not None and os.path.isfile(X_path) and os.path.isfile(y_path):
+            logger.info(f"Loading materialized dataset from {X_path}")
+            # Copy-on-write, so that the tensors are writable while the pages stay shared
+            X_all, y_all = np.load(X_path, mmap_mode="c"), np.load(y_path, mmap_mode="c")
+        else:
+            tmp_paths: List[str] = []
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                # Unique temporary files, so that concurrent runs with the same key do not write to the same file
+                for _ in range(2):
+                    fd, tmp_path = tempfile.mkstemp(suffix=".npy.tmp", dir=cache_dir)
+                    os.close(fd)
+                    tmp_paths.append(tmp_path)
+                X_all = np.lib.format.open_memmap(tmp_paths[0], mode="w+", dtype=np.float32,
+                                                  shape=(offsets[-1], n_features))
+                y_all = np.lib.format.open_memmap(tmp_paths[1], mode="w+", dtype=np.float32, shape=(offsets[-1],))
+            else:
+                X_all = np.empty((offsets[-1], n_features), dtype=np.float32)
+                y_all = np.empty(offsets[-1], dtype=np.float32)
+            try:
+                for k, (X, y) in enumerate(entries):
+                    if not self.pairwise_mode and self.feat_idxs is not None:
+                        X = X[:, self.feat_idxs]
+                    X_all[offsets[k]:offsets[k + 1]] = self._transform(np.array(X))
+                    y_all[offsets[k]:offsets[k + 1]] = y
+                if cache_dir is not None:
+                    X_all.flush()
+                    y_all.flush()
+                    del X_all, y_all
+                    os.replace(tmp_paths[0], X_path)
+                    os.replace(tmp_paths[1], y_path)
+                    X_all, y_all = np.load(X_path, mmap_mode="c"), np.load(y_path, mmap_mode="c")
+            finally:
+                for tmp_path in tmp_paths:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        X_all, y_all = torch.from_numpy(X_all), torch.from_numpy(y_all)
+
+        if self.pairwise_mode:
+            self.pairwise_data['X'], self.pairwise_data['y'] = X_all, y_all
+        else:
+            self.blockwise_data = [(X_all[offsets[k]:offsets[k + 1]], y_all[offsets[k]:offsets[k + 1]], cluster_ids)
+                                   for k, (_, _, cluster_ids) in enumerate(self.blockwise_data)]
+        self.materialized = True
+        return self
+
+    def _transform(self, X):
+        if self.convert_nan:
+            # In place, unless X is a read-only view (of a block store)
+            X = np.nan_to_num(X, copy=not X.flags.writeable, nan=self.nan_value)
+        if self.scale and self.scaler is not None:
+            if X.shape[0] != 0:
+                X = self.scaler.transform(X)
+        return X
 
     def __getitem__(self, idx):
         if not self.pairwise_mode:
             X, y, cluster_ids = self.blockwise_data[idx]
+            if self.feat_idxs is not None and not self.materialized:
+                X = X[:, self.feat_idxs]
         else:
             X = self.pairwise_data['X'][idx].reshape(-1, len(self.pairwise_data['X'][0]))
             y = self.pairwise_data['y'][idx].reshape(-1)
+        if not self.materialized:
+            X = self._transform(X)
+        return (X, y, cluster_ids) if not self.pairwise_mode else (X, y)
+
+
+class BlockBucketSampler(Sampler):
+    """
+    Samples the blocks of a blockwise S2BlocksDataset one at a time, grouped by size: blocks are put into buckets of
+    sizes [bucket_ratio^k, bucket_ratio^(k+1)), which are visited from the largest sizes down, and consecutive blocks
+    are grouped into steps of at least pair_budget pairs (gradients are accumulated over the blocks of a step; only the
+    last step can be smaller). With shuffle, the blocks of each bucket and the order of the steps are reshuffled at
+    every epoch. With bucket_ratio=None, blocks are sampled in dataset order.
+
+    Blocks with fewer than min_pairs pairs (which training skips) are still sampled, but not counted in the steps:
+    get_step(i) returns the number of counted blocks in the step of the i-th sampled block, and whether it is the last
+    counted block of its step (i.e. the optimizer steps after it)
+
+    Parameters
+    ----------
+    dataset: S2BlocksDataset
+        a blockwise (not pairwise_mode) dataset
+    pair_budget: int
+        minimum number of pairs per step (<= 1: one block per step)
+    bucket_ratio: float
+        ratio between the block sizes of consecutive buckets (> 1), or None to disable bucketing
+    shuffle: bool
+        whether to shuffle the blocks within buckets and the steps at every epoch
+    min_pairs: int
+        blocks with fewer pairs are not counted in the steps
+    """
+
+    def __init__(self, dataset: S2BlocksDataset, pair_budget: int = 1, bucket_ratio: Optional[float] = None,
+                 shuffle: bool = False, min_pairs: int = 1):
+        if dataset.pairwise_mode:
+            raise ValueError("BlockBucketSampler requires a blockwise dataset")
+        if bucket_ratio is not None and bucket_ratio <= 1:
+            raise ValueError("bucket_ratio must be > 1")
+        self.block_sizes = np.array([len(cluster_ids) for _, _, cluster_ids in dataset.blockwise_data], dtype=int)
+        self.n_pairs = np.array([len(y) for _, y, _ in dataset.blockwise_data], dtype=int)
+        self.pair_budget = pair_budget
+        self.bucket_ratio = bucket_ratio
+        self.shuffle = shuffle
+        self.min_pairs = min_pairs
+        self._build_steps()
+
+    def _get_buckets(self) -> List[np.ndarray]:
+        if self.bucket_ratio is None:
+            return [np.arange(len(self.block_sizes))]
+        bucket_idxs = np.floor(np.log(np.maximum(self.block_sizes, 1)) / np.log(self.bucket_ratio)).astype(int)
+        buckets = [np.where(bucket_idxs == b)[0] for b in np.unique(bucket_idxs)[::-1]]
+        if self.shuffle:
+            buckets = [np.random.permutation(bucket) for bucket in buckets]
+        return buckets
+
+    def _build_steps(self):
+        counted = self.n_pairs >= self.min_pairs
+        steps = []
+        step, step_pairs, step_counted = [], 0, 0
+        for idx in np.concatenate(self._get_buckets()).astype(int):
+            step.append(idx)
+            if counted[idx]:
+                step_pairs += self.n_pairs[idx]
+                step_counted += 1
+                if step_pairs >= self.pair_budget:
+                    steps.append(step)
+                    step, step_pairs, step_counted = [], 0, 0
+        if len(step) > 0:
+            if step_counted == 0 and len(steps) > 0:
+                # Only skipped blocks left: they join the last step
+                steps[-1] += step
+            else:
+                steps.append(step)
+        if self.shuffle and len(steps) > 1:
+            steps = [steps[i] for i in np.random.permutation(len(steps))]
+
+        self.order = np.array([idx for step in steps for idx in step], dtype=int)
+        self.step_sizes = []  # Number of counted blocks of each step
+        self._step_len = np.zeros(len(self.order), dtype=int)
+        self._step_end = np.zeros(len(self.order), dtype=bool)
+        start = 0
+        for step in steps:
+            counted_pos = [start + k for k, idx in enumerate(step) if counted[idx]]
+            self.step_sizes.append(len(counted_pos))
+            self._step_len[start:start + len(step)] = len(counted_pos)
+            if len(counted_pos) > 0:
+                self._step_end[counted_pos[-1]] = True
+            start += len(step)
+
+    def get_step(self, i: int) -> Tuple[int, bool]:
+        """
+        Returns the number of counted blocks in the step of the i-th block of the current epoch, and whether the
+        optimizer steps after that block
+        """
+        return int(self._step_len[i]), bool(self._step_end[i])
+
+    def __iter__(self):
+        if self.shuffle:
+            self._build_steps()
+        return iter(self.order.tolist())
+
+    def __len__(self):
+        return len(self.block_sizes)
+
+
+class S2PairwiseStreamDataset(IterableDataset):
+    """
+    Iterable pairwise dataset that yields (X, y) batches of batch_size pairs as float32 tensors, without stacking the
+    pairs of all blocks: blocks are read (in shuffled order) from block_dict, which can be a BlockFeatureStore, into
+    a buffer of at least buffer_size pairs, which is shuffled and cut into contiguous batches; the transforms (NaN
+    conversion, scaling) are applied once per buffer, and the pairs left over are carried into the next buffer. With
+    buffer_size=0, the pairs are streamed in block order. Large blocks are split as in S2BlocksDataset (subsample_sz),
+    into chunks that are drawn once per dataset, so get_label_stats reports the statistics of the streamed pairs.
+    Use with DataLoader(dataset, batch_size=None); with DataLoader workers, the blocks are split among the workers
+    (and each worker yields its own last, smaller batch), so the dataset has no __len__. The dataset is not indexable
+    either: runs that index the train pairs (e.g. overfitting runs) need an S2BlocksDataset. label_stats can pass
+    precomputed label statistics (e.g. from the metadata of the split, see s2and.block_store.get_block_metadata)
+    """
+    def __init__(self, block_dict: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]], batch_size: int,
+                 convert_nan=True, nan_value=-1, scale=False, scaler=None, subsample_sz=-1, feat_idxs=None,
+                 buffer_size=0, label_stats: Optional[Dict[str, int]] = None):
+        self.block_dict = block_dict
+        self.block_keys = list(self.block_dict.keys())
+        self.batch_size = batch_size
+        self.convert_nan = convert_nan
+        self.nan_value = nan_value
+        self.scale = scale
+        self.scaler = scaler
+        if self.scale and self.scaler is None:
+            # Fit scaler on input data
+            self.scaler = get_scaler_from_stats(get_blockwise_scaler_stats(self.block_dict, feat_idxs))
+        self.subsample_sz = subsample_sz
+        self.feat_idxs = feat_idxs
+        self.buffer_size = buffer_size
+        # Block k is chunked with seed _subsample_seed + k, so its chunks are the same at every pass
+        self._subsample_seed = np.random.randint(2 ** 31 - len(self.block_keys))
+        self._label_stats = label_stats
+
+    def _get_pair_idxs(self, k, matrix_sz):
+        # Indices of the pairs of block k that are kept (None: all of them)
+        if self.subsample_sz == -1 or matrix_sz <= self.subsample_sz:
+            return None
+        shuffled_idxs = np.random.RandomState(self._subsample_seed + k).permutation(matrix_sz)
+        return np.concatenate([
+            get_condensed_submatrix_indices(np.sort(shuffled_idxs[i:i + self.subsample_sz]), matrix_sz)
+            for i in range(0, matrix_sz, self.subsample_sz)
+        ])
+
+    def _get_block_pairs(self, k):
+        X, y, cluster_ids = self.block_dict[self.block_keys[k]]
+        if len(y) == 0:
+            return None, y
+        pair_idxs = self._get_pair_idxs(k, len(cluster_ids))
+        if pair_idxs is not None:
+            X, y = X[pair_idxs], y[pair_idxs]
+        if self.feat_idxs is not None:
+            X = X[:, self.feat_idxs]
+        return X, y
+
+    @property
+    def n_features(self) -> int:
+        if self.feat_idxs is not None:
+            return len(self.feat_idxs)
+        if hasattr(self.block_dict, 'n_features'):  # BlockFeatureStore
+            return self.block_dict.n_features
+        # Blocks of a single signature have no pairs (and X of shape (0,) in the features pickles)
+        return next((X.shape[1] for X, y, _ in self.block_dict.values() if len(y) > 0), 0)
+
+    def get_label_stats(self) -> Dict[str, int]:
+        """
+        Returns the number of pairs (n_pairs) and of positive pairs (n_pos) of the dataset, from the labels only
+        """
+        if self._label_stats is None:
+            n_pairs, n_pos = 0, 0.
+            for k, block_key in enumerate(self.block_keys):
+                _, y, cluster_ids = self.block_dict[block_key]
+                pair_idxs = self._get_pair_idxs(k, len(cluster_ids)) if len(y) > 0 else None
+                if pair_idxs is not None:
+                    y = y[pair_idxs]
+                n_pairs += len(y)
+                n_pos += float(np.sum(y))
+            self._label_stats = {'n_pairs': n_pairs, 'n_pos': int(n_pos)}
+        return self._label_stats
+
+    def _transform(self, X):
+        # X is a float32 copy, transformed in place
         if self.convert_nan:
-            np.nan_to_num(X, copy=False, nan=self.nan_value)
+            X = np.nan_to_num(X, copy=False, nan=self.nan_value)
         if self.scale and self.scaler is not None:
             if X.shape[0] != 0:
-                X = self.scaler.transform(X)
-        return (X, y, cluster_ids) if not self.pairwise_mode else (X, y)
+                X = self.scaler.transform(X, copy=False)
+        return X
+
+    def _get_batches(self, Xs, ys, flush):
+        # Shuffles the buffered pairs, and returns the transformed full batches (all batches if flush) and the
+        # untransformed pairs left over
+        X, y = np.concatenate(Xs).astype(np.float32, copy=False), np.concatenate(ys).astype(np.float32, copy=False)
+        if self.buffer_size > 0:
+            perm = np.random.permutation(len(y))
+            X, y = X[perm], y[perm]
+        n_yield = len(y) if flush else len(y) - len(y) % self.batch_size
+        X_out = self._transform(X[:n_yield])  # The buffer is a copy: the left-over pairs are not transformed
+        batches = [(torch.from_numpy(X_out[i:i + self.batch_size]), torch.from_numpy(y[i:i + self.batch_size]))
+                   for i in range(0, n_yield, self.batch_size)]
+        return batches, X[n_yield:], y[n_yield:]
+
+    def __iter__(self):
+        block_idxs = np.arange(len(self.block_keys))
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            block_idxs = block_idxs[worker_info.id::worker_info.num_workers]
+        if self.buffer_size > 0:
+            block_idxs = np.random.permutation(block_idxs)
+        buffer_size = max(self.buffer_size, self.batch_size)
+        Xs, ys, n_buffered = [], [], 0
+        for k in block_idxs:
+            X, y = self._get_block_pairs(k)
+            if len(y) == 0:
+                continue
+            Xs.append(X)
+            ys.append(y)
+            n_buffered += len(y)
+            if n_buffered >= buffer_size:
+                batches, X_left, y_left = self._get_batches(Xs, ys, flush=False)
+                yield from batches
+                Xs, ys, n_buffered = [X_left], [y_left], len(y_left)
+        if n_buffered > 0:
+            batches, _, _ = self._get_batches(Xs, ys, flush=True)
+            yield from batches
 
 class ANDData:
     """
@@ -1492,12 +1928,6 @@ class ANDData:
 
             return pairs
 
-    @staticmethod
-    def get_indices_by_matrix_idx(K, n):
-        first_pos = list(range(K * (n - 1) - K * (K - 1) // 2, K * (n - 1) - K * (K - 1) // 2 + (n - K - 2) + 1))
-        second_pos = [k * (n - 1) - k * (k - 1) // 2 + K - k - 1 for k in range(K)]
-        return first_pos + second_pos
-
     def pair_sampling_to_store(
         self,
         sample_size: int,
@@ -1661,9 +2091,7 @@ class ANDData:
                     sig_pairs = blockwise_sig_pairs[block_id]
                     cluster_ids = blockwise_cluster_ids[block_id]
                     n = len(signatures)
-                    block_len = len(sig_pairs)
 
-                    all_idxs = np.arange(0, n)
                     sig_idxs_to_keep = []
                     for i, s in enumerate(signatures):
                         if (s in subsample_id_set):
@@ -1679,24 +2107,10 @@ class ANDData:
                     elif(sig_idxs_to_keep.size== n):
                         # continue no need to subsample
                         continue
-                    else:
-                        sig_idxs_to_remove = np.delete(all_idxs, sig_idxs_to_keep)
-
-                    idxs_to_remove = []
-                    for midx in sig_idxs_to_remove:
-                        idxs_to_remove += self.get_indices_by_matrix_idx(midx, n)
-                    idxs_to_remove = np.sort(np.unique(idxs_to_remove))
-                    if (idxs_to_remove.size == 0):
-                        idxs_to_keep = np.arange(block_len)
-                    else:
-                        idxs_to_keep = np.delete(np.arange(block_len), idxs_to_remove)
 
-                    idxs_to_keep = np.array(idxs_to_keep, dtype=int)
+                    idxs_to_keep = get_condensed_submatrix_indices(sig_idxs_to_keep, n)
                     sig_idxs_to_keep = np.array(sig_idxs_to_keep, dtype=int)
-                    #print(type(idxs_to_keep), type(sig_idxs_to_keep), idxs_to_keep, sig_idxs_to_keep)
-                    _sig_pairs = [ele for idx, ele in enumerate(sig_pairs) if idx in idxs_to_keep]
-                    # Error in next line: 'tuple' object is not callable, but above line also works same
-                    #_sig_pairs = list(np.array([tuple(row) for row in sig_pairs], dtype=np.dtype('U10,U10,i'))[idxs_to_keep])
+                    _sig_pairs = [sig_pairs[idx] for idx in idxs_to_keep]
                     _clusterIds = list(np.array(cluster_ids)[sig_idxs_to_keep])
                     _signatures = list(np.array(signatures)[sig_idxs_to_keep])
                     # Update the values in the dictionary
@@ -2,6 +2,7 @@ import pickle
 from typing import Tuple, List, Union, Dict, Callable, Any, Optional
 
 import os
+import shutil
 import multiprocessing
 import json
 import numpy as np
@@ -12,6 +13,7 @@ from collections import Counter
 from tqdm import tqdm
 
 from s2and.data import ANDData, Signature
+from s2and.block_store import write_block_store, write_block_metadata, get_block_store_path, is_block_store
 from s2and.consts import (
     CACHE_ROOT,
     NUMPY_NAN,
@@ -835,9 +837,11 @@ def store_featurized_pickles(
     nan_value: float = np.nan,
     delete_training_data: bool = False,
     random_seed: int = 1,
+    write_block_stores: bool = True,
 ) -> Union[Tuple[TupleOfArrays, TupleOfArrays, TupleOfArrays], TupleOfArrays]:
     """
     Featurizes the input dataset and stores as preprocessed data in pickle files
+    (and in memory-mapped block stores, see s2and.block_store), with the metadata of each split next to its pickle
 
     Parameters
     ----------
@@ -859,6 +863,8 @@ def store_featurized_pickles(
         the value to replace nans with
     delete_training_data: bool
         Whether to delete some suspicious training examples
+    write_block_stores: bool
+        Whether to also write each split as a block store, next to its pickle
 
     Returns
     -------
@@ -979,6 +985,19 @@ def store_featurized_pickles(
             pickle.dump(val_blockwise_features, _pkl_file)
         with open(test_pkl,"wb") as _pkl_file:
             pickle.dump(test_blockwise_features, _pkl_file)
+        if write_block_stores:
+            write_block_store(train_blockwise_features, get_block_store_path(train_pkl), n_features=NUM_FEATURES)
+            write_block_store(val_blockwise_features, get_block_store_path(val_pkl), n_features=NUM_FEATURES)
+            write_block_store(test_blockwise_features, get_block_store_path(test_pkl), n_features=NUM_FEATURES)
+        else:
+            # Stores of an earlier featurization no longer match the pickles
+            for _pkl in [train_pkl, val_pkl, test_pkl]:
+                if is_block_store(get_block_store_path(_pkl)):
+                    shutil.rmtree(get_block_store_path(_pkl))
+        # After the features: the metadata records the fingerprint of the features it describes
+        write_block_metadata(train_blockwise_features, train_pkl, n_features=NUM_FEATURES)
+        write_block_metadata(val_blockwise_features, val_pkl, n_features=NUM_FEATURES)
+        write_block_metadata(test_blockwise_features, test_pkl, n_features=NUM_FEATURES)
 
         # Check if the signature objects are stored or not, useful for qualitative analysis
         train_signatures_pkl = f"{PREPROCESSED_DATA_DIR}/{dataset.name}/seed{random_seed}/train_signatures.pkl"
@@ -0,0 +1,136 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from s2and.block_store import (
+    BlockFeatureStore,
+    convert_pickle_to_block_store,
+    get_block_metadata_path,
+    has_current_block_store,
+    is_block_store,
+    load_block_metadata,
+    write_block_metadata,
+    write_block_store,
+)
+from s2and.data import S2BlocksDataset
+
+
+class TestBlockStore(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.RandomState(0)
+        self.block_dict = {}
+        for block_id, n in [("a", 4), ("b", 1), ("c", 6)]:
+            n_pairs = n * (n - 1) // 2
+            X = rng.rand(n_pairs, 3)
+            X[rng.rand(n_pairs, 3) < 0.2] = np.nan
+            y = rng.randint(0, 2, n_pairs).astype(float)
+            self.block_dict[block_id] = [X, y, [f"{block_id}{i % 2}" for i in range(n)]]
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check_store(self, store):
+        assert list(store.keys()) == list(self.block_dict.keys())
+        assert store.n_features == 3
+        for block_id, (X, y, cluster_ids) in self.block_dict.items():
+            _X, _y, _cluster_ids = store[block_id]
+            assert _X.dtype == np.float32
+            assert len(X) == 0 or isinstance(_X, np.memmap)
+            np.testing.assert_array_equal(_X, X.astype(np.float32))
+            np.testing.assert_array_equal(_y, y)
+            assert _cluster_ids == cluster_ids
+            assert store.block_size(block_id) == len(cluster_ids)
+
+    def test_write_and_read(self):
+        path = os.path.join(self.tmp_dir.name, "train_features")
+        write_block_store(self.block_dict, path)
+        assert is_block_store(path)
+        self.check_store(BlockFeatureStore(path))
+
+    def test_pickle_by_path(self):
+        path = write_block_store(self.block_dict, os.path.join(self.tmp_dir.name, "train_features"))
+        data = pickle.dumps(BlockFeatureStore(path))
+        assert len(data) < 1000
+        self.check_store(pickle.loads(data))
+
+    def test_convert_pickle(self):
+        pkl_path = os.path.join(self.tmp_dir.name, "train_features.pkl")
+        with open(pkl_path, "wb") as fh:
+            pickle.dump(self.block_dict, fh)
+        path = convert_pickle_to_block_store(pkl_path)
+        assert path == os.path.join(self.tmp_dir.name, "train_features")
+        self.check_store(BlockFeatureStore(path))
+
+    def test_current_block_store(self):
+        pkl_path = os.path.join(self.tmp_dir.name, "train_features.pkl")
+        with open(pkl_path, "wb") as fh:
+            pickle.dump(self.block_dict, fh)
+        assert not has_current_block_store(pkl_path)
+        path = convert_pickle_to_block_store(pkl_path)
+        assert has_current_block_store(pkl_path)
+        # A pickle rewritten after its store supersedes the store
+        index_mtime_ns = os.stat(os.path.join(path, "index.npz")).st_mtime_ns
+        os.utime(pkl_path, ns=(index_mtime_ns + 10**9, index_mtime_ns + 10**9))
+        assert not has_current_block_store(pkl_path)
+
+    def test_blocks_dataset(self):
+        path = write_block_store(self.block_dict, os.path.join(self.tmp_dir.name, "train_features"))
+        store = BlockFeatureStore(path)
+        feat_idxs = np.array([0, 2])
+        dataset = S2BlocksDataset(store, convert_nan=True, nan_value=-1, feat_idxs=feat_idxs)
+        for i, (X, y, cluster_ids) in enumerate(self.block_dict.values()):
+            _X, _y, _cluster_ids = dataset[i]
+            np.testing.assert_array_equal(_X, np.nan_to_num(X[:, feat_idxs].astype(np.float32), nan=-1))
+            np.testing.assert_array_equal(_y, y)
+            assert _cluster_ids == cluster_ids
+        # The store itself is left untouched
+        assert np.isnan(store["a"][0]).any()
+
+    def test_block_metadata(self):
+        pkl_path = os.path.join(self.tmp_dir.name, "train_features.pkl")
+        with open(pkl_path, "wb") as fh:
+            pickle.dump(self.block_dict, fh)
+        metadata = write_block_metadata(self.block_dict, pkl_path)
+        assert os.path.isfile(get_block_metadata_path(pkl_path))
+        assert metadata["block_ids"].tolist() == ["a", "b", "c"]
+        assert metadata["block_sizes"].tolist() == [4, 1, 6]
+        assert metadata["block_n_pairs"].tolist() == [6, 0, 15]
+        assert metadata["block_n_pos"].tolist() == [int(y.sum()) for _, y, _ in self.block_dict.values()]
+        assert metadata["n_features"] == 3
+        nan_counts = sum(np.isnan(X).sum(axis=0) for X, _, _ in self.block_dict.values())
+        np.testing.assert_array_equal(metadata["feature_nan_counts"], nan_counts)
+
+        def read_fn():
+            raise AssertionError("The split should not be read")
+
+        loaded = load_block_metadata(pkl_path, read_fn=read_fn)
+        for key, value in metadata.items():
+            np.testing.assert_array_equal(loaded[key], value)
+        # Converting the split to a store changes the features it is read from: the metadata is recomputed
+        convert_pickle_to_block_store(pkl_path)
+        with self.assertRaises(AssertionError):
+            load_block_metadata(pkl_path, read_fn=read_fn)
+        loaded = load_block_metadata(pkl_path)
+        for key, value in metadata.items():
+            np.testing.assert_array_equal(loaded[key], value)
+        load_block_metadata(pkl_path, read_fn=read_fn)
+
+    def test_block_metadata_stale_store(self):
+        pkl_path = os.path.join(self.tmp_dir.name, "train_features.pkl")
+        with open(pkl_path, "wb") as fh:
+            pickle.dump(self.block_dict, fh)
+        path = convert_pickle_to_block_store(pkl_path)
+        # Rewrite the pickle after its store: the metadata is computed from the pickle, not from the stale store
+        del self.block_dict["c"]
+        with open(pkl_path, "wb") as fh:
+            pickle.dump(self.block_dict, fh)
+        index_mtime_ns = os.stat(os.path.join(path, "index.npz")).st_mtime_ns
+        os.utime(pkl_path, ns=(index_mtime_ns + 10**9, index_mtime_ns + 10**9))
+        metadata = load_block_metadata(pkl_path)
+        assert metadata["block_ids"].tolist() == ["a", "b"]
+        assert metadata["block_sizes"].tolist() == [4, 1]
@@ -0,0 +1,35 @@
+import unittest
+
+from e2e_pipeline.cc_router import CCRouter
+
+
+class TestCCRouter(unittest.TestCase):
+    def test_route_by_size(self):
+        router = CCRouter(exact_max_size=4, sdp_max_size=10, nosdp_max_size=20)
+        assert [router.route(N) for N in [2, 4, 5, 10, 11, 20, 21, 1000]] == \
+               ["exact", "exact", "sdp", "sdp", "nosdp", "nosdp", "hac", "hac"]
+        # 0 disables a route, -1 means unlimited
+        router = CCRouter(exact_max_size=0, sdp_max_size=0, nosdp_max_size=-1)
+        assert router.route(3) == "nosdp" and router.route(10000) == "nosdp"
+
+    def test_time_budget(self):
+        router = CCRouter(sdp_max_size=-1, nosdp_max_size=0, time_budget=1.)
+        assert router.route(100) == "sdp"  # No observations yet
+        router.record(10, "sdp", 0.01)
+        assert router.predict_time("sdp", 20) == 0.08
+        assert router.route(40) == "sdp"  # 0.64s
+        assert router.route(50) == "hac"  # 1.25s
+        # Predictions extrapolate from the largest block seen on the route
+        router.record(50, "sdp", 0.5)
+        assert router.route(60) == "sdp"
+
+    def test_log(self):
+        router = CCRouter(exact_max_size=4, log_size=3)
+        for N in range(1, 6):
+            router.record(N, router.route(N), 0.1)
+        assert [N for N, _, _ in router.log] == [3, 4, 5]
+        assert router.stats() == {"exact": 2, "sdp": 1}
+        router.reset_log()
+        assert len(router.log) == 0
+        # The time predictions are kept
+        assert router.predict_time("sdp", 5) == 0.1
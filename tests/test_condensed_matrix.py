@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+import torch
+
+from utils.condensed_matrix import TriuIndexCache, compress, triu_indices, triu_indices_np, uncompress
+
+
+def reference_uncompress(condensed, N, make_symmetric=False, ones_diagonal=False):
+    # Sparse-tensor construction used before the shared index cache
+    idxs = torch.triu_indices(N, N, offset=1)
+    if make_symmetric:
+        sym_idxs = torch.stack((torch.cat((idxs[0], idxs[1])), torch.cat((idxs[1], idxs[0]))))
+        matrix = torch.sparse_coo_tensor(sym_idxs, torch.cat((condensed, condensed)), [N, N]).to_dense()
+    else:
+        matrix = torch.sparse_coo_tensor(idxs, condensed, [N, N]).to_dense()
+    if ones_diagonal:
+        matrix += torch.eye(N, dtype=condensed.dtype)
+    return matrix
+
+
+class TestCondensedMatrix(unittest.TestCase):
+    def test_triu_indices(self):
+        for N in [1, 2, 5, 30]:
+            rows, cols = triu_indices(N)
+            expected = torch.triu_indices(N, N, offset=1)
+            assert torch.equal(rows, expected[0]) and torch.equal(cols, expected[1])
+            rows, cols = triu_indices_np(N)
+            expected = np.triu_indices(N, k=1)
+            np.testing.assert_array_equal(rows, expected[0])
+            np.testing.assert_array_equal(cols, expected[1])
+
+    def test_cache(self):
+        cache = TriuIndexCache(max_pairs=20)
+        rows, _, flat = cache.get(5)  # 10 pairs
+        assert cache.get(5)[0] is rows
+        assert torch.equal(flat, rows * 5 + cache.get(5)[1])
+        cache.get(4)  # 6 pairs
+        cache.get(6)  # 15 pairs: evicts 5, then 4
+        assert len(cache) == 1 and cache.stats()["n_pairs"] == 15
+        cache.get(10)  # 45 pairs: not cached
+        assert len(cache) == 1 and cache.stats()["misses"] == 4
+
+    def test_uncompress_and_compress(self):
+        for N in [1, 2, 3, 7]:
+            for dtype in [torch.float32, torch.float64]:
+                for make_symmetric in [False, True]:
+                    for ones_diagonal in [False, True]:
+                        condensed = torch.randn(N * (N - 1) // 2, dtype=dtype, requires_grad=True)
+                        expected = reference_uncompress(condensed, N, make_symmetric, ones_diagonal)
+                        matrix = uncompress(condensed, N, make_symmetric, ones_diagonal)
+                        assert matrix.dtype == dtype and torch.equal(matrix, expected)
+                        # Same gradients
+                        upstream = torch.randn(N, N, dtype=dtype)
+                        grad, = torch.autograd.grad((matrix * upstream).sum(), condensed)
+                        expected_grad, = torch.autograd.grad((expected * upstream).sum(), condensed)
+                        assert torch.allclose(grad, expected_grad)
+                        assert torch.equal(compress(matrix.detach()), condensed.detach())
@@ -1,7 +1,21 @@
+import os
+import tempfile
 import unittest
 import pytest
+import numpy as np
+import torch
 
-from s2and.data import ANDData
+from sklearn.preprocessing import StandardScaler
+
+from s2and.data import (
+    ANDData,
+    S2BlocksDataset,
+    S2PairwiseStreamDataset,
+    BlockBucketSampler,
+    get_condensed_submatrix_indices,
+    get_blockwise_scaler_stats,
+    get_scaler_from_stats,
+)
 
 
 class TestData(unittest.TestCase):
@@ -209,4 +223,155 @@ class TestData(unittest.TestCase):
     def test_construct_cluster_to_signatures(self):
         cluster_to_signatures = self.dummy_dataset.construct_cluster_to_signatures({"a": ["0", "1"], "b": ["3", "4"]})
         expected_cluster_to_signatures = {"1": ["0", "1"], "3": ["3", "4"]}
-        assert cluster_to_signatures == expected_cluster_to_signatures
\ No newline at end of file
+        assert cluster_to_signatures == expected_cluster_to_signatures
+
+    def test_get_condensed_submatrix_indices(self):
+        n = 9
+        rows, cols = np.triu_indices(n, k=1)
+        pair_to_idx = {(i, j): k for k, (i, j) in enumerate(zip(rows, cols))}
+        for idxs_to_keep in [[], [4], [0, 8], [1, 2, 5, 7], list(range(n))]:
+            expected = [pair_to_idx[(i, j)] for i, j in zip(rows, cols) if i in idxs_to_keep and j in idxs_to_keep]
+            assert get_condensed_submatrix_indices(np.array(idxs_to_keep), n).tolist() == expected
+
+    def test_blocks_dataset_subsampling(self):
+        # Each pairwise row holds the (sorted) pair of signature indices, so the kept rows can be checked
+        n = 11
+        rows, cols = np.triu_indices(n, k=1)
+        X = np.stack([rows, cols], axis=1).astype(float)
+        y = (rows % 3 == cols % 3).astype(float)
+        cluster_ids = [f"c{i}" for i in range(n)]
+        np.random.seed(0)
+        dataset = S2BlocksDataset({"block": (X, y, cluster_ids)}, convert_nan=False, subsample_sz=4)
+        assert len(dataset) == 3
+        kept = []
+        for _X, _y, _cluster_ids in dataset.blockwise_data:
+            idxs = np.array([int(c[1:].split("_")[0]) for c in _cluster_ids])
+            sub_rows, sub_cols = np.triu_indices(len(idxs), k=1)
+            assert np.array_equal(_X, np.stack([idxs[sub_rows], idxs[sub_cols]], axis=1))
+            assert np.array_equal(_y, (idxs[sub_rows] % 3 == idxs[sub_cols] % 3).astype(float))
+            kept += idxs.tolist()
+        assert sorted(kept) == list(range(n))
+
+    def test_blockwise_scaler_stats(self):
+        rng = np.random.RandomState(0)
+        block_dict = {}
+        for b, n_pairs in enumerate([0, 1, 6, 15, 28]):
+            X = rng.rand(n_pairs, 5) * 10
+            X[rng.rand(n_pairs, 5) < 0.3] = np.nan
+            X[:, 1] = np.nan
+            X[:, 3] = 2.0
+            block_dict[str(b)] = (X, np.zeros(n_pairs), [])
+        stats = get_blockwise_scaler_stats(block_dict)
+        assert stats["n_samples_seen"].tolist()[1] == 0
+        feat_idxs = np.array([0, 2, 3, 4])
+        all_X = np.concatenate([X for X, _, _ in block_dict.values()])[:, feat_idxs]
+        expected = StandardScaler().fit(all_X)
+        scaler = get_scaler_from_stats(stats, feat_idxs)
+        np.testing.assert_allclose(scaler.mean_, expected.mean_)
+        np.testing.assert_allclose(scaler.scale_, expected.scale_)
+        np.testing.assert_allclose(scaler.transform(all_X), expected.transform(all_X))
+
+    def test_blocks_dataset_materialize(self):
+        rng = np.random.RandomState(0)
+        block_dict = {}
+        for b, n in enumerate([1, 4, 7]):
+            X = rng.rand(n * (n - 1) // 2, 4)
+            X[rng.rand(*X.shape) < 0.3] = np.nan
+            block_dict[str(b)] = (X, rng.randint(0, 2, len(X)).astype(float), [str(i) for i in range(n)])
+        source = {k: (X.copy(), y, c) for k, (X, y, c) in block_dict.items()}
+        kwargs = dict(convert_nan=True, nan_value=-1, scale=True, feat_idxs=np.array([0, 1, 3]), sort_desc=True)
+        expected = S2BlocksDataset(source, **kwargs)
+        dataset = S2BlocksDataset(block_dict, **kwargs).materialize()
+        assert dataset.materialized
+        for i in range(len(dataset)):
+            X, y, cluster_ids = dataset[i]
+            _X, _y, _cluster_ids = expected[i]
+            assert X.dtype == torch.float32 and y.dtype == torch.float32
+            np.testing.assert_array_equal(X.numpy(), _X.astype(np.float32))
+            np.testing.assert_array_equal(y.numpy(), _y.astype(np.float32))
+            assert cluster_ids == _cluster_ids
+        # The source arrays are not modified
+        assert all(np.isnan(X).any() for X, _, _ in block_dict.values() if len(X) > 1)
+        # Cached to (and then mapped from) cache_dir, without leaving temporary files behind
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                cached = S2BlocksDataset(block_dict, **kwargs).materialize(cache_dir=cache_dir, source_key="train")
+                assert len(os.listdir(cache_dir)) == 2
+                for i in range(len(cached)):
+                    np.testing.assert_array_equal(cached[i][0].numpy(), dataset[i][0].numpy())
+                    np.testing.assert_array_equal(cached[i][1].numpy(), dataset[i][1].numpy())
+
+    def test_block_bucket_sampler(self):
+        sizes = [1, 2, 9, 3, 12, 5, 4, 8]
+        block_dict = {
+            str(b): (np.zeros((n * (n - 1) // 2, 2)), np.zeros(n * (n - 1) // 2), [str(i) for i in range(n)])
+            for b, n in enumerate(sizes)
+        }
+        dataset = S2BlocksDataset(block_dict, convert_nan=False)
+        n_pairs = np.array([n * (n - 1) // 2 for n in sizes])
+
+        sampler = BlockBucketSampler(dataset, pair_budget=20, bucket_ratio=2.0, min_pairs=1)
+        order = list(sampler)
+        assert sorted(order) == list(range(len(sizes)))
+        # Buckets [8, 16), [4, 8), [2, 4), [1, 2), visited from the largest sizes down
+        bucket_idxs = np.floor(np.log2(np.array(sizes)[order]))
+        assert (np.diff(bucket_idxs) <= 0).all()
+        # Every step but the last has at least pair_budget pairs, and ends at its last counted block
+        steps, start = [], 0
+        for i in range(len(order)):
+            n_blocks, step_end = sampler.get_step(i)
+            if step_end:
+                steps.append(order[start : i + 1])
+                start = i + 1
+                assert n_blocks == sum(n_pairs[idx] >= 1 for idx in steps[-1])
+        assert all(n_pairs[step].sum() >= 20 for step in steps[:-1])
+        assert sampler.step_sizes == [len([idx for idx in step if n_pairs[idx] >= 1]) for step in steps]
+        # The single-signature block (no pairs) is sampled last, after the end of the last step
+        assert order[-1] == 0 and start == len(order) - 1
+
+        sampler = BlockBucketSampler(dataset, pair_budget=1, bucket_ratio=None)
+        assert list(sampler) == list(range(len(sizes)))
+        assert [sampler.get_step(i) for i in range(len(sizes))] == [(1, False), (1, True)] + [(1, True)] * 6
+        np.random.seed(0)
+        sampler = BlockBucketSampler(dataset, pair_budget=1, bucket_ratio=2.0, shuffle=True)
+        assert sorted(list(sampler)) == list(range(len(sizes)))
+
+    def test_pairwise_stream_dataset(self):
+        rng = np.random.RandomState(0)
+        block_dict = {}
+        for b, n in enumerate([1, 3, 8, 5, 12, 2]):
+            X = rng.rand(n * (n - 1) // 2, 4)
+            X[rng.rand(*X.shape) < 0.2] = np.nan
+            block_dict[str(b)] = (X, rng.randint(0, 2, len(X)).astype(float), [str(i) for i in range(n)])
+        kwargs = dict(convert_nan=True, nan_value=-1, scale=True, feat_idxs=np.array([0, 2, 3]))
+        expected = S2BlocksDataset(block_dict, pairwise_mode=True, **kwargs)
+        expected_X, expected_y = expected[:]
+
+        for buffer_size in [0, 7, 1000]:
+            dataset = S2PairwiseStreamDataset(block_dict, 4, buffer_size=buffer_size, **kwargs)
+            assert dataset.n_features == 3
+            assert dataset.get_label_stats() == expected.get_label_stats()
+            batches = list(dataset)
+            assert len(batches) == -(-len(expected_y) // 4)
+            assert all(len(y) == 4 for _, y in batches[:-1])
+            X = torch.cat([X for X, _ in batches]).numpy()
+            y = torch.cat([y for _, y in batches]).numpy()
+            assert X.dtype == np.float32 and y.dtype == np.float32
+            # The same pairs (rows with their labels), shuffled or not
+            order, expected_order = np.lexsort(np.c_[X, y].T), np.lexsort(np.c_[expected_X, expected_y].T)
+            np.testing.assert_allclose(X[order], expected_X[expected_order], rtol=1e-5, atol=1e-6)
+            np.testing.assert_array_equal(y[order], expected_y[expected_order])
+            if buffer_size == 0:
+                np.testing.assert_allclose(X, expected_X, rtol=1e-5, atol=1e-6)
+
+        # The feature count skips single-signature blocks, stored as (0,) arrays in the features pickles
+        single_first = {"a": (np.zeros((0,)), np.zeros((0,)), ["0"]), **block_dict}
+        assert S2PairwiseStreamDataset(single_first, 4, convert_nan=False).n_features == 4
+
+        # Large blocks are split into the same chunks at every pass
+        dataset = S2PairwiseStreamDataset(block_dict, 5, subsample_sz=4, buffer_size=10, **kwargs)
+        stats = dataset.get_label_stats()
+        assert stats["n_pairs"] == 3 + (6 + 6) + (6 + 0) + (6 + 6 + 6) + 1
+        for _ in range(2):
+            assert sum(len(y) for _, y in dataset) == stats["n_pairs"]
+            assert sum(float(y.sum()) for _, y in dataset) == stats["n_pos"]
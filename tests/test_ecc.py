@@ -0,0 +1,75 @@
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from ecc.ecc import EccClusterer
+
+
+def reference_bookkeeping(features, ecc_mx):
+    """
+    The constraint bookkeeping of all the ECCs (rows of ecc_mx), recomputed from scratch as add_constraint did before
+    it was made incremental. Returns incompat_mx, the points satisfying each positive feature of each ECC and var_vals
+    """
+    num_points, num_ecc = features.shape[0], ecc_mx.shape[0]
+    # A point or ECC is incompatible with an ECC if one of them requires a feature that the other excludes
+    nodes = np.vstack([features, ecc_mx])
+    incompat_mx = np.any(nodes[:, None, :] * ecc_mx[None, :, :] == -1, axis=2)
+    pos_feats_points = [(i, np.where((features[:, feat] > 0) & ~incompat_mx[:num_points, i])[0])
+                        for i in range(num_ecc) for feat in np.where(ecc_mx[i] > 0)[0]]
+    # If there is no way a single cluster can satisfy both constraints...
+    for i, points in pos_feats_points:
+        for j in range(i + 1, num_ecc):
+            if np.all(incompat_mx[points, j]):
+                incompat_mx[i, j] = True
+                incompat_mx[j, i] = True
+    var_vals = {}
+    for i in range(num_ecc):
+        for pos_feat_idx, points in enumerate([points for k, points in pos_feats_points if k == i]):
+            if points.size > 0:
+                var_vals[(pos_feat_idx, i)] = points.tolist()
+    var_vals = dict(sorted(var_vals.items(), key=lambda x: len(x[1])))
+    return incompat_mx, pos_feats_points, var_vals
+
+
+def random_constraint(n_feats, max_pos_feats, rng):
+    # Some positive features, and some of the others negative
+    row = np.zeros(n_feats)
+    pos_feats = rng.choice(n_feats, size=int(rng.integers(1, min(max_pos_feats, n_feats) + 1)), replace=False)
+    row[pos_feats] = 1
+    other_feats = np.setdiff1d(np.arange(n_feats), pos_feats)
+    row[rng.choice(other_feats, size=int(rng.integers(0, len(other_feats) + 1)), replace=False)] = -1
+    return row
+
+
+class TestEccClusterer(unittest.TestCase):
+    def test_add_constraint(self):
+        rng = np.random.default_rng(0)
+        for _ in range(30):
+            num_points, n_feats, max_num_ecc, max_pos_feats = (int(rng.integers(3, 15)), int(rng.integers(3, 8)),
+                                                               int(rng.integers(1, 8)), 4)
+            features = (rng.random((num_points, n_feats)) < 0.4).astype(float)
+            W = csr_matrix(np.triu(rng.normal(size=(num_points, num_points)), 1))
+            clusterer = EccClusterer(W, csr_matrix(features), max_num_ecc, max_pos_feats, 10)
+            ecc_rows = []
+            for num_ecc in range(1, max_num_ecc + 1):
+                ecc_rows.append(random_constraint(n_feats, max_pos_feats, rng))
+                clusterer.add_constraint(csr_matrix(ecc_rows[-1]))
+                incompat_mx, pos_feats_points, var_vals = reference_bookkeeping(features, np.vstack(ecc_rows))
+                active_n = num_points + num_ecc
+
+                np.testing.assert_array_equal(clusterer.incompat_mx, incompat_mx)
+                np.testing.assert_array_equal(clusterer.ecc_mx.toarray(), np.vstack(ecc_rows))
+                # Incompatible nodes cannot be clustered with the ECC
+                np.testing.assert_array_equal(clusterer.U.value[:num_ecc, :active_n], ~incompat_mx.T)
+                assert np.all(clusterer.U.value[num_ecc:] == 1) and np.all(clusterer.U.value[:, active_n:] == 1)
+                for i in range(num_ecc):
+                    ecc_pos_feats_points = [points for k, points in pos_feats_points if k == i]
+                    for pos_feat_idx, A in enumerate(clusterer.As):
+                        expected = np.ones(num_points + max_num_ecc)
+                        if pos_feat_idx < len(ecc_pos_feats_points):
+                            expected[:] = 0
+                            expected[ecc_pos_feats_points[pos_feat_idx]] = 1
+                        np.testing.assert_array_equal(A.value[:, i], expected)
+                assert list(clusterer.var_vals) == list(var_vals)
+                assert all(list(clusterer.var_vals[key]) == points for key, points in var_vals.items())
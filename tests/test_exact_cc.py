@@ -0,0 +1,69 @@
+import unittest
+import itertools
+
+import numpy as np
+import torch
+
+from e2e_pipeline.exact_cc import solve_exact_cc
+from e2e_pipeline.cc_inference import CCInference
+from e2e_pipeline.model import EntResModel
+from utils.condensed_matrix import triu_indices_np
+
+
+def intra_cluster_objective(W, labels):
+    labels = np.asarray(labels)
+    round_matrix = torch.tensor(labels[:, None] == labels[None, :], dtype=W.dtype)
+    return torch.sum(W * torch.triu(round_matrix, diagonal=1)).item()
+
+
+def brute_force_objective(W, N):
+    # Best intra-cluster objective over all labelings with at most N labels
+    return max(intra_cluster_objective(W, labels) for labels in itertools.product(range(N), repeat=N))
+
+
+def random_weight_matrix(N, rng):
+    W = torch.zeros(N, N)
+    rows, cols = triu_indices_np(N)
+    W[rows, cols] = torch.tensor(rng.randn(len(rows)), dtype=torch.float32)
+    return W
+
+
+class TestExactCC(unittest.TestCase):
+    def test_solve_exact_cc(self):
+        rng = np.random.RandomState(0)
+        for N in range(1, 6):
+            W = random_weight_matrix(N, rng)
+            labels, round_matrix, _ = solve_exact_cc(W, N)
+            assert len(labels) == N
+            np.testing.assert_array_equal(
+                round_matrix.numpy(), (labels[:, None] == labels[None, :]).numpy().astype(np.float32)
+            )
+            assert np.isclose(intra_cluster_objective(W, labels), brute_force_objective(W, N), atol=1e-5)
+
+    def test_exact_not_worse_than_sdp_rounding(self):
+        rng = np.random.RandomState(1)
+        exact = CCInference(1000, 1e-4, True, True, exact_max_size=8)
+        sdp = CCInference(1000, 1e-4, True, True, exact_max_size=0)
+        for N in [3, 5, 7]:
+            W = random_weight_matrix(N, rng)
+            edge_weights = W[triu_indices_np(N)]
+            exact_labels = exact(edge_weights, N)
+            sdp_labels = sdp(edge_weights, N)
+            assert exact.route == "exact" and sdp.route == "sdp"
+            assert intra_cluster_objective(W, exact_labels) >= intra_cluster_objective(W, sdp_labels) - 1e-5
+
+    def test_single_signature_block(self):
+        cc_inference = CCInference(1000, 1e-3, True, True, exact_max_size=10)
+        assert cc_inference(torch.zeros(0), 1) == [0]
+        assert cc_inference.round_objective_value == 0
+        # All-zero weights are not scaled either
+        cc_inference(torch.zeros(3), 3)
+        assert not np.isnan(cc_inference.round_objective_value)
+
+        model = EntResModel(5, 2, 0.0, False, False, False, 8, 1, False, False, "leaky_relu", 0.01, None, 1000, 1e-3,
+                            True, exact_max_size=10)
+        model.eval()
+        with torch.no_grad():
+            model(torch.rand(0, 5), 1)
+        assert model.cluster_labels.tolist() == [0]
+        assert model.round_objective_value == 0 and model.frac_objective_value == 0
@@ -0,0 +1,160 @@
+import unittest
+
+import numpy as np
+import torch
+
+from e2e_pipeline.hac_cut_layer import HACCutLayer
+from e2e_pipeline.sdp_layer import SDPLayer
+from utils.condensed_matrix import compress
+
+
+def reference_hac_cut(X, weights, _MAX_DIST=1000):
+    """
+    The torch merge loop that HACCutLayer.get_rounded_solution replaces (with use_similarities and
+    max_similarity=max(X), as in forward). Returns round_matrix, cluster_labels, parents and objective_value
+    """
+    D = X.size(1)
+    parents = torch.arange(D + (D - 1))
+    parent_to_idx = torch.arange(D + (D - 1))
+    idx_to_parent = torch.arange(D)
+    cluster_sizes = torch.ones(D + (D - 1))
+    energy = torch.zeros(D + (D - 1))
+    clustering = torch.zeros((D + (D - 1), D))
+    clustering[torch.arange(D), torch.arange(D)] = torch.arange(1, D + 1, dtype=clustering.dtype)
+    round_matrix = torch.eye(D)
+
+    _MAX_DIST = torch.max(torch.abs(X)) * _MAX_DIST
+    Y = _MAX_DIST * torch.ones(D, D).tril() + (torch.max(X) - X).triu(1)
+    values, indices = torch.min(Y, dim=1)
+    max_node = D - 1
+    for i in range(D - 1):
+        max_node += 1
+        merge_idx_1 = torch.argmin(values).item()
+        merge_idx_2 = indices[merge_idx_1].item()
+        parent_1 = idx_to_parent[parent_to_idx[idx_to_parent[merge_idx_1]]].item()
+        parent_2 = idx_to_parent[parent_to_idx[idx_to_parent[merge_idx_2]]].item()
+        parents[parent_1] = max_node
+        parents[parent_2] = max_node
+        idx_to_parent[merge_idx_1] = max_node
+        parent_to_idx[max_node] = merge_idx_1
+
+        max_dist_mask = Y == _MAX_DIST
+        new_cluster_size = cluster_sizes[parent_1] + cluster_sizes[parent_2]
+        cluster_sizes[max_node] = new_cluster_size
+        new_merge_idx_1_values = (torch.min(Y[merge_idx_1, :], Y[:, merge_idx_1]) * cluster_sizes[parent_1] +
+                                  torch.min(Y[:, merge_idx_2], Y[merge_idx_2, :]) * cluster_sizes[parent_2]) / \
+            new_cluster_size
+        Y[:, merge_idx_1] = new_merge_idx_1_values
+        Y[merge_idx_1, :] = new_merge_idx_1_values
+        Y[max_dist_mask] = _MAX_DIST
+        Y[:, merge_idx_2] = _MAX_DIST
+        Y[merge_idx_2, :] = _MAX_DIST
+        values[merge_idx_2] = _MAX_DIST
+        max_dist_mask = values == _MAX_DIST
+        values, indices = torch.min(Y, dim=1)
+        values[max_dist_mask] = _MAX_DIST
+
+        clustering[max_node] = clustering[parent_1] + clustering[parent_2]
+        leaf_indices = torch.where(clustering[max_node])[0]
+        leaf_edges = torch.meshgrid(leaf_indices, leaf_indices, indexing='ij')
+        energy[max_node] = energy[parent_1] + energy[parent_2]
+        merge_energy = torch.sum(weights[leaf_edges])
+        if merge_energy >= energy[max_node]:
+            energy[max_node] = merge_energy
+            clustering[max_node][clustering[max_node] > 0] = max_node
+            round_matrix[leaf_edges] = 1
+
+    objective_matrix = weights * torch.triu(round_matrix, diagonal=1)
+    objective_value = (energy[max_node] - torch.sum(objective_matrix[objective_matrix < 0])).item()
+    return round_matrix, clustering[-1], parents, objective_value
+
+
+def random_blocks(n_blocks, max_size=20, seed=0):
+    # Random (X, W) pairs, with ties in X for some blocks and integral X for others
+    rng = np.random.default_rng(seed)
+    blocks = []
+    for b in range(n_blocks):
+        N = int(rng.integers(2, max_size))
+        W = torch.tensor(rng.normal(size=(N, N)), dtype=torch.float32 if b % 2 else torch.float64).triu(1)
+        X = torch.rand(N, N, dtype=torch.float64)
+        X = (X + X.T) / 2
+        X.fill_diagonal_(1)
+        if b % 3 == 0:
+            X = torch.round(X * 4) / 4
+        if b % 5 == 0:
+            X = (W.double() + W.double().T > 0).double()
+            X.fill_diagonal_(1)
+        blocks.append((X, W))
+    return blocks
+
+
+class TestHACCutLayer(unittest.TestCase):
+    def test_matches_reference(self):
+        layer = HACCutLayer()
+        for X, W in random_blocks(100):
+            round_matrix, cluster_labels, parents, objective_value = reference_hac_cut(X.clone(), W.clone())
+            layer.get_rounded_solution(X.clone(), W.clone(), max_similarity=torch.max(X))
+            assert torch.equal(layer.round_matrix, round_matrix)
+            assert torch.equal(layer.cluster_labels.float(), cluster_labels)
+            assert torch.equal(layer.parents, parents)
+            assert abs(layer.objective_value - objective_value) < 1e-4
+
+    def test_node_energies(self):
+        layer = HACCutLayer()
+        for X, W in random_blocks(30, seed=1):
+            N = len(X)
+            layer.get_rounded_solution(X.clone(), W.clone(), max_similarity=torch.max(X))
+            parents = layer.parents.numpy()
+            W_np = W.double().numpy()
+            leaves = [[i] for i in range(N)] + [[] for _ in range(N - 1)]
+            children = [[] for _ in range(2 * N - 1)]
+            for node in range(2 * N - 2):
+                children[parents[node]].append(node)
+            for node in range(N, 2 * N - 1):
+                leaves[node] = sorted(leaves[children[node][0]] + leaves[children[node][1]])
+                intra = W_np[np.ix_(leaves[node], leaves[node])].sum()
+                assert abs(layer.cluster_energies[node].item() - intra) < 1e-4
+                # Best cut of the subtree: the node itself, or the best cuts of its children
+                best = max(intra, sum(layer.node_energies[c].item() for c in children[node]))
+                assert abs(layer.node_energies[node].item() - best) < 1e-4
+            assert torch.all(layer.node_energies[:N] == 0)
+            # The root energy is the intra-cluster weight of the rounded solution
+            intra_total = torch.sum(W.double() * torch.triu(layer.round_matrix.double(), diagonal=1)).item()
+            assert abs(layer.node_energies[-1].item() - intra_total) < 1e-4
+
+    def test_batched(self):
+        layer = HACCutLayer()
+        blocks = random_blocks(60, seed=2)
+        cluster_labels, objective_values = layer.get_rounded_solutions([X.clone() for X, _ in blocks],
+                                                                       [W.clone() for _, W in blocks])
+        for (X, W), labels, objective_value in zip(blocks, cluster_labels, objective_values):
+            layer.get_rounded_solution(X.clone(), W.clone(), max_similarity=torch.max(X))
+            assert torch.equal(labels, layer.cluster_labels)
+            assert abs(objective_value - layer.objective_value) < 1e-4
+
+    def test_condensed(self):
+        layer = HACCutLayer()
+        blocks = random_blocks(60, seed=3)
+        # The diagonal of the dense solutions (1) is the fill value of the condensed ones
+        xs, ws, Ns = [compress(X) for X, _ in blocks], [compress(W) for _, W in blocks], [len(X) for X, _ in blocks]
+        cluster_labels, objective_values = layer.get_rounded_solutions_condensed(xs, ws, Ns, fill_value=1.)
+        for (X, W), x, w, labels, objective_value in zip(blocks, xs, ws, cluster_labels, objective_values):
+            layer.get_rounded_solution(X.clone(), W.clone(), max_similarity=torch.max(X))
+            dense_labels, dense_objective_value = layer.cluster_labels, layer.objective_value
+            round_condensed = layer.get_rounded_solution_condensed(x.clone(), w.clone(), len(X), fill_value=1.)
+            assert torch.equal(layer.cluster_labels, dense_labels) and torch.equal(labels, dense_labels)
+            assert abs(layer.objective_value - dense_objective_value) < 1e-4
+            assert abs(objective_value - dense_objective_value) < 1e-4
+            assert torch.equal(round_condensed, compress(reference_hac_cut(X.clone(), W.clone())[0]))
+
+    def test_condensed_all_zero(self):
+        # Scaling leaves all-zero blocks as is (no NaNs from 0 / 0)
+        layer, sdp_layer = HACCutLayer(), SDPLayer(scale_input=True)
+        N = 6
+        W_val, x = sdp_layer.forward_condensed(torch.zeros(N * (N - 1) // 2), N)
+        assert torch.equal(W_val, torch.zeros(N * (N - 1) // 2))
+        assert torch.all(x == 0.5)
+        assert sdp_layer.objective_value == 0.
+        round_condensed = layer.forward_condensed(x, W_val, N, fill_value=0.5)
+        assert torch.isfinite(round_condensed).all()
+        assert layer.objective_value == 0.
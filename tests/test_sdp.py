@@ -0,0 +1,186 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from e2e_pipeline.sdp_layer import SDPLayer, SDPProblemCache, SDPWarmStartStore, SDP_PROBLEM_CACHE, CvxpyException
+from e2e_pipeline.sdp_pool import SDPWorkerPool, solve_sdp_batch
+from e2e_pipeline.lowrank_sdp import solve_lowrank_sdp
+from e2e_pipeline.reduction_layer import CCReductionLayer
+
+
+def random_weight_matrices(sizes, seed=0):
+    torch.manual_seed(seed)
+    return [torch.triu(torch.randn(N, N, dtype=torch.float64), diagonal=1) for N in sizes]
+
+
+class TestSDPProblemCache(unittest.TestCase):
+    def test_lru(self):
+        cache = SDPProblemCache(maxsize=2)
+        problem = cache.get(3)
+        assert cache.get(3) is problem
+        cache.get(4)
+        cache.get(3)
+        cache.get(5)  # Evicts 4, the least recently used
+        assert len(cache) == 2
+        assert cache.get(3) is problem
+        assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 3
+        cache.resize(1)  # Keeps 3, the most recently used
+        assert len(cache) == 1 and cache.get(3) is problem
+
+    def test_cached_solves_match(self):
+        W = random_weight_matrices([6])[0]
+        sdp_layer = SDPLayer(max_iters=50000, eps=1e-6)
+        sdp_layer.eval()
+        SDP_PROBLEM_CACHE.clear()
+        X = sdp_layer(W.clone(), 6)
+        # Solved again on the cached problem, then on a freshly compiled one
+        X_cached = sdp_layer(W.clone(), 6)
+        assert SDP_PROBLEM_CACHE.stats()["hits"] == 1
+        SDP_PROBLEM_CACHE.clear()
+        X_fresh = sdp_layer(W.clone(), 6)
+        np.testing.assert_allclose(X_cached.numpy(), X.numpy(), atol=1e-5)
+        np.testing.assert_allclose(X_fresh.numpy(), X.numpy(), atol=1e-5)
+
+        # Differentiable solves (through the cached cvxpylayer) match the eval solves
+        sdp_layer.train()
+        W_grad = W.clone().requires_grad_()
+        X_train = sdp_layer(W_grad, 6)
+        X_train.sum().backward()
+        np.testing.assert_allclose(X_train.detach().numpy(), X.numpy(), atol=1e-5)
+        assert torch.isfinite(W_grad.grad).all()
+
+
+class TestLowRankSDP(unittest.TestCase):
+    def test_matches_scs(self):
+        sdp_layer = SDPLayer(max_iters=50000, eps=1e-6)
+        sdp_layer.eval()
+        for W in random_weight_matrices([8, 12, 16], seed=1):
+            N = len(W)
+            X, _ = solve_lowrank_sdp(W, N, max_iters=5000)
+            # Feasible: symmetric, unit diagonal, nonnegative and PSD
+            np.testing.assert_allclose(X.numpy(), X.numpy().T, atol=1e-10)
+            np.testing.assert_allclose(np.diag(X.numpy()), 1., atol=1e-10)
+            assert X.min() >= 0 and torch.linalg.eigvalsh(X).min() >= -1e-8
+            # Close to (and, up to the SCS tolerance, not above) the SDP optimum
+            objective, scs_objective = torch.sum(W * X).item(), torch.sum(W * sdp_layer(W.clone(), N)).item()
+            assert 0.98 * scs_objective <= objective <= scs_objective + 1e-4
+
+    def test_differentiable(self):
+        W = random_weight_matrices([10])[0].requires_grad_()
+        sdp_layer = SDPLayer(max_iters=5000, solver="lowrank")
+        sdp_layer.train()
+        X = sdp_layer(W * 1., 10)
+        X.sum().backward()
+        assert torch.isfinite(W.grad).all() and W.grad.abs().sum() > 0
+
+
+class TestSDPWarmStart(unittest.TestCase):
+    def test_store(self):
+        result = {'x': np.ones(10), 'y': np.zeros(5), 's': np.zeros(5), 'info': {'iter': 100}}
+        with tempfile.TemporaryDirectory() as spill_dir:
+            # Room for one entry only: the least recently used one is spilled
+            store = SDPWarmStartStore(max_memory_mb=160 / (1024 * 1024), spill_dir=spill_dir)
+            store.put('a', 4, result)
+            store.put('b', 4, dict(result, info={'iter': 40}))
+            assert len(store) == 1 and len(os.listdir(spill_dir)) == 1
+            x, _, _ = store.get('a', 4)  # Read back from the spill directory
+            np.testing.assert_array_equal(x, result['x'])
+            assert store.get('a', 5) is None  # Stored for another problem size
+            store.put('a', 4, dict(result, info={'iter': 30}))
+            assert store.stats()['iters_saved'] == 70
+            # Warm starts outlive the store through the spill directory
+            store.flush()
+            assert SDPWarmStartStore(spill_dir=spill_dir).get('b', 4) is not None
+
+    def test_warm_started_solves_match(self):
+        W = random_weight_matrices([8])[0]
+        R = torch.rand(8, 8, dtype=torch.float64)  # Random upstream gradient
+        cold = SDPLayer(max_iters=50000, eps=1e-6)
+        warm = SDPLayer(max_iters=50000, eps=1e-6, warm_start=True)
+        for layer in [cold, warm]:
+            layer.train()
+        for epoch in range(3):
+            W_epoch = W + 0.01 * epoch * random_weight_matrices([8], seed=epoch + 1)[0]
+            W_cold, W_warm = W_epoch.clone().requires_grad_(), W_epoch.clone().requires_grad_()
+            X_cold, X_warm = cold(W_cold, 8), warm(W_warm, 8, block_id='block')
+            (X_cold * R).sum().backward()
+            (X_warm * R).sum().backward()
+            np.testing.assert_allclose(X_warm.detach().numpy(), X_cold.detach().numpy(), atol=1e-4)
+            np.testing.assert_allclose(W_warm.grad.numpy(), W_cold.grad.numpy(), atol=1e-4)
+        assert warm.warm_start_store.stats()['hits'] == 2
+
+
+class TestCCReductionLayer(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        # Two groups of 5 with only negative edges between them, and one overwhelmingly positive edge
+        rng = np.random.RandomState(0)
+        labels = np.repeat([0, 1], 5)
+        W = np.where(labels[:, None] == labels[None, :], rng.randn(10, 10), -rng.rand(10, 10))
+        W[0, 1] = 100.
+        self.W = torch.triu(torch.tensor(W), diagonal=1)
+
+    def test_reduction(self):
+        reduction = CCReductionLayer().get_reduction(self.W, 10)
+        components = sorted([list(node_idxs) for node_idxs, _, _ in reduction])
+        assert components == [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]]
+        for node_idxs, super_node_labels, n_super_nodes in reduction:
+            if 0 in node_idxs:
+                # Nodes 0 and 1 are contracted
+                assert n_super_nodes == 4 and super_node_labels[0] == super_node_labels[1]
+            else:
+                assert n_super_nodes == 5
+
+    def test_matches_full_sdp(self):
+        sdp_layer = SDPLayer(max_iters=50000, eps=1e-6)
+        sdp_layer.eval()
+        X = sdp_layer(self.W.clone(), 10)
+        reduction_layer = CCReductionLayer()
+        X_reduced = reduction_layer(self.W.clone(), 10, sdp_layer)
+        assert sorted(reduction_layer.reduced_sizes) == [4, 5]
+        assert torch.all(X_reduced[:5, 5:] == 0)
+        assert abs(torch.sum(self.W * X_reduced).item() - torch.sum(self.W * X).item()) < 1e-4
+
+        sdp_layer.train()
+        W = self.W.clone().requires_grad_()
+        reduction_layer(W * 1., 10, sdp_layer, return_triu=True).sum().backward()
+        assert torch.isfinite(W.grad).all()
+
+
+class TestSDPWorkerPool(unittest.TestCase):
+    def test_pool_matches_serial(self):
+        sizes = [5, 7, 4, 6]
+        sdp_layer = SDPLayer(max_iters=50000, eps=1e-6)
+        sdp_layer.train()
+
+        W_vals = [W.clone().requires_grad_() for W in random_weight_matrices(sizes)]
+        Xs = [sdp_layer(W, N) for W, N in zip(W_vals, sizes)]
+        sum((X * torch.arange(X.numel()).reshape(X.shape)).sum() for X in Xs).backward()
+
+        pool = SDPWorkerPool(2, cache_size=2)
+        try:
+            pool_W_vals = [W.clone().detach().requires_grad_() for W in random_weight_matrices(sizes)]
+            pool_Xs = solve_sdp_batch(sdp_layer, pool_W_vals, [None] * len(sizes), pool)
+            sum((X * torch.arange(X.numel()).reshape(X.shape)).sum() for X in pool_Xs).backward()
+        finally:
+            pool.close()
+
+        for X, pool_X, W, pool_W in zip(Xs, pool_Xs, W_vals, pool_W_vals):
+            np.testing.assert_allclose(pool_X.detach().numpy(), X.detach().numpy(), atol=1e-6)
+            np.testing.assert_allclose(pool_W.grad.numpy(), W.grad.numpy(), atol=1e-4)
+
+    def test_dead_worker_raises(self):
+        pool = SDPWorkerPool(1)
+        try:
+            pool._workers[0].terminate()
+            pool._workers[0].join()
+            W_np = random_weight_matrices([4])[0].numpy()
+            with mock.patch('e2e_pipeline.sdp_pool.POLL_INTERVAL', 0.1):
+                with self.assertRaises(CvxpyException):
+                    pool.solve([W_np], {"solve_method": "SCS", "max_iters": 100, "eps": 1e-3}, [None])
+        finally:
+            pool.close()
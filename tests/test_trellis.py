@@ -0,0 +1,195 @@
+import unittest
+
+import higra as hg
+import numpy as np
+import torch
+from scipy.sparse import coo_matrix, csr_matrix
+
+from e2e_pipeline.hac_cut_layer import HACCutLayer
+from e2e_pipeline.sdp_layer import get_max_agree_objective
+from e2e_pipeline.trellis_cut_layer import TrellisCutLayer
+from ecc.trellis import LINKAGES, Trellis, build_trellis_from_trees
+from utils.trellis_helper_fns import build_trellis, cut_trellis
+from tests.test_hac_cut import random_blocks
+
+
+def reference_build_trellis(trees):
+    # Trellis nodes looked up by their leaf sets, with the child pair ordering of the numba builder: the first pair
+    # of a node in tree order (children in node-index order), later pairs sorted
+    num_leaves = (trees.shape[1] + 1) // 2
+    node_ids = {(i,): i for i in range(num_leaves)}
+    node_leaves = [(i,) for i in range(num_leaves)]
+    child_pairs = [[] for _ in range(num_leaves)]
+    for tree in trees:
+        tree_to_trellis = list(range(num_leaves))
+        for curr in range(num_leaves, len(tree)):
+            lchild, rchild = [tree_to_trellis[child] for child in np.where(tree == curr)[0] if child != curr]
+            leaves = tuple(sorted(node_leaves[lchild] + node_leaves[rchild]))
+            if leaves not in node_ids:
+                node_ids[leaves] = len(node_leaves)
+                node_leaves.append(leaves)
+                child_pairs.append([(lchild, rchild)])
+            elif all(pair[0] != lchild for pair in child_pairs[node_ids[leaves]]):
+                child_pairs[node_ids[leaves]].append(tuple(sorted((lchild, rchild))))
+            tree_to_trellis.append(node_ids[leaves])
+    leaves_indptr = np.cumsum([0] + [len(leaves) for leaves in node_leaves])
+    leaves_indices = np.array([leaf for leaves in node_leaves for leaf in leaves])
+    child_pairs_indptr = np.cumsum([0] + [2 * len(pairs) for pairs in child_pairs])
+    child_pairs_indices = np.array([node for pairs in child_pairs for pair in pairs for node in pair])
+    return leaves_indptr, leaves_indices, child_pairs_indptr, child_pairs_indices
+
+
+def random_trees(n, seed, ties=False):
+    # Parents arrays of the trees of all linkages on a random similarity matrix, with tied similarities if `ties`
+    rng = np.random.default_rng(seed)
+    A = rng.random((n, n))
+    if ties:
+        A = np.round(A * 3) / 3
+    A = (A + A.T) / 2
+    np.fill_diagonal(A, 0)
+    g, w = hg.adjacency_matrix_2_undirected_graph(A)
+    return np.vstack(Trellis.build_trees(g, -w, list(LINKAGES)))
+
+
+def trellis_cuts(t, node, cuts=None):
+    # All the clusterings (lists of leaf tuples) of the leaves of `node` made of trellis nodes
+    cuts = {} if cuts is None else cuts
+    if node not in cuts:
+        cuts[node] = [[tuple(t.leaves_indices[t.leaves_indptr[node]:t.leaves_indptr[node + 1]])]]
+        for lchild, rchild in t.get_child_pairs_iter(node):
+            cuts[node] += [lcut + rcut for lcut in trellis_cuts(t, lchild, cuts)
+                           for rcut in trellis_cuts(t, rchild, cuts)]
+    return cuts[node]
+
+
+def cut_energy(W, clusters):
+    return sum(W[np.ix_(cluster, cluster)].sum() for cluster in clusters)
+
+
+def num_ecc_satisfied(features, ecc_mx, clusters):
+    # ECCs (the leaves after the points) satisfied by the features of the points clustered with them
+    num_points, num_sat = features.shape[0], 0
+    for cluster in clusters:
+        cluster_feats = np.any(features[[leaf for leaf in cluster if leaf < num_points]] > 0, axis=0)
+        for leaf in cluster:
+            if leaf >= num_points:
+                ecc = ecc_mx[leaf - num_points]
+                num_sat += bool(np.all(cluster_feats[ecc > 0]) and not np.any(cluster_feats[ecc < 0]))
+    return num_sat
+
+
+def random_similarities(n, rng):
+    pw_probs = rng.random((n, n))
+    pw_probs = np.triu(pw_probs, 1) + np.triu(pw_probs, 1).T
+    return pw_probs
+
+
+class TestTrellis(unittest.TestCase):
+    def test_matches_reference(self):
+        for seed in range(40):
+            n = 2 + seed
+            trees = random_trees(n, seed, ties=seed % 2 == 0)
+            for trellis_arrays, reference_arrays in zip(build_trellis_from_trees(trees),
+                                                        reference_build_trellis(trees)):
+                np.testing.assert_array_equal(trellis_arrays, reference_arrays)
+
+    def test_leaf_sets(self):
+        for seed in range(20):
+            n = 3 + 2 * seed
+            trees = random_trees(n, seed, ties=seed % 2 == 1)
+            leaves_indptr, leaves_indices, child_pairs_indptr, child_pairs_indices = build_trellis_from_trees(trees)
+            node_leaves = [tuple(leaves_indices[leaves_indptr[node]:leaves_indptr[node + 1]])
+                           for node in range(len(leaves_indptr) - 1)]
+            # Leaves come first, and every node has a distinct sorted leaf set
+            assert node_leaves[:n] == [(i,) for i in range(n)]
+            assert len(set(node_leaves)) == len(node_leaves)
+            assert all(list(leaves) == sorted(set(leaves)) for leaves in node_leaves)
+            # Each child pair partitions the leaves of its node
+            for node, leaves in enumerate(node_leaves):
+                pairs = child_pairs_indices[child_pairs_indptr[node]:child_pairs_indptr[node + 1]].reshape(-1, 2)
+                assert (len(pairs) == 0) == (node < n)
+                for lchild, rchild in pairs:
+                    assert not set(node_leaves[lchild]) & set(node_leaves[rchild])
+                    assert tuple(sorted(node_leaves[lchild] + node_leaves[rchild])) == leaves
+            # Every cluster of every tree is a trellis node
+            for tree in trees:
+                clusters = [[i] for i in range(n)] + [[] for _ in range(n - 1)]
+                for node in range(len(tree) - 1):
+                    clusters[tree[node]] += clusters[node]
+                assert all(tuple(sorted(cluster)) in node_leaves for cluster in clusters)
+
+    def test_cut(self):
+        rng = np.random.default_rng(0)
+        for _ in range(30):
+            n = int(rng.integers(2, 9))
+            t = build_trellis(random_similarities(n, rng))
+            W = np.round(10 * np.triu(rng.normal(size=(n, n)), 1))
+            best_clustering, obj_val, num_ecc_sat = cut_trellis(t, coo_matrix(W))
+            root = t.topo_order[-1]
+            assert abs(obj_val - max(cut_energy(W, clusters) for clusters in trellis_cuts(t, root))) < 1e-9
+            assert num_ecc_sat == 0
+            # The clustering is a trellis cut with the optimal energy
+            clusters = [tuple(np.where(best_clustering == label)[0]) for label in np.unique(best_clustering)]
+            assert sorted(clusters) in [sorted(cut) for cut in trellis_cuts(t, root)]
+            assert abs(cut_energy(W, clusters) - obj_val) < 1e-9
+
+    def test_cut_with_eccs(self):
+        rng = np.random.default_rng(1)
+        for _ in range(40):
+            num_points, n_feats, num_ecc = int(rng.integers(2, 7)), int(rng.integers(2, 6)), int(rng.integers(1, 4))
+            features = (rng.random((num_points, n_feats)) < 0.4).astype(float)
+            # Positive features of some point (the ECC is satisfiable), and negative features among the others
+            ecc_mx = np.zeros((num_ecc, n_feats))
+            for e in range(num_ecc):
+                point_feats = np.where(features[rng.integers(num_points)] > 0)[0]
+                ecc_mx[e, point_feats[:2] if point_feats.size else rng.integers(n_feats)] = 1
+                ecc_mx[e, (ecc_mx[e] == 0) & (rng.random(n_feats) < 0.3)] = -1
+            n = num_points + num_ecc
+            t = build_trellis(random_similarities(n, rng))
+            W = np.zeros((n, n))
+            W[:num_points, :num_points] = np.round(10 * np.triu(rng.normal(size=(num_points, num_points)), 1))
+            best_clustering, obj_val, num_ecc_sat = cut_trellis(t, coo_matrix(W[:num_points, :num_points]),
+                                                                csr_matrix(features), csr_matrix(ecc_mx))
+            # Most satisfied ECCs first, then the highest energy
+            root = t.topo_order[-1]
+            best = max((num_ecc_satisfied(features, ecc_mx, clusters), cut_energy(W, clusters))
+                       for clusters in trellis_cuts(t, root))
+            assert num_ecc_sat == best[0] and abs(obj_val - best[1]) < 1e-9
+            clusters = [tuple(np.where(best_clustering == label)[0]) for label in np.unique(best_clustering)]
+            assert num_ecc_satisfied(features, ecc_mx, clusters) == num_ecc_sat
+            assert abs(cut_energy(W, clusters) - obj_val) < 1e-9
+
+
+def untied_blocks(n_blocks, seed):
+    # The blocks of random_blocks without ties in X, on which the linkage trees do not depend on tie-breaking
+    return [block for b, block in enumerate(random_blocks(n_blocks, seed=seed)) if b % 3 and b % 5]
+
+
+class TestTrellisCutLayer(unittest.TestCase):
+    def test_average_linkage_matches_hac_cut(self):
+        # The trellis of the average linkage tree alone is the tree cut by HACCutLayer
+        hac_cut_layer, trellis_cut_layer = HACCutLayer(), TrellisCutLayer(linkages=['average'])
+        for X, W in untied_blocks(40, seed=4):
+            hac_cut_layer.get_rounded_solution(X.clone(), W.clone(), max_similarity=torch.max(X))
+            round_matrix = trellis_cut_layer.get_rounded_solution(X.clone(), W.clone())
+            assert abs(trellis_cut_layer.objective_value - hac_cut_layer.objective_value) < 1e-4
+            assert trellis_cut_layer.objective_value == get_max_agree_objective(W, round_matrix)
+
+    def test_all_linkages(self):
+        hac_cut_layer, trellis_cut_layer = HACCutLayer(), TrellisCutLayer()
+        blocks = untied_blocks(30, seed=5)
+        cluster_labels, objective_values = trellis_cut_layer.get_rounded_solutions([X for X, _ in blocks],
+                                                                                   [W for _, W in blocks])
+        for (X, W), labels, objective_value in zip(blocks, cluster_labels, objective_values):
+            round_matrix = trellis_cut_layer.get_rounded_solution(X, W)
+            assert torch.equal(labels, trellis_cut_layer.cluster_labels)
+            assert objective_value == trellis_cut_layer.objective_value
+            # The intra-cluster weight is the cut objective, and not below that of the average linkage tree cut
+            intra = torch.sum(W.double() * torch.triu(round_matrix.double(), diagonal=1)).item()
+            assert abs(intra - trellis_cut_layer.cut_obj_value) < 1e-4
+            hac_cut_layer.get_rounded_solution(X.clone(), W.clone(), max_similarity=torch.max(X))
+            assert intra >= hac_cut_layer.node_energies[-1].item() - 1e-4
+
+    def test_invalid_linkage(self):
+        with self.assertRaises(ValueError):
+            TrellisCutLayer(linkages=['ward']).get_rounded_solution(torch.eye(3), torch.zeros(3, 3))
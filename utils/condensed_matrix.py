@@ -0,0 +1,108 @@
+from collections import OrderedDict
+
+import torch
+
+
+class TriuIndexCache:
+    """
+    Bounded LRU cache of the indices of the strict upper triangle of an NxN matrix (in torch.triu_indices order),
+    keyed by N and device. Each entry holds the row, column and flat (row * N + column) indices of the N(N-1)/2 pairs.
+    The cache holds at most max_pairs pairs in total; larger matrices are indexed without caching.
+    Cached tensors are shared by all callers and must not be modified in place.
+    """
+
+    def __init__(self, max_pairs=2 ** 22):
+        self.max_pairs = max_pairs
+        self.hits = 0
+        self.misses = 0
+        self._n_pairs = 0
+        self._cache = OrderedDict()
+
+    def get(self, N, device='cpu'):
+        key = (N, str(torch.device(device)))
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.misses += 1
+        rows, cols = torch.triu_indices(N, N, offset=1, device=device)
+        indices = (rows, cols, rows * N + cols)
+        n_pairs = N * (N - 1) // 2
+        if n_pairs <= self.max_pairs:
+            self._cache[key] = indices
+            self._n_pairs += n_pairs
+            self._evict()
+        return indices
+
+    def _evict(self):
+        while self._n_pairs > self.max_pairs:
+            (N, _), _ = self._cache.popitem(last=False)
+            self._n_pairs -= N * (N - 1) // 2
+
+    def resize(self, max_pairs):
+        self.max_pairs = max_pairs
+        self._evict()
+
+    def clear(self):
+        self._cache.clear()
+        self._n_pairs = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'n_pairs': self._n_pairs,
+            'max_pairs': self.max_pairs,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_lookups if n_lookups > 0 else 0.
+        }
+
+    def __len__(self):
+        return len(self._cache)
+
+
+TRIU_INDEX_CACHE = TriuIndexCache()
+
+
+def triu_indices(N, device='cpu'):
+    """
+    Row and column indices of the strict upper triangle of an NxN matrix, as torch.triu_indices(N, N, offset=1)
+    """
+    rows, cols, _ = TRIU_INDEX_CACHE.get(N, device)
+    return rows, cols
+
+
+def triu_indices_np(N):
+    """
+    Row and column indices of the strict upper triangle of an NxN matrix, as np.triu_indices(N, k=1)
+    """
+    rows, cols, _ = TRIU_INDEX_CACHE.get(N)
+    return rows.numpy(), cols.numpy()
+
+
+def uncompress(condensed, N, make_symmetric=False, ones_diagonal=False):
+    """
+    NxN matrix from the N(N-1)/2 condensed vector of its strict upper triangle (zeros elsewhere). With make_symmetric,
+    the lower triangle is filled too, and with ones_diagonal, the diagonal is set to 1
+    """
+    rows, cols, flat = TRIU_INDEX_CACHE.get(N, condensed.device)
+    matrix = torch.zeros(N * N, dtype=condensed.dtype, device=condensed.device)
+    matrix.index_put_((flat,), condensed)
+    matrix = matrix.view(N, N)
+    if make_symmetric:
+        matrix.index_put_((cols, rows), condensed)
+    if ones_diagonal:
+        matrix.fill_diagonal_(1.)
+    return matrix
+
+
+def compress(matrix):
+    """
+    N(N-1)/2 condensed vector of the strict upper triangle of an NxN matrix
+    """
+    N = matrix.size(0)
+    _, _, flat = TRIU_INDEX_CACHE.get(N, matrix.device)
+    return matrix.reshape(-1).index_select(0, flat)
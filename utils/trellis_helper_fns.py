@@ -3,29 +3,144 @@ import numpy as np
 import numba as nb
 from scipy.sparse import csr_matrix, coo_matrix
 
-def build_trellis(pw_probs: np.ndarray, only_avg_hac: bool = False):
-    t = Trellis(adj_mx=pw_probs)
+def build_trellis(pw_probs: np.ndarray, only_avg_hac: bool = False, linkages=None):
+    t = Trellis(adj_mx=pw_probs, linkages=linkages)
     t.fit(only_avg_hac=only_avg_hac)
     return t
 
 
-def cut_trellis(t: Trellis, edge_weights: coo_matrix):
-    membership_indptr = t.leaves_indptr
-    membership_indices = t.leaves_indices
-    membership_data = get_membership_data(membership_indptr,
-                                          membership_indices)
-    obj_vals = np.zeros((t.num_nodes,))
-    num_ecc_sat = np.zeros((t.num_nodes,))
-
-    for node in t.internal_nodes_topo_ordered():
-        node_start = membership_indptr[node]
-        node_end = membership_indptr[node + 1]
-        leaves = membership_indices[node_start:node_end]
-        # if num_ecc > 0: # Condition is never true for 0 there-exists constraints
-        #     num_ecc_sat[node] = get_num_ecc_sat(
-        #         leaves, num_points)
-        obj_vals[node] = get_intra_cluster_energy(edge_weights, leaves)
-        for lchild, rchild in t.get_child_pairs_iter(node):
+def get_symmetric_adjacency(edge_weights: coo_matrix, n: int):
+    """
+    CSR adjacency of W + W^T without the diagonal, plus the diagonal of W, so that the energy of a set of leaves
+    (the sum of all entries of `edge_weights` within the set) can be built up from pairwise cross sums
+    """
+    edge_weights = coo_matrix((edge_weights.data, (edge_weights.row, edge_weights.col)), shape=(n, n))
+    adj = (edge_weights + edge_weights.T).tocsr().astype(np.float64)
+    diag = edge_weights.diagonal().astype(np.float64)
+    adj.setdiag(0.)
+    adj.eliminate_zeros()
+    adj.sort_indices()
+    return adj.indptr, adj.indices, adj.data, diag
+
+
+def get_ecc_bitsets(point_features: csr_matrix, ecc_mx: csr_matrix):
+    """
+    Features of each point as a bitset over the features used by the ECCs (rows of ecc_mx), and ecc_mx with its
+    column indices mapped to bit positions
+    """
+    ecc_mx = csr_matrix(ecc_mx)
+    ecc_feats = np.unique(ecc_mx.indices)
+    n_words = max((ecc_feats.size + 63) // 64, 1)
+    point_ecc_feats = csr_matrix(point_features)[:, ecc_feats].tocoo()
+    point_bitsets = np.zeros((point_features.shape[0], n_words), dtype=np.uint64)
+    np.bitwise_or.at(point_bitsets, (point_ecc_feats.row, point_ecc_feats.col // 64),
+                     np.left_shift(np.uint64(1), (point_ecc_feats.col % 64).astype(np.uint64)))
+    ecc_bits = np.searchsorted(ecc_feats, ecc_mx.indices).astype(np.int64)
+    return point_bitsets, ecc_mx.indptr.astype(np.int64), ecc_bits, ecc_mx.data.astype(np.float64)
+
+
+def cut_trellis(t: Trellis, edge_weights: coo_matrix, point_features: csr_matrix = None, ecc_mx: csr_matrix = None):
+    """
+    Best clustering in the trellis: maximizes the number of satisfied ECCs, and then the intra-cluster energy.
+    With ECCs, the first point_features.shape[0] leaves are points and the others are the ECCs (rows of ecc_mx)
+    """
+    membership_data = get_membership_data(t.leaves_indptr, t.leaves_indices)
+    if ecc_mx is None:
+        # Always the case for 0 there-exists constraints
+        num_points = t.n
+        point_bitsets = np.zeros((t.n, 1), dtype=np.uint64)
+        ecc_indptr, ecc_bits, ecc_data = np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    else:
+        num_points = point_features.shape[0]
+        point_bitsets, ecc_indptr, ecc_bits, ecc_data = get_ecc_bitsets(point_features, ecc_mx)
+    adj_indptr, adj_indices, adj_data, diag = get_symmetric_adjacency(edge_weights, t.n)
+    obj_vals, num_ecc_sat = cut_trellis_dp(t.leaves_indptr, t.leaves_indices, t.child_pairs_indptr,
+                                           t.child_pairs_indices, t.topo_order, adj_indptr, adj_indices, adj_data,
+                                           diag, num_points, point_bitsets, ecc_indptr, ecc_bits, ecc_data,
+                                           membership_data)
+
+    # The last node in topological order is the root of the trellis
+    root = t.topo_order[-1]
+    best_clustering = membership_data[t.leaves_indptr[root]:t.leaves_indptr[root + 1]]
+
+    return best_clustering, obj_vals[root], num_ecc_sat[root]
+
+
+@nb.njit
+def cut_trellis_dp(leaves_indptr: np.ndarray,
+                   leaves_indices: np.ndarray,
+                   child_pairs_indptr: np.ndarray,
+                   child_pairs_indices: np.ndarray,
+                   topo_order: np.ndarray,
+                   adj_indptr: np.ndarray,
+                   adj_indices: np.ndarray,
+                   adj_data: np.ndarray,
+                   diag: np.ndarray,
+                   num_points: int,
+                   point_bitsets: np.ndarray,
+                   ecc_indptr: np.ndarray,
+                   ecc_bits: np.ndarray,
+                   ecc_data: np.ndarray,
+                   membership_data: np.ndarray):
+    num_nodes = leaves_indptr.size - 1
+    n = diag.size
+    # Energy of each node as a single cluster; any child pair of a node partitions its leaves, so it is the sum of
+    # the energies of the children plus the weight of the edges across them
+    intra = np.zeros(num_nodes)
+    # Features (used by the ECCs) of the points of each node, as bitsets
+    bitsets = np.zeros((num_nodes, point_bitsets.shape[1]), dtype=np.uint64)
+    for node in range(num_nodes):
+        if leaves_indptr[node + 1] - leaves_indptr[node] == 1:
+            leaf = leaves_indices[leaves_indptr[node]]
+            intra[node] = diag[leaf]
+            if leaf < num_points:
+                bitsets[node] = point_bitsets[leaf]
+    obj_vals = np.zeros(num_nodes)
+    num_ecc_sat = np.zeros(num_nodes)
+    marker = np.full(n, -1, dtype=np.int64)
+
+    for node in topo_order:
+        node_start = leaves_indptr[node]
+        node_end = leaves_indptr[node + 1]
+        lchild = child_pairs_indices[child_pairs_indptr[node]]
+        rchild = child_pairs_indices[child_pairs_indptr[node] + 1]
+        # Mark the leaves of the larger child and scan the adjacency rows of the smaller one
+        if leaves_indptr[lchild + 1] - leaves_indptr[lchild] < leaves_indptr[rchild + 1] - leaves_indptr[rchild]:
+            small, large = lchild, rchild
+        else:
+            small, large = rchild, lchild
+        for i in range(leaves_indptr[large], leaves_indptr[large + 1]):
+            marker[leaves_indices[i]] = node
+        cross = 0.
+        for i in range(leaves_indptr[small], leaves_indptr[small + 1]):
+            u = leaves_indices[i]
+            for k in range(adj_indptr[u], adj_indptr[u + 1]):
+                if marker[adj_indices[k]] == node:
+                    cross += adj_data[k]
+        intra[node] = intra[lchild] + intra[rchild] + cross
+
+        # An ECC in the node is satisfied if the points of the node have all of its positive features and none of
+        # its negative ones; the ECC leaves are the last leaves of the node
+        bitsets[node] = bitsets[lchild] | bitsets[rchild]
+        node_num_ecc_sat = 0
+        i = node_end - 1
+        while i >= node_start and leaves_indices[i] >= num_points:
+            ecc_idx = leaves_indices[i] - num_points
+            to_satisfy = 0.
+            satisfied = 0.
+            for k in range(ecc_indptr[ecc_idx], ecc_indptr[ecc_idx + 1]):
+                if ecc_data[k] > 0:
+                    to_satisfy += 1.
+                if (bitsets[node, ecc_bits[k] // 64] >> np.uint64(ecc_bits[k] % 64)) & np.uint64(1):
+                    satisfied += ecc_data[k]
+            if satisfied == to_satisfy:
+                node_num_ecc_sat += 1
+            i -= 1
+        num_ecc_sat[node] = node_num_ecc_sat
+        obj_vals[node] = intra[node]
+        for j in range(child_pairs_indptr[node], child_pairs_indptr[node + 1], 2):
+            lchild = child_pairs_indices[j]
+            rchild = child_pairs_indices[j + 1]
             cpair_num_ecc_sat = num_ecc_sat[lchild] + num_ecc_sat[rchild]
             cpair_obj_val = obj_vals[lchild] + obj_vals[rchild]
             if (num_ecc_sat[node] < cpair_num_ecc_sat
@@ -33,28 +148,20 @@ def cut_trellis(t: Trellis, edge_weights: coo_matrix):
                         and obj_vals[node] < cpair_obj_val)):
                 num_ecc_sat[node] = cpair_num_ecc_sat
                 obj_vals[node] = cpair_obj_val
-                lchild_start = membership_indptr[lchild]
-                lchild_end = membership_indptr[lchild + 1]
-                rchild_start = membership_indptr[rchild]
-                rchild_end = membership_indptr[rchild + 1]
+                lchild_start = leaves_indptr[lchild]
+                lchild_end = leaves_indptr[lchild + 1]
+                rchild_start = leaves_indptr[rchild]
+                rchild_end = leaves_indptr[rchild + 1]
                 merge_memberships(
-                    membership_indices[lchild_start:lchild_end],
+                    leaves_indices[lchild_start:lchild_end],
                     membership_data[lchild_start:lchild_end],
-                    membership_indices[rchild_start:rchild_end],
+                    leaves_indices[rchild_start:rchild_end],
                     membership_data[rchild_start:rchild_end],
-                    membership_indices[node_start:node_end],
+                    leaves_indices[node_start:node_end],
                     membership_data[node_start:node_end],
                 )
 
-    # The value of `node` is the root since we iterate over the trellis
-    # nodes in topological order bottom up. Moreover, the values of
-    # `node_start` and `node_end` also correspond to the root of the
-    # trellis.
-    best_clustering = membership_data[node_start:node_end]
-    # if num_ecc > 0: # Condition is never true for 0 there-exists constraints
-    #     best_clustering = best_clustering[:-num_ecc]
-
-    return best_clustering, obj_vals[node], num_ecc_sat[node]
+    return obj_vals, num_ecc_sat
 
 @nb.njit(parallel=True)
 def get_membership_data(indptr: np.ndarray,
@@ -65,13 +172,6 @@ def get_membership_data(indptr: np.ndarray,
             data[j] = i
     return data
 
-def get_intra_cluster_energy(edge_weights: coo_matrix,
-                             leaves: np.ndarray):
-    row_mask = np.isin(edge_weights.row, leaves)
-    col_mask = np.isin(edge_weights.col, leaves)
-    data_mask = row_mask & col_mask
-    return np.sum(edge_weights.data[data_mask])
-
 @nb.njit
 def merge_memberships(lchild_indices: np.ndarray,
                       lchild_data: np.ndarray,